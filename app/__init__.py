@@ -15,11 +15,18 @@ import micropython
 # --- Utils ---
 import utils.t_logger as t_logger
 from utils.init_wifi import init_wifi
-from utils.messagebus import MessageBus, Subscriber, Publisher
+from utils.messagebus import (MessageBus, Subscriber, Publisher, check_priority, check_timeout,
+                              PRIORITY_NORMAL, PRIORITY_URGENT)
+from utils.bus_bridge import BusBridge, bus_bridge_task, DEFAULT_LEASE_S
+from utils.mem_service import MemService, mem_task
+from utils.telemetry import telemetry_task
+from utils.jobs import jobs_task
+from utils.task_resources import TaskResources
+from utils.calibration import calibration
 from utils.coap_server import (
-    AsyncCoAPServer, CoAPRequest,
+    AsyncCoAPServer, CoAPRequest, iter_json,
     METHOD_GET, METHOD_POST,
-    RESP_CONTENT, RESP_CHANGED, RESP_BAD_REQ, RESP_INTERNAL_ERR,
+    RESP_CONTENT, RESP_CHANGED, RESP_BAD_REQ, RESP_NOT_FOUND, RESP_INTERNAL_ERR,
 )
 
 # --- Hardware & Tasks ---
@@ -80,6 +87,7 @@ async def async_main():
 
     coap = AsyncCoAPServer()
     log.start_broadcast()
+    asyncio.create_task(log.flush_task())  # log lines buffered from here on, sent in batches
     log.info('[Init] CoAP Server Started')
     gc.collect()
 
@@ -108,36 +116,106 @@ async def async_main():
             print(e)
             return RESP_INTERNAL_ERR, {"text": str(e)}
 
-    @coap.route("/app/messagebus", methods=("POST",))
+    def is_urgent(req):
+        data = req.json
+        return isinstance(data, dict) and data.get('priority') == PRIORITY_URGENT
+
+    # long reply waits (e.g. a us_scan) leave workers for the other routes,
+    # an urgent message (the joystick stop) is admitted past every limit
+    @coap.route("/app/messagebus", methods=("POST",), max_concurrency=6, urgent=is_urgent)
     async def messagebus_handler(req: CoAPRequest):
         log.info('=== MessageBus ===')
         data = req.json
         if not data:
             return RESP_BAD_REQ, {'text': "Bad Request missing body"}
 
-        publisher.publish(data['topic'], data['payload'])
-
+        try:
+            priority = check_priority(data.get('priority', PRIORITY_NORMAL))
+            timeout = check_timeout(data.get('reply_timeout', 2))
+        except ValueError as e:
+            return RESP_BAD_REQ, {'text': str(e)}
         if data.get('wait_reply', 'No').upper() == 'YES' or data.get('reply_topic', None):
             req.send_ack()
-
-            # 1. Create the subscriber explicitly
-            sub = Subscriber(subscriber_id='messagebus_handler', topics=data['reply_topic'])
-
             try:
-                # 2. Wait for the message
-                topic, sender_id, message = await sub.get(timeout=float(data.get('reply_timeout', 2)))
-                return RESP_CONTENT, {'topic': topic, 'sender_id': sender_id, 'message': message}
+                # correlated request, only the reply to this request is returned
+                topic, sender_id, message = await publisher.request(
+                    data['topic'], data['payload'],
+                    timeout=timeout,
+                    reply_topic=data.get('reply_topic', None),
+                    priority=priority)
+                # streamed: large replies (e.g. us_scan_report) go out as Block2
+                return RESP_CONTENT, iter_json({'topic': topic, 'sender_id': sender_id, 'message': message})
+            except ValueError as e:
+                return RESP_BAD_REQ, {'text': str(e)}
             except asyncio.TimeoutError:
                 return RESP_INTERNAL_ERR, {'text': "Timeout waiting for reply"}
-            finally:
-                # 3. CRITICAL: Unsubscribe and remove from global bus
-                sub.close()
-                del sub
         else:
+            publisher.publish(data['topic'], data['payload'], priority)
             return RESP_CHANGED, {"text": "OK"}
 
-    @coap.route('/app/log/level', ('POST',))
+    @coap.route('/app/bus/stats', ('GET',))
+    async def bus_stats_handler(req: CoAPRequest):
+        return RESP_CONTENT, MessageBus.instance().stats()
+
+    @coap.route('/app/bus/stream', ('GET', 'POST'))
+    async def bus_stream_handler(req: CoAPRequest):
+        """
+        Register/renew a UDP stream of topics to the caller (empty topics stops it).
+        The stream always goes to the requesting address, only the port is chosen.
+        """
+        bridge = BusBridge.instance()
+        if req.method == METHOD_GET:
+            return RESP_CONTENT, bridge.stats()
+        data = req.json
+        if data is None:
+            return RESP_BAD_REQ, {'text': "Missing body"}
+        try:
+            ret = bridge.register(req.ip, data.get('port', log.multicast_port),
+                                  data.get('topics'), float(data.get('lease_s', DEFAULT_LEASE_S)))
+        except ValueError as e:
+            return RESP_BAD_REQ, {'text': str(e)}
+        return RESP_CHANGED, ret or {'text': 'Removed'}
+
+    # ETag from the change counter: an unchanged calibration costs one 2.03 packet
+    @coap.route('/app/calibration', ('GET',), etag=lambda req: calibration.version, max_age=10)
+    async def calibration_handler(req: CoAPRequest):
+        """Calibration dump, ?key= selects one entry."""
+        key = req.query.get('key')
+        if key is None:
+            return RESP_CONTENT, iter_json(calibration.data)
+        if key not in calibration.data:
+            return RESP_NOT_FOUND, {'text': f"No calibration '{key}'"}
+        return RESP_CONTENT, iter_json(calibration.data[key])
+
+    @coap.route('/app/coap/stats', ('GET', 'POST'))
+    async def coap_stats_handler(req: CoAPRequest):
+        """Server counters; POST {'rate', 'burst'} sets the per client rate limit."""
+        if req.method != METHOD_GET:
+            data = req.json
+            if not data:
+                return RESP_BAD_REQ, {'text': "Missing body"}
+            coap.set_rate_limit(data.get('rate'), data.get('burst'))
+        return RESP_CONTENT, coap.stats()
+
+    @coap.route('/app/mem', ('GET', 'POST'))
+    async def mem_handler(req: CoAPRequest):
+        """Heap telemetry; POST {'threshold', 'free_min', 'idf_free_min', 'largest_min', 'frag_max'} tunes it."""
+        mem = MemService.instance()
+        if req.method != METHOD_GET:
+            data = req.json
+            if not data:
+                return RESP_BAD_REQ, {'text': "Missing body"}
+            if 'threshold' in data:
+                mem.set_threshold(data['threshold'])
+            mem.set_alerts(free_min=data.get('free_min'), idf_free_min=data.get('idf_free_min'),
+                           largest_min=data.get('largest_min'), frag_max=data.get('frag_max'))
+        return RESP_CONTENT, mem.stats()
+
+    @coap.route('/app/log/level', ('GET', 'POST'))
     async def log_level_handler(req: CoAPRequest):
+        if req.method == METHOD_GET:
+            return RESP_CONTENT, {"console": log.level_console, "network": log.level_network,
+                                  "stats": log.stats()}
         data = req.json
         if not data:
             return RESP_BAD_REQ, {'text': "Missing body"}
@@ -145,6 +223,8 @@ async def async_main():
         log.set_level(console=data.get('console'), network=data.get('network'))
         return RESP_CHANGED, {"console": log.level_console, "network": log.level_network}
 
+    TaskResources(coap)  # /task/<name>: bus topics without the /app/messagebus wrapper
+
     log.info('Done routs')
     gc.collect()
 
@@ -152,6 +232,10 @@ async def async_main():
     # 4. Start Server Task
     asyncio.create_task(coap.run())
     log.info('[Init] CoAP Server Started')
+    asyncio.create_task(bus_bridge_task())
+    asyncio.create_task(mem_task())
+    asyncio.create_task(telemetry_task(coap))
+    asyncio.create_task(jobs_task(coap))  # /app/jobs: us_scan, calibrations without holding a worker
     # gc.collect()
 
     # 5. Start Hardware Tasks
@@ -0,0 +1,88 @@
+"""
+CoAP ping round-trip benchmark (PC-side)
+----------------------------------------
+Sends GET /app/ping to the robot back to back and prints the RTT
+distribution, e.g. to compare the server receive loop before/after a change:
+    python bench_ping.py [robot_ip] [count]
+The server rate limits every client (CLIENT_RATE/CLIENT_BURST in
+utils/coap_server.py), so the benchmark raises its bucket through
+POST /app/coap/stats for the run and restores it afterwards. Only 2.xx
+responses count as round trips, anything else (e.g. 4.29) is a failure.
+"""
+import sys
+import json
+import time
+import asyncio
+from aiocoap import Message, Code, Context
+from coap_client_interface import ROBOT_IP
+
+
+BENCH_RATE = 1000  # requests/s allowed during the run (the server maximum)
+
+
+async def _rate_limit(context, ip, rate=None, burst=None):
+    """GET (or POST new values to) /app/coap/stats, returns the (rate, burst) in force."""
+    uri = f"coap://{ip}/app/coap/stats"
+    if rate is None:
+        message = Message(code=Code.GET, uri=uri)
+    else:
+        message = Message(code=Code.POST, uri=uri, payload=json.dumps({'rate': rate, 'burst': burst}).encode())
+    response = await asyncio.wait_for(context.request(message).response, 5)
+    stats = json.loads(response.payload)
+    return stats['rate'], stats['burst']
+
+
+async def ping_rtt(ip, count=200, interval=0.0):
+    """
+    Returns (round-trip times in ms of the 2.xx answered pings,
+    {failure: count}) where a failure is a response code or 'timeout'.
+    """
+    context = await Context.create_client_context()
+    uri = f"coap://{ip}/app/ping"
+    rtts = []
+    failures = {}
+    try:
+        saved = await _rate_limit(context, ip)
+        await _rate_limit(context, ip, BENCH_RATE, count)
+        try:
+            for _ in range(count):
+                t0 = time.perf_counter()
+                try:
+                    response = await asyncio.wait_for(context.request(Message(code=Code.GET, uri=uri)).response, 5)
+                    if response.code.is_successful():
+                        rtts.append((time.perf_counter() - t0) * 1000)
+                    else:
+                        failures[str(response.code)] = failures.get(str(response.code), 0) + 1
+                except Exception:
+                    failures['timeout'] = failures.get('timeout', 0) + 1
+                if interval:
+                    await asyncio.sleep(interval)
+        finally:
+            await _rate_limit(context, ip, *saved)
+    finally:
+        await context.shutdown()
+    return rtts, failures
+
+
+def _percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def main():
+    ip = sys.argv[1] if len(sys.argv) > 1 else ROBOT_IP
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    # idle (spaced) pings show the wakeup latency, back to back pings the throughput
+    for name, interval in (('back to back', 0.0), ('spaced 50 ms', 0.05)):
+        rtts, failures = asyncio.run(ping_rtt(ip, count, interval))
+        rtts.sort()
+        if failures:
+            print(f"{name:>12}: {sum(failures.values())} of {count} pings failed {failures}")
+        if not rtts:
+            print(f"{name}: no reply from {ip}")
+            continue
+        print(f"{name:>12}: n={len(rtts)} min {rtts[0]:.1f} ms, median {_percentile(rtts, 50):.1f} ms, "
+              f"p95 {_percentile(rtts, 95):.1f} ms, max {rtts[-1]:.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,19 @@
+"""
+CBOR codec (PC-side)
+--------------------
+The robot's utils/cbor.py, loaded from the repository so both sides share
+one codec for Content-Format 60 (see that module for what it covers).
+"""
+import os
+import importlib.util
+
+_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'utils', 'cbor.py')
+_spec = importlib.util.spec_from_file_location('robot_cbor', _PATH)
+_cbor = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(_cbor)
+
+CF_CBOR = _cbor.CF_CBOR
+dumps = _cbor.dumps
+loads = _cbor.loads
+encode_into = _cbor.encode_into
+iter_encode = _cbor.iter_encode
@@ -12,10 +12,14 @@ import logging
 import warnings
 
 # Add 'init_client' to the list
-from coap_client_interface import post_to_messagebus, post_to_robot, init_client, set_log_callback
+from coap_client_interface import post_to_messagebus, post_to_robot, init_client, set_log_callback, PRIORITY_URGENT
 from polar_plot_widget import PolarPlot
 
 
+# a stop answered 4.29/5.03 (robot rate limit, full queue) is sent again
+STOP_RETRIES = 5
+STOP_RETRY_S = 0.1
+
 # room north offset -52.325 of East wall
 # North&South wall @52.325 (2800mm [27]) East&West @323.325 (3300mm)
 # on map widget draw north offset arrow, and the walls.
@@ -227,7 +231,7 @@ class MessageSender(threading.Thread):
         self._payload = None
         self.start()
 
-    def send(self, topic, payload, reply_topic=None, reply_timeout=2, wait_timeout=2):
+    def send(self, topic, payload, reply_topic=None, reply_timeout=2, wait_timeout=2, priority=0):
         # Update the current message to be sent (overwriting any pending one)
         with self._lock:
             self._topic = topic
@@ -235,6 +239,7 @@ class MessageSender(threading.Thread):
             self._reply_topic = reply_topic
             self._reply_timeout = reply_timeout
             self._wait_timeout = wait_timeout
+            self._priority = priority
         # Signal the worker thread that there is a message
         self._event.set()
 
@@ -248,14 +253,22 @@ class MessageSender(threading.Thread):
                 reply_topic = self._reply_topic
                 reply_timeout = self._reply_timeout
                 wait_timeout = self._wait_timeout
+                priority = self._priority
                 self._topic = None
                 self._payload = None
                 self._reply_topic = None
                 self._wait_timeout = 2
                 self._reply_timeout = 2
+                self._priority = 0
             if topic:
                 try:
-                    response = post_to_messagebus(topic, payload, reply_topic, reply_timeout, wait_timeout)
+                    for _ in range(STOP_RETRIES + 1):
+                        response = post_to_messagebus(topic, payload, reply_topic, reply_timeout, wait_timeout,
+                                                      priority=priority)
+                        # a refused stop is retried, unless a newer command replaced it
+                        if priority != PRIORITY_URGENT or response[0] not in (429, 503) or self._event.is_set():
+                            break
+                        time.sleep(STOP_RETRY_S)
                     if reply_topic:
                         self.return_q.put(response)
                 except Exception as e:
@@ -434,7 +447,10 @@ class ClientUi(tk.Frame):
         p1, p2 = (p, p2) if x < 0 else (p2, p)
         print('PWR', r, x, y, p1, p2)
         p = 0
-        self.sender.send('motors_task', {'motor0_power': p1 * 100, 'motor1_power': p2 * 100})
+        # a stop jumps ahead of any queued command on the robot
+        priority = PRIORITY_URGENT if p1 == 0 and p2 == 0 else 0
+        self.sender.send('motors_task', {'motor0_power': p1 * 100, 'motor1_power': p2 * 100},
+                         priority=priority)
 
     def do_ahrc_btn(self):
         response = post_to_messagebus('ahrs_task', {'command': 'single'}, reply_topic='ahrs_report', reply_timeout=2, wait_timeout=2)
@@ -6,17 +6,57 @@ import socket
 import struct
 # import logging
 from aiocoap import Message, Code, Context, resource
+import cbor_codec
 
 # CoAP Configuration
 ROBOT_IP = "192.168.1.80"  # Robot IP Address
 COAP_PORT = 5683
 
+# Message bus priorities (utils/messagebus.py PRIORITY_xxx)
+PRIORITY_NORMAL = 0
+PRIORITY_HIGH = 1
+PRIORITY_URGENT = 2
+
+# Bus bridge streams (utils/bus_bridge.py)
+STREAM_PORT = 5683  # frames arrive on the log listener port
+STREAM_LEASE_S = 60
+
+# Payload content formats (utils/coap_server.py CF_xxx)
+CF_JSON = 50
+CF_CBOR = cbor_codec.CF_CBOR
+
+# Longest default reply timeout of the /task/<name> bindings (us_scan)
+TASK_MAX_TIMEOUT_S = 120
+
+# GET response cache (ETag revalidation, fresh for the response Max-Age)
+CACHE_MAX = 64
+
+
+def topic_matches(pattern, topic):
+    """True if a concrete topic name matches a name or +/# pattern (as utils/messagebus.py)."""
+    p = pattern.split('/')
+    t = topic.split('/')
+    for i, level in enumerate(p):
+        if level == '#':
+            return True
+        if i == len(t) or (level != '+' and level != t[i]):
+            return False
+    return len(p) == len(t)
+
 class CoapInterface:
     def __init__(self, robot_ip):
         self.robot_ip = robot_ip
         self.loop = asyncio.new_event_loop()
         self.context = None
         self.log_callback = None
+        self.content_format = CF_JSON  # request payloads and preferred responses
+        self.cache = {}  # (uri, content format) -> [etag, payload, response cf, fresh until]
+        self.cache_stats = {'hits': 0, 'revalidated': 0, 'misses': 0}
+        self.stream_callbacks = {}  # topic pattern -> [callback(topic, sender_id, message)]
+        self.stream_stats = {'frames': 0, 'lost': 0, 'errors': 0}
+        self._stream_seq = None
+        self._stream_lock = threading.Lock()
+        self._stream_thread = None
 
         # Start UDP Listener Thread
         self._udp_thread = threading.Thread(target=self._run_udp_listener, daemon=True)
@@ -80,8 +120,13 @@ class CoapInterface:
         while True:
             try:
                 data, addr = sock.recvfrom(4096)
-                if self.log_callback:
-                    self.log_callback(data.decode('utf-8', errors='replace'))
+                if data[:1] == b'{':
+                    self._on_stream_frame(data)
+                elif self.log_callback:
+                    # the robot logger batches several '\n' separated lines per datagram
+                    for line in data.decode('utf-8', errors='replace').split('\n'):
+                        if line:
+                            self.log_callback(line)
             except Exception as e:
                 print(f"[UDP] Listener error: {e}")
                 time.sleep(1)
@@ -94,46 +139,169 @@ class CoapInterface:
     def set_log_callback(self, callback):
         self.log_callback = callback
 
+    def set_content_format(self, cf):
+        """CF_JSON or CF_CBOR (smaller, faster to parse on the robot) for requests and responses."""
+        if cf not in (CF_JSON, CF_CBOR):
+            raise ValueError(f"Unsupported content format {cf}")
+        self.content_format = cf
+
     def _on_log_received(self, msg):
         if self.log_callback:
             self.log_callback(msg)
 
-    async def _send_request_async(self, path, payload):
+    # --- Bus bridge streams ---
+    def _on_stream_frame(self, data):
+        """Fan a bus bridge frame out to the callbacks of matching patterns."""
+        try:
+            frame = json.loads(data.decode('utf-8'))
+        except ValueError:
+            self.stream_stats['errors'] += 1
+            return
+        seq = frame.get('seq', 0)
+        if self._stream_seq is not None and seq > self._stream_seq + 1:
+            self.stream_stats['lost'] += seq - self._stream_seq - 1
+        self._stream_seq = seq
+        self.stream_stats['frames'] += 1
+        topic = frame.get('topic', '')
+        with self._stream_lock:
+            callbacks = [cb for pattern, cbs in self.stream_callbacks.items()
+                         if topic_matches(pattern, topic) for cb in cbs]
+        for cb in callbacks:
+            try:
+                cb(topic, frame.get('sender_id'), frame.get('message'))
+            except Exception as e:
+                print(f"[Stream] Callback error on {topic}: {e}")
+
+    def _register_streams(self):
+        with self._stream_lock:
+            topics = list(self.stream_callbacks)
+        return self.send_rpc('/app/bus/stream',
+                             {'topics': topics, 'port': STREAM_PORT, 'lease_s': STREAM_LEASE_S})
+
+    def _run_stream_keepalive(self):
+        """Renew the robot side registration before the lease expires."""
+        while self.stream_callbacks:
+            time.sleep(STREAM_LEASE_S / 2)
+            if self.stream_callbacks:
+                status, _, data = self._register_streams()
+                if status >= 300:
+                    print(f"[Stream] Renew failed: {status} {data}")
+
+    def subscribe_stream(self, topics, callback):
+        """
+        Stream bus topics (names or +/# patterns) from the robot.
+        callback(topic, sender_id, message) runs on the UDP listener thread.
+        Returns (status_code, reason, json_data) of the registration.
+        """
+        if isinstance(topics, str):
+            topics = [topics]
+        with self._stream_lock:
+            for topic in topics:
+                self.stream_callbacks.setdefault(topic, []).append(callback)
+        ret = self._register_streams()
+        if self._stream_thread is None or not self._stream_thread.is_alive():
+            self._stream_thread = threading.Thread(target=self._run_stream_keepalive, daemon=True)
+            self._stream_thread.start()
+        return ret
+
+    def unsubscribe_stream(self, callback=None):
+        """Remove a callback (None removes all) and update the robot registration."""
+        with self._stream_lock:
+            for topic in list(self.stream_callbacks):
+                cbs = [cb for cb in self.stream_callbacks[topic] if callback is not None and cb != callback]
+                if cbs:
+                    self.stream_callbacks[topic] = cbs
+                else:
+                    del self.stream_callbacks[topic]
+        return self._register_streams()
+
+    async def _send_request_async(self, path, payload, method=Code.POST):
         uri = f"coap://{self.robot_ip}/{path.lstrip('/')}"
-        encoded_payload = json.dumps(payload).encode('utf-8')
+        cf = self.content_format
+        request = Message(code=method, uri=uri)
+        if method in (Code.POST, Code.PUT):
+            if cf == CF_CBOR:
+                request.payload = cbor_codec.dumps(payload)
+            else:
+                request.payload = json.dumps(payload).encode('utf-8')
+            request.opt.content_format = cf
+        request.opt.accept = cf
 
-        request = Message(code=Code.POST, uri=uri, payload=encoded_payload)
+        cached = self.cache.get((uri, cf)) if method == Code.GET else None
+        if cached is not None:
+            if time.monotonic() < cached[3]:
+                self.cache_stats['hits'] += 1
+                return Code.CONTENT, _decode_payload(cached[1], cached[2])
+            request.opt.etags = [cached[0]]
 
         try:
             response = await self.context.request(request).response
-            return response.code, response.payload
+            if response.code == Code.VALID and cached is not None:
+                # unchanged: the robot answered with one small packet
+                self.cache_stats['revalidated'] += 1
+                cached[3] = time.monotonic() + (response.opt.max_age or 0)
+                return Code.CONTENT, _decode_payload(cached[1], cached[2])
+            if method == Code.GET:
+                self._cache_store((uri, cf), response)
+            return response.code, _decode_payload(response.payload, response.opt.content_format)
         except Exception as e:
             print(f"[CoAP] Request failed: {e}")
             return None, None
 
-    def send_rpc(self, path, payload, timeout=5):
+    def _cache_store(self, key, response):
+        self.cache.pop(key, None)
+        if response.code != Code.CONTENT or response.opt.etag is None:
+            return
+        self.cache_stats['misses'] += 1
+        if len(self.cache) >= CACHE_MAX:
+            del self.cache[next(iter(self.cache))]  # oldest entry
+        self.cache[key] = [response.opt.etag, response.payload, response.opt.content_format,
+                           time.monotonic() + (response.opt.max_age or 0)]
+
+    def clear_cache(self):
+        self.cache.clear()
+
+    # --- Observe (push telemetry, e.g. /telemetry/ahrs) ---
+    async def _observe_async(self, path, callback, rate_ms):
+        uri = f"coap://{self.robot_ip}/{path.lstrip('/')}"
+        if rate_ms:
+            uri += f"?rate_ms={int(rate_ms)}"
+        message = Message(code=Code.GET, uri=uri, observe=0)
+        message.opt.accept = self.content_format
+        request = self.context.request(message)
+        try:
+            first = await request.response
+            callback(path, _decode_payload(first.payload, first.opt.content_format))
+            async for notification in request.observation:
+                callback(path, _decode_payload(notification.payload, notification.opt.content_format))
+        except asyncio.CancelledError:
+            request.observation.cancel()
+        except Exception as e:
+            print(f"[CoAP] Observe {path} ended: {e}")
+
+    def observe(self, path, callback, rate_ms=None):
         """
-        Sends a CoAP POST request and waits for the response.
+        Observe a robot resource. callback(path, data) runs on the CoAP loop
+        thread for the current state and every notification.
+        Returns a concurrent Future, cancel() it to stop observing.
+        """
+        return asyncio.run_coroutine_threadsafe(self._observe_async(path, callback, rate_ms), self.loop)
+
+    def send_rpc(self, path, payload, timeout=5, method=Code.POST):
+        """
+        Sends a CoAP request (POST by default) and waits for the response.
         Returns: (status_code, reason, json_data)
         """
         future = asyncio.run_coroutine_threadsafe(
-            self._send_request_async(path, payload),
+            self._send_request_async(path, payload, method),
             self.loop
         )
 
         try:
-            code, resp_payload = future.result(timeout=timeout)
+            code, resp_data = future.result(timeout=timeout)
             if code is None:
                 return 500, "Internal Error", None
 
-            # Parse response
-            resp_data = {}
-            if resp_payload:
-                try:
-                    resp_data = json.loads(resp_payload.decode('utf-8'))
-                except:
-                    resp_data = resp_payload.decode('utf-8')
-
             # Map CoAP codes to HTTP-like status for compatibility
             if hasattr(code, 'class_') and hasattr(code, 'detail'):
                 status_int = code.class_ * 100 + code.detail
@@ -148,6 +316,18 @@ class CoapInterface:
             return 500, str(e), None
 
 
+def _decode_payload(payload, cf=None):
+    """Response payload by its Content-Format (CBOR or JSON), raw text as fallback."""
+    if not payload:
+        return {}
+    try:
+        if cf is not None and int(cf) == CF_CBOR:
+            return cbor_codec.loads(payload)
+        return json.loads(payload.decode('utf-8'))
+    except ValueError:
+        return payload.decode('utf-8', errors='replace')
+
+
 # --- Global Instance (Lazy Load) ---
 _interface = None
 
@@ -161,9 +341,50 @@ def get_interface():
 def set_log_callback(callback):
     get_interface().set_log_callback(callback)
 
+def set_content_format(cf):
+    """CF_JSON (default) or CF_CBOR for all requests and responses."""
+    get_interface().set_content_format(cf)
+
+def subscribe_stream(topics, callback):
+    """Continuous UDP stream of robot bus topics, see CoapInterface.subscribe_stream()."""
+    return get_interface().subscribe_stream(topics, callback)
+
+def observe(path, callback, rate_ms=None):
+    """Push telemetry via CoAP Observe, see CoapInterface.observe()."""
+    return get_interface().observe(path, callback, rate_ms)
+
+def unsubscribe_stream(callback=None):
+    return get_interface().unsubscribe_stream(callback)
+
+# --- Jobs (utils/jobs.py): long operations without a blocking request ---
+
+def start_job(topic, payload=None, reply_topic=None, reply_timeout=120, priority=PRIORITY_NORMAL):
+    """Start e.g. a 'us_scan' on the robot. Returns (status_code, reason, job), job['id'] for the rest."""
+    return get_interface().send_rpc('/app/jobs', {'topic': topic, 'payload': payload,
+                                                  'reply_topic': reply_topic,
+                                                  'reply_timeout': reply_timeout,
+                                                  'priority': priority})
+
+def get_from_robot(path, timeout=5):
+    """GET a robot resource, served from the ETag cache while unchanged."""
+    return get_interface().send_rpc(path, None, timeout=timeout, method=Code.GET)
+
+def job_status(job_id=None):
+    """One job with its partial results and result, or the list of all jobs."""
+    path = '/app/jobs' if job_id is None else f'/app/jobs?id={int(job_id)}'
+    return get_interface().send_rpc(path, None, method=Code.GET)
+
+def cancel_job(job_id):
+    return get_interface().send_rpc(f'/app/jobs?id={int(job_id)}', None, method=Code.DELETE)
+
+def observe_jobs(callback):
+    """callback(path, [job summary, ...]) on every job change, see CoapInterface.observe()."""
+    return get_interface().observe('/app/jobs', callback)
+
 # --- Drop-in Replacements (Updated to use get_interface) ---
 
-def post_to_messagebus(topic, payload, reply_topic=None, reply_timeout=2, wait_timeout=2):
+def post_to_messagebus(topic, payload, reply_topic=None, reply_timeout=2, wait_timeout=2,
+                       priority=PRIORITY_NORMAL):
     # In CoAP, 'topic' becomes the resource path (e.g., 'messagebus' or specific task)
     # We ignore reply_topic as CoAP is Request/Response
     timeout = max(reply_timeout, wait_timeout)
@@ -180,12 +401,31 @@ def post_to_messagebus(topic, payload, reply_topic=None, reply_timeout=2, wait_t
         "payload": payload
     }
     wrapped_payload["reply_timeout"] = reply_timeout
+    if priority != PRIORITY_NORMAL:
+        wrapped_payload["priority"] = priority
     # Or if the robot CoAP server exposes resources directly:
     # return get_interface().send_rpc(topic, payload, timeout=timeout)
 
     # Assuming we send to a generic messagebus resource:
     return get_interface().send_rpc("/app/messagebus", wrapped_payload, timeout=timeout)
 
+def post_to_task(name, payload=None, timeout=None, priority=PRIORITY_NORMAL, reply=True):
+    """
+    Command a robot task directly (utils/task_resources.py), e.g.
+    post_to_task('servo', {'set_angle': 90}). Returns (status_code, reason, reply message).
+    timeout: reply timeout in s (None: the robot's default for the task).
+    """
+    query = []
+    if timeout is not None:
+        query.append(f"timeout={timeout}")
+    if priority != PRIORITY_NORMAL:
+        query.append(f"priority={priority}")
+    if not reply:
+        query.append("noreply")
+    path = f"/task/{name}" + ("?" + "&".join(query) if query else "")
+    wait = timeout if timeout is not None else TASK_MAX_TIMEOUT_S
+    return get_interface().send_rpc(path, payload or {}, timeout=wait + 1)
+
 def post_to_robot(path, payload=None, reply_topic=None, reply_timeout=2, wait_timeout=2):
     cmd = path.strip("/")
     timeout = max(reply_timeout, wait_timeout)
@@ -1,6 +1,7 @@
 from machine import SoftI2C
 from sys import maxsize
 import time
+import asyncio
 import ustruct
 import utils.t_logger as t_logger
 log = t_logger.get_logger()
@@ -103,14 +104,28 @@ class MMC5983:
         else:
             return None
 
-    def calibrate(self, calib_time=20):
+    async def calibrate(self, calib_time=20, progress=None):
+        """
+        Min/max of calib_time seconds of rotating the robot, the other tasks
+        run meanwhile. progress(fraction) is called about once a second, a
+        False return cancels (no calibration saved).
+        """
         start_time = time.ticks_ms()
+        next_report = 1000
         min_x, max_x = maxsize, -maxsize
         min_y, max_y = maxsize, -maxsize
         min_z, max_z = maxsize, -maxsize
         x, y, z = 0, 0, 0
 
-        while time.ticks_diff(time.ticks_ms(), start_time) < calib_time * 1000: # 20 seconds
+        while True:
+            elapsed = time.ticks_diff(time.ticks_ms(), start_time)
+            if elapsed >= calib_time * 1000:
+                break
+            if progress is not None and elapsed >= next_report:
+                next_report += 1000
+                if progress(elapsed / (calib_time * 1000)) is False:
+                    log.warning("Calibration cancelled")
+                    return False
             data = self.read_mag_xyz_raw()
             if data:
                 x, y, z = data
@@ -122,7 +137,7 @@ class MMC5983:
                 min_z = min(min_z, z)
                 max_z = max(max_z, z)
                 # print(f"Sampling... X[{min_x:.1f}:{max_x:.1f}] Y[{min_y:.1f}:{max_y:.1f}] Z[{min_z:.1f}:{max_z:.1f}]")
-            time.sleep(0.05)
+            await asyncio.sleep_ms(50)
 
         # Calculate Offsets (Midpoint)
         # Avoid division by zero if sensor didn't move or wasn't read
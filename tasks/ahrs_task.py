@@ -9,6 +9,7 @@ from devices.imu import qmi8658
 from utils.messagebus import Subscriber, Publisher, QueueEmpty
 from devices.magnetometer.mmc5983 import MMC5983
 from tasks.display_task import PRINT
+from utils.jobs import report_progress, is_cancelled
 
 
 # [1,0,0] = A * [a,b,c]
@@ -204,19 +205,22 @@ async def ahrs_task(i2c_obj):
     gyro_bias = await _calibrate_gyro(imu)
     if False:
         await asyncio.sleep(2)
-        mag.calibrate()
+        await mag.calibrate()
         input('Continue')
     # Get initial orientation from accelerometer. The driver now handles axis remapping.
     accel_reading = await _read_sensor_with_retry(imu.read_accel_xyz)
     rot_matrix = build_rotation(normalize(accel_reading), [0,0,-1])
-    sbr_ahrs = Subscriber('ahrs_task', topics='ahrs_task')
+    # priority lanes: a 'stop' sent as PRIORITY_URGENT skips queued commands
+    sbr_ahrs = Subscriber('ahrs_task', topics='ahrs_task', lanes=3)
     plsh = Publisher('ahrs_task')
     timeout = None
     last_command = None
+    request = None  # command to answer with the next report
     while True:
         try:
             topic, src, message = await sbr_ahrs.get(timeout=timeout)
             if message and message.get('command', None):
+                request = message
                 if message['command'] == 'single':
                     timeout = None
                     last_command = 'single'
@@ -244,14 +248,24 @@ async def ahrs_task(i2c_obj):
             # print sensor values for debugging
             # print(f"ACCEL: {accel_reading[0]:.2f}, {accel_reading[1]:.2f}, {accel_reading[2]:.2f} | MAG: {mag_reading[0]:.2f}, {mag_reading[1]:.2f}, {mag_reading[2]:.2f}")
             # print("MAG: Failed to get reading")
-            plsh.publish('ahrs_report', {
+            plsh.reply(request, 'ahrs_report', {
                 'time_tick_ms': time.ticks_ms(),
                 'accel_xyz': accel_xyz,
                 'gyro_xyz': gyro_xyz,
                 'heading': heading,
                 'temperature': temperature})
+            request = None  # continuous reports after the first are not replies
         elif last_command == 'calibrate':
-            plsh.publish('ahrs_report', {'ack': 'ACK' if mag.calibrate(calib_time=20) else 'NACK'})
+            # started as a job (utils/jobs.py): progress once a second, stop when cancelled
+            def progress(fraction, request=request):
+                report_progress(plsh, request, fraction)
+                return not is_cancelled(request)
+            done = await mag.calibrate(calib_time=20, progress=progress)
+            if is_cancelled(request):
+                timeout = None  # a cancelled job does not calibrate again
+                last_command = 'stop'
+            plsh.reply(request, 'ahrs_report', {'ack': 'ACK' if done else 'NACK'})
+            request = None
 
 
 if __name__ == "__main__":
@@ -263,8 +277,7 @@ if __name__ == "__main__":
         await asyncio.sleep(5)
         plsh = Publisher('ahrs_test')
         for angle in range(50):
-            plsh.publish(topic='ahrs_task', message={'command': 'single'})
-            response = await Subscriber('ahrs_test', topics='ahrs_report').get()
+            response = await plsh.request('ahrs_task', {'command': 'single'})
             print(response)
             await asyncio.sleep(0.2)
 
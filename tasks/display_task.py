@@ -88,54 +88,64 @@ def display_task(i2c_obj, width=128, height=64):
     PRINT('Display up')
     window = [0, 0, width, height, width, height]
     while True:
-        topic, src, message = await subscription.get()
-        log.debug(message)
-        if 'set_window' in message:
-            if message['set_window'] == 'reset':
-                window = [0, 0, width, height]
-            else:
-                window[0] = max(message['set_window'].get('x', 0), 0)
-                window[1] = max(message['set_window'].get('y', 0), 0)
-                window[2] = message['set_window'].get('w', width)
-                window[3] = message['set_window'].get('h', height)
-                window[4] = min(window[0] + window[2], width)
-                window[5] = min(window[1] + window[3], height)
-
-        if 'clear_rect' in message:
-            display.fill_rect(message['clear_rect']['x'], message['clear_rect']['y'],
-                              message['clear_rect']['w'], message['clear_rect']['h'], 0)
-        elif 'print_at_xy' in message:
-            if not (0<=message['print_at_xy']['x']<window[2] and
-                    0<=message['print_at_xy']['y']<window[3]):
-                publisher.publish('display_report', {'ack': 'NACK'})
-                continue
-            text = message['print_at_xy']['text']
-            warp = message['print_at_xy']['warp']
-            indent = message['print_at_xy']['x']
-            x0 , y0, x1, y1 = window_to_screen(window, message['print_at_xy']['x'], message['print_at_xy']['y'])
-            while text:
-                chr_per_line = (x1 - x0) // 8
-                if chr_per_line < 1 or (y1 - y0) < 8:
-                    break
-                display.text(text[:chr_per_line], x0, y0)
-                if warp:
-                    text = text[chr_per_line:]
-                    x0 += indent
-                    y0 += 8
+        # drain the whole burst, one display refresh per batch
+        batch = await subscription.get_many(8)
+        acks = []  # (request, ack), replied once the batch is on the display
+        for topic, src, message in batch:
+            log.debug(message)
+            if 'set_window' in message:
+                if message['set_window'] == 'reset':
+                    window = [0, 0, width, height]
                 else:
-                    break
-        elif 'draw_line' in message:
-            display.line(message['draw_line']['x1'], message['draw_line']['y1'],
-                         message['draw_line']['x2'], message['draw_line']['y2'], 1)
-        elif 'draw_ellipse' in message:
-            display.ellipse(
-                message['draw_ellipse']['x0'], message['draw_ellipse']['y0'],
-                message['draw_ellipse']['major'], message['draw_ellipse']['minor'], True,
-                message['draw_ellipse']['fill'])
-        elif 'print' in message:
-            ...
-        display.show()
-        publisher.publish('display_report', {'ack': 'ACK'})
+                    window[0] = max(message['set_window'].get('x', 0), 0)
+                    window[1] = max(message['set_window'].get('y', 0), 0)
+                    window[2] = message['set_window'].get('w', width)
+                    window[3] = message['set_window'].get('h', height)
+                    window[4] = min(window[0] + window[2], width)
+                    window[5] = min(window[1] + window[3], height)
+
+            if 'clear_rect' in message:
+                display.fill_rect(message['clear_rect']['x'], message['clear_rect']['y'],
+                                  message['clear_rect']['w'], message['clear_rect']['h'], 0)
+            elif 'print_at_xy' in message:
+                if not (0<=message['print_at_xy']['x']<window[2] and
+                        0<=message['print_at_xy']['y']<window[3]):
+                    acks.append((message, 'NACK'))
+                    continue
+                text = message['print_at_xy']['text']
+                warp = message['print_at_xy']['warp']
+                indent = message['print_at_xy']['x']
+                x0 , y0, x1, y1 = window_to_screen(window, message['print_at_xy']['x'], message['print_at_xy']['y'])
+                while text:
+                    chr_per_line = (x1 - x0) // 8
+                    if chr_per_line < 1 or (y1 - y0) < 8:
+                        break
+                    display.text(text[:chr_per_line], x0, y0)
+                    if warp:
+                        text = text[chr_per_line:]
+                        x0 += indent
+                        y0 += 8
+                    else:
+                        break
+            elif 'draw_line' in message:
+                display.line(message['draw_line']['x1'], message['draw_line']['y1'],
+                             message['draw_line']['x2'], message['draw_line']['y2'], 1)
+            elif 'draw_ellipse' in message:
+                display.ellipse(
+                    message['draw_ellipse']['x0'], message['draw_ellipse']['y0'],
+                    message['draw_ellipse']['major'], message['draw_ellipse']['minor'], True,
+                    message['draw_ellipse']['fill'])
+            elif 'print' in message:
+                ...
+            acks.append((message, 'ACK'))
+        try:
+            display.show()
+            shown = True
+        except OSError as e:
+            log.error(f'[Display] show failed: {e}')
+            shown = False
+        for message, ack in acks:
+            publisher.reply(message, 'display_report', {'ack': ack if shown else 'NACK'})
 
 
 if __name__ == "__main__":
@@ -147,14 +157,10 @@ if __name__ == "__main__":
         await asyncio.sleep(1)
         await asyncio.sleep(1)
         publisher = Publisher('display_test')
-        publisher.publish(topic='display_task', message={'clear_rect': {'x': 0, 'y': 0, 'w': 128, 'h': 64}})
-        print(await Subscriber('display_test', topics='display_report').get())
-        publisher.publish(topic='display_task', message={'print_at_xy': {'x': 0, 'y': 0, 'text': 'Hello World!', 'warp': True, 'indent': 0}})
-        print(await Subscriber('display_test', topics='display_report').get())
-        publisher.publish(topic='display_task', message={'draw_line': {'x1': 8, 'y1': 8, 'x2': 128, 'y2': 64}})
-        print(await Subscriber('display_test', topics='display_report').get())
-        publisher.publish(topic='display_task', message={'draw_ellipse': {'x0': 30, 'y0': 30, 'major': 7, 'minor': 13, 'fill': True}})
-        print(await Subscriber('display_test', topics='display_report').get())
+        print(await publisher.request('display_task', {'clear_rect': {'x': 0, 'y': 0, 'w': 128, 'h': 64}}))
+        print(await publisher.request('display_task', {'print_at_xy': {'x': 0, 'y': 0, 'text': 'Hello World!', 'warp': True, 'indent': 0}}))
+        print(await publisher.request('display_task', {'draw_line': {'x1': 8, 'y1': 8, 'x2': 128, 'y2': 64}}))
+        print(await publisher.request('display_task', {'draw_ellipse': {'x0': 30, 'y0': 30, 'major': 7, 'minor': 13, 'fill': True}}))
 
 
 
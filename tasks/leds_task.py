@@ -54,16 +54,19 @@ async def led_task():
     plsh = Publisher('leds_task')
     PRINT('LEDS task')
     while True:
-        topic, src, message = await sbr_led.get()
-        for rec in message['led_list']:
-            color = rec.get('color', (0,0,0))
-            if isinstance(color, str):
-                color = RGB_COLORS.get(color, (0,0,0))
-            elif  isinstance(color, int):
-                color = (color & 0xFF0000) >> 16, (color & 0xFF00) >> 8, (color & 0xFF)
-            leds[int(rec['led_id'])] = color
+        # apply the whole burst, one LED strip write per batch
+        batch = await sbr_led.get_many(8)
+        for topic, src, message in batch:
+            for rec in message['led_list']:
+                color = rec.get('color', (0,0,0))
+                if isinstance(color, str):
+                    color = RGB_COLORS.get(color, (0,0,0))
+                elif  isinstance(color, int):
+                    color = (color & 0xFF0000) >> 16, (color & 0xFF00) >> 8, (color & 0xFF)
+                leds[int(rec['led_id'])] = color
         leds.write()
-        plsh.publish('leds_report', {'ack': 'ACK'})
+        for topic, src, message in batch:
+            plsh.reply(message, 'leds_report', {'ack': 'ACK'})
 
 
 if __name__ == "__main__":
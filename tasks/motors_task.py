@@ -1,13 +1,14 @@
 import math
 import asyncio
 from machine import Pin, I2C
-from utime import sleep_ms, ticks_ms
+from utime import ticks_ms
 
 from boards.matrixbit_on3 import MBIT_PIN_MAP
 from mbit_ext.superbit_extension_board import Motor, Pca9685
-from utils.messagebus import Subscriber, Publisher
+from utils.messagebus import Subscriber, Publisher, QueueEmpty
 from tasks.display_task import PRINT
 from utils.calibration import calibration
+from utils.jobs import report_progress, is_cancelled
 import utils.t_logger as t_logger
 log = t_logger.get_logger()
 
@@ -15,7 +16,14 @@ log = t_logger.get_logger()
 WHEEL_BASE = (115 + 75) /2  # mm
 WHEEL_DIAMETER = 37  # mm
 
-def calibrate_motor(calib_motor, break_motor):
+PWM_STEPS = (10, 20, 30, 40, 50, 60, 70, 80, 90, 95)
+
+async def calibrate_motor(calib_motor, break_motor, progress=None):
+    """
+    Measure Vss and tau of calib_motor at each of PWM_STEPS (about 20 s), the
+    other tasks run meanwhile. progress(fraction) is called after each step,
+    a False return cancels: nothing is saved. True when done.
+    """
     from tasks.ahrs_task import IMU, MAG
     buf = []
     gyro_bias = [0, 0, 0]
@@ -27,30 +35,33 @@ def calibrate_motor(calib_motor, break_motor):
         gyro_bias[0] += gyro[0]/n
         gyro_bias[1] += gyro[1]/n
         gyro_bias[2] += gyro[2]/n
-        sleep_ms(20)
+        await asyncio.sleep_ms(20)
     # print(gyro_bias)
     _calib = []
-    for pwm in (10, 20, 30, 40, 50, 60, 70,80, 90, 95):
-        ret = _estimate_vss_and_tau(calib_motor, break_motor, buf, gyro_bias, _calib, pwm)
+    for i, pwm in enumerate(PWM_STEPS):
+        ret = await _estimate_vss_and_tau(calib_motor, break_motor, buf, gyro_bias, _calib, pwm)
         _calib.append(ret)
         log.debug(ret['pwm'], ret['Vss'], ret['tau'])
+        if progress is not None and progress((i + 1) / len(PWM_STEPS)) is False:
+            return False
     calib[f'M{calib_motor.motor_id}'] = _calib
     # print(calib)
     calibration.set('motors', calib)
     calibration.save_calibration()
+    return True
 
-def _estimate_vss_and_tau(calib_motor, break_motor, buf, gyro_bias, _calib, pwm):
+async def _estimate_vss_and_tau(calib_motor, break_motor, buf, gyro_bias, _calib, pwm):
     # tau about 0.21, pwm_0(stall) > 5 , pwm_1 < 95(saturated)
     from tasks.ahrs_task import IMU, MAG
     buf = []
     t0 = ticks_ms()
-    sleep_ms(100)
+    await asyncio.sleep_ms(100)
     break_motor.set_throttle(0)
     calib_motor.set_throttle(pwm / 100)
     t = ticks_ms() - t0
     buf.append((t, IMU.read_gyro_xyz()))
     while t < 1_500 :
-        sleep_ms(100)
+        await asyncio.sleep_ms(100)
         t = ticks_ms() - t0
         buf.append((t, IMU.read_gyro_xyz()))
     break_motor.set_throttle(0)
@@ -90,6 +101,11 @@ async def motors_task(pwm_controller, motor0_id, motor1_id, revers_motor1):
         topic: 'motors_report'
         message: {'ack': 'ACK'|'NACK',
                   }
+    Only the latest pending drive command is executed, older ones that were
+    not read yet are overwritten. Requests (reply expected, e.g. calibrate)
+    and urgent commands are never overwritten, urgent ones (a stop) are read
+    before anything else. A command received during a timed run
+    ('time_ms') ends the run and is executed at once.
 
     Args:
         pwm_controller (Pca9685): Pca9685 object to use for communication.
@@ -106,17 +122,33 @@ async def motors_task(pwm_controller, motor0_id, motor1_id, revers_motor1):
     motor_0 = Motor(motor_id=motor0_id, pwm_controller=pwm_controller)
     motor_1 = Motor(motor_id=motor1_id, pwm_controller=pwm_controller, revers=revers_motor1)
 
-    sbr_us = Subscriber('motors_task', topics='motors_task')
+    # drive commands are only useful at their newest value (joystick stream),
+    # requests and prioritised stops are queued in full (see ConflatingQueue)
+    sbr_us = Subscriber('motors_task', topics='motors_task', conflate=True)
     plsh = Publisher('motors_task')
     log.info('start motors_task')
+    message = None
     while True:
-        topic, src, message = await sbr_us.get()
+        if message is None:
+            topic, src, message = await sbr_us.get()
         if 'calibrate' in message:
+            pairs = []
             if message['calibrate'] == 'motor0' or message['calibrate'] == 'both':
-                calibrate_motor(motor_0, motor_1)
+                pairs.append((motor_0, motor_1))
             if message['calibrate'] == 'motor1' or message['calibrate'] == 'both':
-                calibrate_motor(motor_1, motor_0)
-            plsh.publish('motors_report', {'ack': 'ACK', 'calibrate': calibration.data})
+                pairs.append((motor_1, motor_0))
+            done = True
+            for i, (calib_motor, break_motor) in enumerate(pairs):
+                # started as a job (utils/jobs.py): progress per step, stop when cancelled
+                def progress(fraction, i=i):
+                    report_progress(plsh, message, (i + fraction) / len(pairs))
+                    return not is_cancelled(message)
+                done = await calibrate_motor(calib_motor, break_motor, progress)
+                if not done:
+                    break
+            plsh.reply(message, 'motors_report', {'ack': 'ACK' if done else 'NACK',
+                                                  'calibrate': calibration.data})
+            message = None
             continue
         m0_pwr = message.get('motor0_power', 0)
         m1_pwr = message.get('motor1_power', 0)
@@ -124,11 +156,17 @@ async def motors_task(pwm_controller, motor0_id, motor1_id, revers_motor1):
         t_ms = message.get('time_ms', None)
         motor_0.set_throttle(m0_pwr / 100)
         motor_1.set_throttle(m1_pwr / 100)
+        next_message = None
         if t_ms:
-            await asyncio.sleep_ms(t_ms)
-            motor_0.set_throttle(0)
-            motor_1.set_throttle(0)
-        plsh.publish('motors_report', {'ack': 'ACK'})
+            # keep listening while driving, a new command (e.g. a stop)
+            # preempts the timed run instead of waiting for it to end
+            try:
+                topic, src, next_message = await sbr_us.get(timeout=t_ms / 1000)
+            except QueueEmpty:
+                motor_0.set_throttle(0)
+                motor_1.set_throttle(0)
+        plsh.reply(message, 'motors_report', {'ack': 'ACK'})
+        message = next_message
 
 
 if __name__ == "__main__":
@@ -141,8 +179,7 @@ if __name__ == "__main__":
         await asyncio.sleep(1)
         plsh = Publisher('motors_test')
         for angle in range(0, 1):
-            plsh.publish(topic='motors_task', message={'motor0_power': 50, 'motor1_power': -50, 'time_ms':1000})
-            response = await Subscriber('motors_report', topics='servo_report').get()
+            response = await plsh.request('motors_task', {'motor0_power': 50, 'motor1_power': -50, 'time_ms': 1000})
             print(response)
             await asyncio.sleep(1)
 
@@ -43,7 +43,7 @@ async def servo_task(pwm_controller, servo_id):
         topic, src, message = await sbr_us.get()
         if isinstance(message.get('set_angle', None), (int, float)):
             servo.set_angle(message['set_angle'])
-            plsh.publish('servo_report', {'ack': 'ACK'})
+            plsh.reply(message, 'servo_report', {'ack': 'ACK'})
 
 
 if __name__ == "__main__":
@@ -56,8 +56,7 @@ if __name__ == "__main__":
         await asyncio.sleep(1)
         plsh = Publisher('servo_test')
         for angle in range(0, 181, 5):
-            plsh.publish(topic='servo_task', message={'set_angle': angle})
-            response = await Subscriber('servo_test', topics='servo_report').get()
+            response = await plsh.request('servo_task', {'set_angle': angle})
             print(response)
             await asyncio.sleep(0.2)
 
@@ -1,6 +1,7 @@
 import asyncio
 
 from utils.messagebus import Publisher, Subscriber
+from utils.jobs import report_progress, is_cancelled
 from tasks.display_task import PRINT
 
 
@@ -14,26 +15,32 @@ async def us_scan(start_angle, stop_angle, step):
     PRINT('US scan')
     publisher = Publisher('us_scan_task')
     us_scan_sub = Subscriber('us_scan', topics='us_scan')
-    servo_sub = Subscriber('servo_test', topics='servo_report')
-    us_sub = Subscriber('us_report', topics='us_report')
     while True:
         src, tpc, msg = await us_scan_sub.get()
         ret = []
         _step = msg['step'] if 'step' in msg else step
         _stop_angle = msg['stop_angle'] if 'stop_angle' in msg else stop_angle
-        angle = msg['start_angle'] if 'start_angle' in msg else start_angle
+        angle = _start_angle = msg['start_angle'] if 'start_angle' in msg else start_angle
+        cancelled = False
         while angle <= _stop_angle:
+            # started as a job (utils/jobs.py): stop when cancelled, report each point
+            if is_cancelled(msg):
+                cancelled = True
+                break
             try:
-                publisher.publish(topic='servo_task', message={'set_angle': angle})
-                response = await servo_sub.get()
+                await publisher.request('servo_task', {'set_angle': angle},
+                                        timeout=3, reply_topic='servo_report')
                 await asyncio.sleep(1)
-                publisher.publish(topic='us_task', message={'measure': 'DO'})
-                _, _, response = await us_sub.get(timeout=3)
-                ret.append({'angle': angle, 'distance': response['distance']})
+                _, _, response = await publisher.request('us_task', {'measure': 'DO'},
+                                                         timeout=3, reply_topic='us_report')
+                point = {'angle': angle, 'distance': response['distance']}
+                ret.append(point)
+                report_progress(publisher, msg,
+                                (angle - _start_angle + 1) / (_stop_angle - _start_angle + 1), point)
             except Exception as e:
                 print(e)
             angle += _step
-        publisher.publish('us_scan_report', {'scan_distances': ret})
+        publisher.reply(msg, 'us_scan_report', {'scan_distances': ret, 'cancelled': cancelled})
 
 
 if __name__ == '__main__':
@@ -51,8 +58,7 @@ if __name__ == '__main__':
         asyncio.create_task(us_task())
         asyncio.create_task(us_scan(0, 180, 5))
         await asyncio.sleep(1)
-        Publisher('test_scan').publish(topic='us_scan',message={})
-        print(await Subscriber('xxx', 'us_scan_report').get())
+        print(await Publisher('test_scan').request('us_scan', {}, timeout=30))
 #         print(await us_scan(0, 180, 5))
 
     asyncio.run(test())
@@ -46,7 +46,7 @@ async def us_task():
         topic, src, message = await sbr_us.get()
         if message.get('measure', 'DONT') == 'DO':
             distance = ultrasonic.distance_cm()
-            plsh.publish('us_report', {'distance': distance})
+            plsh.reply(message, 'us_report', {'distance': distance})
 
 
 if __name__ == "__main__":
@@ -55,8 +55,7 @@ if __name__ == "__main__":
         await asyncio.sleep(1)
 
         plsh = Publisher('us_test')
-        plsh.publish(topic='us_task', message={'measure': 'DO'})
-        response = await Subscriber('us_report', topics='us_response').get()
+        response = await plsh.request('us_task', {'measure': 'DO'})
         print(response)
 
     asyncio.run(test())
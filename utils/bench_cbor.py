@@ -0,0 +1,51 @@
+# CBOR vs JSON micro-benchmark, run on the robot:
+#   import utils.bench_cbor
+# Encodes and decodes typical payloads (an ahrs_report and a us_scan result)
+# with ujson and utils.cbor, and prints payload bytes, time and heap bytes
+# allocated per operation.
+import gc
+import time
+import ujson
+from utils import cbor
+
+N_ROUNDS = 500
+
+AHRS_REPORT = {'time_tick_ms': 123456789, 'accel_xyz': [0.012, -0.034, 0.981],
+               'gyro_xyz': [0.5, -1.25, 0.0], 'heading': 271.4, 'temperature': 31.5}
+US_SCAN = {'scan': [[angle, 100 + angle % 57] for angle in range(0, 180, 5)]}
+
+
+def _time(fn, arg):
+    """(us per call, heap bytes per call) of fn(arg)."""
+    gc.collect()
+    gc.disable()
+    mem0 = gc.mem_alloc()
+    t0 = time.ticks_us()
+    for _ in range(N_ROUNDS):
+        fn(arg)
+    dt = time.ticks_diff(time.ticks_us(), t0)
+    mem = gc.mem_alloc() - mem0
+    gc.enable()
+    return dt / N_ROUNDS, mem / N_ROUNDS
+
+
+def _encode_into(obj, buf=bytearray(256)):
+    buf[:] = b''  # one buffer reused across calls
+    cbor.encode_into(buf, obj)
+
+
+def _run(name, obj):
+    json_bytes = ujson.dumps(obj).encode()
+    cbor_bytes = cbor.dumps(obj)
+    print(f"{name}: json {len(json_bytes)} bytes, cbor {len(cbor_bytes)} bytes")
+    for label, fn, arg in (('json dumps', ujson.dumps, obj),
+                           ('cbor dumps', cbor.dumps, obj),
+                           ('cbor encode_into', _encode_into, obj),
+                           ('json loads', ujson.loads, json_bytes),
+                           ('cbor loads', cbor.loads, memoryview(cbor_bytes))):
+        us, mem = _time(fn, arg)
+        print(f"  {label:>16}: {us:.1f} us, {mem:.1f} bytes")
+
+
+_run('ahrs_report', AHRS_REPORT)
+_run('us_scan', US_SCAN)
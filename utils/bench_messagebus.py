@@ -0,0 +1,106 @@
+# Message bus micro-benchmark, run on the robot:
+#   import utils.bench_messagebus
+# Measures publish -> get throughput and heap bytes allocated per message
+# for the ring buffer Queue against the previous list based Queue, and the
+# latency of a stop command queued behind a backlog with/without priority lanes.
+import gc
+import time
+import uasyncio as asyncio
+from utils.messagebus import (Subscriber, Publisher, Queue, MessageBus,
+                              OVERFLOW_DROP_OLDEST, PRIORITY_URGENT)
+
+N_MESSAGES = 2000
+BURST = 8
+
+
+class _ListQueue:
+    """The previous list based Queue, kept here only as the baseline."""
+    def __init__(self, maxsize=0):
+        self.maxsize = maxsize
+        self._items = []
+        self._get_waiters = []
+
+    def empty(self):
+        return len(self._items) == 0
+
+    def put_nowait(self, item, priority=0):
+        self._items.append(item)
+        if self._get_waiters:
+            self._get_waiters.pop(0).set()
+
+    async def get(self, timeout=None):
+        while self.empty():
+            event = asyncio.Event()
+            self._get_waiters.append(event)
+            await event.wait()
+        return self._items.pop(0)
+
+
+async def _run(name, queue):
+    sub = Subscriber('bench', topics='bench', queue=queue)
+    pub = Publisher('bench')
+    message = {'value': 1}
+    gc.collect()
+    gc.disable()
+    mem0 = gc.mem_alloc()
+    t0 = time.ticks_us()
+    for _ in range(N_MESSAGES // BURST):
+        for _ in range(BURST):
+            pub.publish('bench', message)
+        for _ in range(BURST):
+            await sub.get()
+    dt = time.ticks_diff(time.ticks_us(), t0)
+    mem = gc.mem_alloc() - mem0
+    gc.enable()
+    sub.close()
+    print(f"{name:>6}: {N_MESSAGES * 1_000_000 // dt} msg/s, "
+          f"{dt / N_MESSAGES:.1f} us/msg, {mem / N_MESSAGES:.1f} bytes/msg")
+
+
+def _publish_allocations():
+    """gc.mem_alloc() delta per publish from the bus instrumentation mode."""
+    subs = [Subscriber('bench%d' % i, topics='bench') for i in range(3)]
+    pub = Publisher('bench')
+    bus = MessageBus.instance()
+    message = {'value': 1}
+    bus.instrument()
+    for _ in range(N_MESSAGES):
+        pub.publish('bench', message)
+        for sub in subs:
+            sub.get_nowait()
+    bus.instrument(False)
+    for sub in subs:
+        sub.close()
+    stats = bus.alloc_stats
+    print(f"publish fan-out 3: {stats['bytes'] / max(stats['publishes'], 1):.1f} bytes/publish, "
+          f"max {stats['max']}, skipped {stats['skipped']}")
+
+
+async def _stop_latency(lanes, backlog=12, work_ms=5):
+    """Time from publishing a stop until a busy consumer reads it."""
+    sub = Subscriber('bench_motors', topics='bench_motors', maxsize=16, lanes=lanes)
+    pub = Publisher('bench')
+    for i in range(backlog):
+        pub.publish('bench_motors', {'motor0_power': i, 'time_ms': work_ms})
+    t0 = time.ticks_us()
+    pub.publish('bench_motors', {'motor0_power': 0, 'motor1_power': 0}, PRIORITY_URGENT)
+    while True:
+        _, _, message = await sub.get()
+        if message.get('motor0_power', 0) == 0 and 'time_ms' not in message:
+            break
+        await asyncio.sleep_ms(work_ms)  # the consumer is busy with each command
+    dt = time.ticks_diff(time.ticks_us(), t0)
+    sub.close()
+    print(f"stop latency behind {backlog} commands, lanes={lanes}: {dt / 1000:.1f} ms")
+
+
+async def main():
+    print(f"publish->get {N_MESSAGES} messages, bursts of {BURST}")
+    await _run('list', _ListQueue())
+    await _run('ring', Queue(BURST * 2, OVERFLOW_DROP_OLDEST))
+    _publish_allocations()
+    await _stop_latency(lanes=1)
+    await _stop_latency(lanes=3)
+
+
+asyncio.run(main())
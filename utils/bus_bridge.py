@@ -0,0 +1,163 @@
+# Bus bridge: stream MessageBus topics to PC tools over UDP.
+#
+# A PC registers an endpoint (its IP and a UDP port) with a list of topic
+# names or +/# patterns, e.g. POST /app/bus/stream
+#   {'topics': ['ahrs_report', 'us_report'], 'port': 5683, 'lease_s': 60}
+# Every message published on a matching topic is then sent as one JSON frame
+#   {"seq": <int>, "topic": <str>, "sender_id": <str>, "message": <obj>}
+# without any per sample request. seq counts the frames sent to that
+# endpoint, so a gap is a frame it lost. Registrations expire after lease_s unless
+# renewed, so a PC that went away stops the stream by itself.
+# Frames start with '{' so they share the log multicast port with the text
+# log lines ('[LEVEL] ...') and the PC tells them apart by the first byte.
+# The bridge reads through a conflating subscriber: when the network is
+# slower than a topic, only the latest sample of that topic is sent.
+import json
+import time
+import uasyncio as asyncio
+import usocket as socket
+import utils.t_logger as t_logger
+from utils.messagebus import Subscriber, topic_matches, QueueEmpty
+
+log = t_logger.get_logger()
+
+DEFAULT_LEASE_S = 60
+MAX_ENDPOINTS = 4
+BATCH = 8
+
+
+class _Endpoint:
+    """One registered PC: destination address, topic patterns and counters."""
+    __slots__ = ('addr', 'patterns', 'expires_ms', 'seq', 'sent', 'errors', '_match')
+
+    def __init__(self, addr, patterns, lease_s):
+        self.addr = addr
+        self.patterns = patterns
+        self.expires_ms = time.ticks_add(time.ticks_ms(), int(lease_s * 1000))
+        self.seq = 0    # frames numbered per destination
+        self.sent = 0
+        self.errors = 0
+        self._match = {}  # concrete topic -> bool, patterns are matched once per topic
+
+    def wants(self, topic):
+        ret = self._match.get(topic)
+        if ret is None:
+            ret = False
+            for pattern in self.patterns:
+                if topic_matches(pattern, topic):
+                    ret = True
+                    break
+            self._match[topic] = ret
+        return ret
+
+    def stats(self):
+        return {'addr': '%s:%d' % self.addr, 'topics': self.patterns, 'seq': self.seq, 'sent': self.sent,
+                'errors': self.errors,
+                'expires_in_ms': time.ticks_diff(self.expires_ms, time.ticks_ms())}
+
+
+class BusBridge:
+    _instance = None
+
+    @classmethod
+    def instance(cls):
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def __init__(self):
+        self.endpoints = {}  # (ip, port) -> _Endpoint
+        self.sub = Subscriber('bus_bridge', conflate=True)
+        self.sock = None
+        self.frames = 0
+
+    def _socket(self):
+        # reuse the socket t_logger opened for the multicast log
+        if self.sock is None:
+            self.sock = log.sock or socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        return self.sock
+
+    def register(self, ip, port, topics, lease_s=DEFAULT_LEASE_S):
+        """
+        Add or renew an endpoint. An empty topics list removes it, patterns
+        dropped by a renewal are unsubscribed unless another endpoint uses them.
+        Returns the endpoint stats or None when removed.
+        """
+        addr = (ip, int(port))
+        if not topics:
+            self.unregister(addr)
+            return None
+        if isinstance(topics, str):
+            topics = [topics]
+        old = self.endpoints.get(addr)
+        if old is None and len(self.endpoints) >= MAX_ENDPOINTS:
+            raise ValueError('Too many stream endpoints')
+        self.endpoints[addr] = ep = _Endpoint(addr, list(topics), lease_s)
+        if old is not None:
+            ep.seq = old.seq  # a renewal continues the numbering
+        for pattern in ep.patterns:
+            self.sub.subscribe(pattern)
+        if old is not None:
+            self._release([p for p in old.patterns if p not in ep.patterns])
+        log.info('[Bridge] %s:%d streams %s' % (addr[0], addr[1], ep.patterns))
+        return ep.stats()
+
+    def unregister(self, addr):
+        ep = self.endpoints.pop(addr, None)
+        if ep is None:
+            return
+        log.info('[Bridge] %s:%d removed' % addr)
+        self._release(ep.patterns)
+
+    def _release(self, patterns):
+        """Unsubscribe the patterns no registered endpoint uses anymore."""
+        used = set()
+        for ep in self.endpoints.values():
+            used.update(ep.patterns)
+        for pattern in patterns:
+            if pattern not in used:
+                self.sub.unsubscribe(pattern)
+
+    def _expire(self):
+        now = time.ticks_ms()
+        for addr in [a for a, ep in self.endpoints.items() if time.ticks_diff(ep.expires_ms, now) <= 0]:
+            self.unregister(addr)
+
+    def _send(self, topic, sender_id, message):
+        frame = None
+        for ep in self.endpoints.values():
+            if not ep.wants(topic):
+                continue
+            try:
+                if frame is None:
+                    # encoded once, shared by all endpoints of the topic,
+                    # each gets its own seq in front: '{"seq": n, ' + frame[1:]
+                    frame = json.dumps({'topic': topic, 'sender_id': sender_id, 'message': message})
+                ep.seq += 1
+                self._socket().sendto('{"seq": %d, %s' % (ep.seq, frame[1:]), ep.addr)
+                ep.sent += 1
+            except Exception as e:
+                ep.errors += 1
+                log.warning('[Bridge] %s:%d send error %s' % (ep.addr[0], ep.addr[1], e))
+        if frame is not None:
+            self.frames += 1
+
+    def stats(self):
+        return {'frames': self.frames, 'dropped': self.sub.dropped,
+                'endpoints': [ep.stats() for ep in self.endpoints.values()]}
+
+    async def run(self):
+        while True:
+            try:
+                batch = await self.sub.get_many(BATCH, timeout=1)
+            except QueueEmpty:
+                self._expire()
+                continue
+            for topic, sender_id, message in batch:
+                self._send(topic, sender_id, message)
+            self._expire()
+            await asyncio.sleep_ms(0)  # let the producers run between bursts
+
+
+async def bus_bridge_task():
+    await BusBridge.instance().run()
@@ -1,12 +1,16 @@
 # module to help mange calibration data
 
 import json
+import random
 
 CALIBARTION_FILE = 'calibration.json'
 
 class Calibration:
     def __init__(self, file_path=CALIBARTION_FILE):
         self.file_path = file_path
+        # change counter, the ETag of /app/calibration: the random per boot high
+        # bits keep a PC's cached version from matching other data after a reboot
+        self.version = random.getrandbits(16) << 16
         self.load_calibration()
 
     def load_calibration(self, file_name:str=None):
@@ -19,6 +23,7 @@ class Calibration:
         except (OSError, ValueError):
             # File not found or invalid JSON
             self.data = {}
+        self.version += 1
 
     def save_calibration(self, file_name:str=None):
         if file_name is None:
@@ -31,17 +36,20 @@ class Calibration:
         """Get a calibration value by key."""
         if key not in self.data:
             self.data[key] = default
+            self.version += 1
         return self.data[key]
 
     def set(self, key, value):
         """Set a calibration value."""
         self.data[key] = value
+        self.version += 1
         # self._save_calibration()
 
     def delete(self, key):
         """Delete a calibration value."""
         if key in self.data:
             del self.data[key]
+            self.version += 1
             # self._save_calibration()
             return True
         return False
@@ -0,0 +1,198 @@
+# Minimal CBOR (RFC 8949) codec for CoAP payloads (Content-Format 60).
+#
+# Covers what the robot exchanges: None, bool, int, float, str, bytes,
+# list/tuple and dict. Encoding appends to a bytearray (encode_into), so a
+# caller can reuse one buffer, or streams chunks (iter_encode) so a large
+# body is never held as a whole; decoding reads a memoryview in place, so a
+# request payload is decoded without copying it first.
+# The PC client uses this same module (coap_client/cbor_codec.py).
+# Floats are sent as float32 when that is exact (always on single precision
+# MicroPython ports), else float64.
+import struct
+
+CF_CBOR = 60
+
+
+def _head(buf, major, n):
+    major <<= 5
+    if n < 24:
+        buf.append(major | n)
+    elif n < 0x100:
+        buf.append(major | 24); buf.append(n)
+    elif n < 0x10000:
+        buf.append(major | 25); buf.extend(struct.pack('>H', n))
+    elif n < 0x100000000:
+        buf.append(major | 26); buf.extend(struct.pack('>I', n))
+    else:
+        buf.append(major | 27); buf.extend(struct.pack('>Q', n))
+
+
+def encode_into(buf, obj):
+    """Append the CBOR encoding of obj to the bytearray buf."""
+    if obj is None:
+        buf.append(0xF6)
+    elif obj is True:
+        buf.append(0xF5)
+    elif obj is False:
+        buf.append(0xF4)
+    elif isinstance(obj, int):
+        if obj >= 0: _head(buf, 0, obj)
+        else: _head(buf, 1, -1 - obj)
+    elif isinstance(obj, float):
+        try:
+            f32 = struct.pack('>f', obj)
+        except OverflowError:
+            f32 = None
+        if f32 is not None and (struct.unpack('>f', f32)[0] == obj or obj != obj):
+            buf.append(0xFA); buf.extend(f32)
+        else:
+            buf.append(0xFB); buf.extend(struct.pack('>d', obj))
+    elif isinstance(obj, str):
+        b = obj.encode('utf-8')
+        _head(buf, 3, len(b)); buf.extend(b)
+    elif isinstance(obj, (bytes, bytearray, memoryview)):
+        _head(buf, 2, len(obj)); buf.extend(obj)
+    elif isinstance(obj, (list, tuple)):
+        _head(buf, 4, len(obj))
+        for v in obj:
+            encode_into(buf, v)
+    elif isinstance(obj, dict):
+        _head(buf, 5, len(obj))
+        for k, v in obj.items():
+            encode_into(buf, k)
+            encode_into(buf, v)
+    else:
+        raise TypeError('CBOR: unsupported type %s' % type(obj))
+    return buf
+
+
+def dumps(obj):
+    return bytes(encode_into(bytearray(), obj))
+
+
+def _encode_items(buf, obj, size):
+    # like encode_into, but containers item by item: yields whenever buf holds size bytes
+    if isinstance(obj, (list, tuple)):
+        _head(buf, 4, len(obj))
+        for v in obj:
+            yield from _encode_items(buf, v, size)
+    elif isinstance(obj, dict):
+        _head(buf, 5, len(obj))
+        for k, v in obj.items():
+            encode_into(buf, k)
+            yield from _encode_items(buf, v, size)
+    else:
+        encode_into(buf, obj)
+    if len(buf) >= size:
+        yield
+
+
+def iter_encode(obj, size=256):
+    """
+    Streaming encoder: the CBOR encoding of obj as bytes chunks of about size
+    bytes, produced as they are consumed (e.g. block by block of a Block2
+    response). Only the pending chunk is held, never the whole encoding.
+    """
+    buf = bytearray()
+    for _ in _encode_items(buf, obj, size):
+        yield bytes(buf)
+        buf[:] = b''
+    if buf:
+        yield bytes(buf)
+
+
+def _half(h):
+    exp = (h >> 10) & 0x1F
+    mant = h & 0x3FF
+    if exp == 0: val = mant * 2.0 ** -24
+    elif exp == 31: val = float('inf') if mant == 0 else float('nan')
+    else: val = (mant + 1024) * 2.0 ** (exp - 25)
+    return -val if h & 0x8000 else val
+
+
+MAX_DEPTH = 32  # nesting of arrays/maps/tags accepted by loads()
+
+
+def _need(data, i, n):
+    if i + n > len(data):
+        raise ValueError('CBOR: truncated')
+
+
+def _decode(data, i, depth=0):
+    """(object, next index) of the item at data[i], ValueError for malformed input."""
+    if depth > MAX_DEPTH:
+        raise ValueError('CBOR: nested too deep')
+    _need(data, i, 1)
+    ib = data[i]
+    major = ib >> 5
+    info = ib & 0x1F
+    i += 1
+    if major == 7:
+        if info == 20: return False, i
+        if info == 21: return True, i
+        if info == 22 or info == 23: return None, i
+        if info == 25:
+            _need(data, i, 2)
+            return _half((data[i] << 8) | data[i+1]), i + 2
+        if info == 26:
+            _need(data, i, 4)
+            return struct.unpack_from('>f', data, i)[0], i + 4
+        if info == 27:
+            _need(data, i, 8)
+            return struct.unpack_from('>d', data, i)[0], i + 8
+        raise ValueError('CBOR: simple value %d' % info)
+    if info < 24:
+        n = info
+    elif info == 24:
+        _need(data, i, 1)
+        n = data[i]; i += 1
+    elif info == 25:
+        _need(data, i, 2)
+        n = (data[i] << 8) | data[i+1]; i += 2
+    elif info == 26:
+        _need(data, i, 4)
+        n = struct.unpack_from('>I', data, i)[0]; i += 4
+    elif info == 27:
+        _need(data, i, 8)
+        n = struct.unpack_from('>Q', data, i)[0]; i += 8
+    else:
+        raise ValueError('CBOR: indefinite length not supported')
+    if major == 0: return n, i
+    if major == 1: return -1 - n, i
+    if major == 2 or major == 3:
+        _need(data, i, n)
+        if major == 2: return bytes(data[i:i+n]), i + n
+        return str(data[i:i+n], 'utf-8'), i + n  # UnicodeError is a ValueError
+    if major == 4 or major == 5:
+        _need(data, i, n)  # every item takes a byte at least: no huge loop on a bad count
+    if major == 4:
+        ret = []
+        for _ in range(n):
+            v, i = _decode(data, i, depth + 1)
+            ret.append(v)
+        return ret, i
+    if major == 5:
+        ret = {}
+        for _ in range(n):
+            k, i = _decode(data, i, depth + 1)
+            v, i = _decode(data, i, depth + 1)
+            try:
+                ret[k] = v
+            except TypeError:
+                raise ValueError('CBOR: unhashable map key')
+        return ret, i
+    # major 6: tag, the tagged item is returned as is
+    return _decode(data, i, depth + 1)
+
+
+def loads(data):
+    """
+    Decode one CBOR item from bytes, bytearray or memoryview. Truncated,
+    corrupt or trailing data raises ValueError.
+    """
+    if not isinstance(data, memoryview):
+        data = memoryview(data)
+    obj, i = _decode(data, 0)
+    if i != len(data):
+        raise ValueError('CBOR: trailing bytes')
+    return obj
@@ -1,11 +1,12 @@
 import usocket as socket
-import struct
 import ujson
+import binascii
+import array
+import utils.cbor as cbor
 import uasyncio as asyncio
 import random
 import time
 import gc
-from micropython import mem_info, qstr_info
 import utils.t_logger as t_logger
 
 log = t_logger.get_logger()
@@ -20,53 +21,652 @@ CODE_TO_METHOD = {1: "GET", 2: "POST", 3: "PUT", 4: "DELETE"}
 
 # Methods
 METHOD_GET = 1; METHOD_POST = 2; METHOD_PUT = 3; METHOD_DELETE = 4
+METHOD_PATCH = 6  # RFC 8132, not idempotent like POST
 
 # Response Codes
+RESP_CREATED     = 65  # 2.01 (Resource created, e.g. a job)
+RESP_DELETED     = 66  # 2.02
+RESP_VALID       = 67  # 2.03 (the client's cached representation is current)
 RESP_CONTENT     = 69  # 2.05 (Success Data)
 RESP_CHANGED     = 68  # 2.04 (Success Action)
+RESP_CONTINUE    = 95  # 2.31 (Block1 received, send the next one)
 RESP_BAD_REQ     = 128 # 4.00
 RESP_NOT_FOUND   = 132 # 4.04
 RESP_METHOD_NOT_ALLOWED = 133 # 4.05
 RESP_ENTITY_INCOMPLETE = 136 # 4.08
+RESP_PRECONDITION_FAILED = 140 # 4.12
+RESP_ENTITY_TOO_LARGE = 141 # 4.13
+RESP_TOO_MANY_REQUESTS = 157 # 4.29 (RFC 8516, Max-Age tells when to retry)
 RESP_INTERNAL_ERR = 160 # 5.00
 RESP_SERVICE_UNAVAILABLE = 163 # 5.03
 
 # Options
-OPT_OBSERVE = 6; OPT_URI_PATH = 11; OPT_URI_QUERY = 15; OPT_BLOCK1 = 27
+OPT_ETAG = 4; OPT_IF_NONE_MATCH = 5; OPT_OBSERVE = 6; OPT_URI_PATH = 11; OPT_CONTENT_FORMAT = 12; OPT_MAX_AGE = 14; OPT_URI_QUERY = 15
+OPT_ACCEPT = 17
+OPT_BLOCK2 = 23; OPT_BLOCK1 = 27; OPT_SIZE1 = 60
+
+# Content formats
+CF_JSON = 50
+CF_CBOR = cbor.CF_CBOR  # 60, selected by the request Accept option
+
+# Pre-encoded option sequences (delta/length header + value) of the common responses
+OPTS_JSON = b'\xC1\x32'                 # Content-Format: JSON
+OPTS_AFTER_OBSERVE_JSON = b'\x61\x32'   # Content-Format: JSON following an Observe option
+OPTS_CBOR = b'\xC1\x3C'                 # Content-Format: CBOR
+OPTS_AFTER_OBSERVE_CBOR = b'\x61\x3C'   # Content-Format: CBOR following an Observe option
+# content format -> (sequence as first option, sequence after Observe)
+_CF_OPTS = {CF_JSON: (OPTS_JSON, OPTS_AFTER_OBSERVE_JSON),
+            CF_CBOR: (OPTS_CBOR, OPTS_AFTER_OBSERVE_CBOR)}
+
+# Datagrams read per wakeup before yielding to the other tasks
+RX_BURST = 8
+# Receive buffer of each pooled request (RFC 7252 suggests 1152 bytes messages)
+RX_BUF_SIZE = 1280
+TX_BUF_SIZE = 1280
+
+# Observe (RFC 7641)
+OBS_MIN_INTERVAL_MS = 50     # default notification rate limit per observer (?rate_ms= overrides)
+OBS_CON_INTERVAL_MS = 5_000  # a CON notification at least this often checks the observer is alive
+OBS_ACK_TIMEOUT_MS = 4_000   # CON notification without ACK after this is a miss
+OBS_MAX_MISSES = 2           # consecutive misses before the observer is dropped
+OBS_TICK_MS = 50
+
+# Message deduplication (RFC 7252 4.5)
+EXCHANGE_LIFETIME_MS = 247_000  # how long a msg id is remembered per client
+EXCHANGE_WINDOW_MS = 45_000     # MAX_TRANSMIT_SPAN: last retransmission of a CON after its first send
+EXCHANGE_CACHE_MAX = 128        # remembered POST/PATCH exchanges (~3 per second over the window)
+EXCHANGE_CACHE_BYTES = 8 * 1024  # all of the cache: slots, index and the arena of the stored ACKs
+
+# Admission control: token bucket per client IP, then a fair (round robin
+# across clients) bounded wait queue in front of the workers
+CLIENT_RATE = 20          # requests per second refilled per client
+CLIENT_BURST = 10         # bucket size
+CLIENT_MAX_ACTIVE = 4     # handlers running per client, its other requests wait
+CLIENT_QUEUE_MAX = 4      # waiting requests per client
+QUEUE_MAX = 8             # waiting requests overall (extra pooled requests)
+QUEUE_TIMEOUT_MS = 10_000 # waited longer -> 5.03
+CLIENT_IDLE_MS = 120_000  # admission state of a silent client is dropped
+BUSY_RETRY_S = 2          # Max-Age of a 5.03
+URGENT_MAX = 2            # urgent requests (e.g. a motor stop) running past all these limits
+
+# Outbound requests, server.request() (RFC 7252 4.8 transmission parameters)
+ACK_TIMEOUT_MS = 2_000
+ACK_RANDOM_FACTOR = 1.5
+MAX_RETRANSMIT = 4
+NSTART = 1                # outstanding requests per peer
+RESPONSE_TIMEOUT_S = 10   # overall wait for the response, incl. a separate one
+
+# Block1 (RFC 7959) uploads
+BLOCK1_MAX_BODY = 16 * 1024  # largest body reassembled in RAM (announced in Size1 of 4.13)
+BLOCK1_BUDGET = 24 * 1024    # buffers of all transfers in flight
+BLOCK1_MAX = 2               # concurrent transfers
+BLOCK1_RESERVE = 2 * 1024    # first buffer when the client sent no Size1
+BLOCK1_TIMEOUT_S = 15
+HOUSEKEEPING_MS = 1_000      # stale transfer / queue sweep period
+
+# Block2 (RFC 7959) streaming of iterator/generator responses
+BLOCK2_SZX = 6          # largest block served: 2 ** (6 + 4) = 1024 bytes
+BLOCK2_WINDOW = 2       # recent blocks kept for re-requests
+BLOCK2_MAX = 4          # concurrent transfers
+BLOCK2_TIMEOUT_S = 30   # transfer dropped when the client stops asking
+
+
+def _readable(sock):
+    """Awaitable that resumes when sock has data (uasyncio I/O poller, no polling)."""
+    yield asyncio.core._io_queue.queue_read(sock)
+
+class MessageBuilder:
+    """
+    Writes a CoAP message (header, token, delta encoded options, payload)
+    into one reused bytearray and sends a memoryview of it, so a send does
+    not allocate intermediate bytes objects. Options must be added in
+    ascending number order. The server has a single builder: a message is
+    built and sent without an await in between.
+    """
+    __slots__ = ('buf', 'view', 'n', 'last_opt')
+
+    def __init__(self, size=TX_BUF_SIZE):
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.n = 0
+        self.last_opt = 0
+
+    def _reserve(self, nbytes):
+        """Grow the buffer for an oversized message (rare, allocates)."""
+        if self.n + nbytes > len(self.buf):
+            buf = bytearray(max(self.n + nbytes, 2 * len(self.buf)))
+            buf[:self.n] = self.view[:self.n]
+            self.buf = buf
+            self.view = memoryview(buf)
+
+    def start(self, mtype, code, msg_id, token=b''):
+        buf = self.buf
+        buf[0] = (COAP_VER << 6) | (mtype << 4) | (len(token) & 0x0F)
+        buf[1] = code
+        buf[2] = (msg_id >> 8) & 0xFF
+        buf[3] = msg_id & 0xFF
+        n = 4 + len(token)
+        buf[4:n] = token
+        self.n = n
+        self.last_opt = 0
+        return self
+
+    def _opt_head(self, number, length):
+        delta = number - self.last_opt
+        self.last_opt = number
+        self._reserve(5 + length)
+        buf = self.buf
+        i = self.n + 1
+        if delta >= 269:
+            d = 14; buf[i] = (delta - 269) >> 8; buf[i+1] = (delta - 269) & 0xFF; i += 2
+        elif delta >= 13:
+            d = 13; buf[i] = delta - 13; i += 1
+        else:
+            d = delta
+        if length >= 269:
+            l = 14; buf[i] = (length - 269) >> 8; buf[i+1] = (length - 269) & 0xFF; i += 2
+        elif length >= 13:
+            l = 13; buf[i] = length - 13; i += 1
+        else:
+            l = length
+        buf[self.n] = (d << 4) | l
+        self.n = i
+
+    def option(self, number, value=b''):
+        """Opaque/string option, value is bytes-like."""
+        length = len(value)
+        self._opt_head(number, length)
+        self.buf[self.n:self.n + length] = value
+        self.n += length
+        return self
+
+    def option_uint(self, number, value):
+        """Unsigned integer option in its shortest big endian encoding (0 -> empty)."""
+        length = 0
+        v = value
+        while v:
+            length += 1
+            v >>= 8
+        self._opt_head(number, length)
+        buf = self.buf
+        for i in range(self.n + length - 1, self.n - 1, -1):
+            buf[i] = value & 0xFF
+            value >>= 8
+        self.n += length
+        return self
+
+    def raw_options(self, encoded, last_number):
+        """Append a pre-encoded option sequence ending with option last_number."""
+        length = len(encoded)
+        self._reserve(length)
+        self.buf[self.n:self.n + length] = encoded
+        self.n += length
+        self.last_opt = last_number
+        return self
+
+    def content_format(self, cf):
+        """Content-Format option (pre-encoded for JSON/CBOR), None adds nothing."""
+        if cf is None:
+            return self
+        opts = _CF_OPTS.get(cf)
+        if opts is None or self.last_opt not in (0, OPT_OBSERVE):
+            return self.option_uint(OPT_CONTENT_FORMAT, cf)
+        return self.raw_options(opts[1] if self.last_opt == OPT_OBSERVE else opts[0], OPT_CONTENT_FORMAT)
+
+    def payload(self, data):
+        if data:
+            length = len(data)
+            self._reserve(1 + length)
+            self.buf[self.n] = 0xFF
+            self.buf[self.n + 1:self.n + 1 + length] = data
+            self.n += 1 + length
+        return self
+
+    def send(self, sock, addr):
+        sock.sendto(self.view[:self.n], addr)
+
+
+def _json_chunks(obj):
+    if isinstance(obj, dict):
+        sep = '{'
+        for k, v in obj.items():
+            yield sep + ujson.dumps(k if isinstance(k, str) else str(k)) + ': '
+            yield from _json_chunks(v)
+            sep = ', '
+        yield '{}' if sep == '{' else '}'
+    elif isinstance(obj, (list, tuple)):
+        sep = '['
+        for v in obj:
+            yield sep
+            yield from _json_chunks(v)
+            sep = ', '
+        yield '[]' if sep == '[' else ']'
+    else:
+        yield ujson.dumps(obj)
+
+
+class JsonChunks:
+    """Iterator over the JSON text of an object in small str chunks (see iter_json)."""
+    __slots__ = ('obj', '_gen')
+
+    def __init__(self, obj):
+        self.obj = obj  # kept to serve CBOR instead when the client Accepts it
+        self._gen = _json_chunks(obj)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._gen)
+
+
+def iter_json(obj):
+    """
+    Serialize obj lazily for a streamed (Block2) response:
+        return RESP_CONTENT, iter_json(big_dict)
+    The body is never held in RAM as a whole; a body that fits in one block
+    goes out as a plain response.
+    """
+    return JsonChunks(obj)
+
+
+_GENERATOR = type((lambda: (yield))())
+
+
+def _is_stream(data):
+    """Iterator/generator response body, served block by block."""
+    return isinstance(data, (JsonChunks, _GENERATOR)) or (
+        not isinstance(data, (str, bytes, bytearray, memoryview, dict, list, tuple))
+        and hasattr(data, '__next__'))
+
+
+class _Block1Transfer:
+    """
+    An upload in progress. Blocks are written into one buffer sized from
+    Size1 up front (grown only when the client sent no Size1), or handed to
+    the route sink as they arrive.
+    """
+    __slots__ = ('buf', 'view', 'length', 'next_num', 'sink', 'time')
+
+    def __init__(self, capacity, sink):
+        self.buf = bytearray(capacity) if capacity else None
+        self.view = memoryview(self.buf) if capacity else None
+        self.length = 0
+        self.next_num = 0
+        self.sink = sink
+        self.time = time.time()
+
+    @property
+    def capacity(self):
+        return len(self.buf) if self.buf is not None else 0
+
+    def grow(self, capacity):
+        buf = bytearray(capacity)
+        if self.length:
+            buf[:self.length] = self.view[:self.length]
+        self.buf = buf
+        self.view = memoryview(buf)
+
+
+class _Block2Transfer:
+    """
+    A streamed response: pulls chunks from the iterator only as blocks are
+    requested, keeping the last BLOCK2_WINDOW blocks for re-requests.
+    """
+    __slots__ = ('chunks', 'code', 'szx', 'cf', 'etag', 'max_age', 'buf', 'blocks', 'next_num', 'time')
+
+    def __init__(self, chunks, code, szx, cf=None, etag=None, max_age=None):
+        self.chunks = chunks
+        self.code = code
+        self.szx = szx
+        self.cf = cf  # Content-Format of the body
+        self.etag = etag
+        self.max_age = max_age
+        self.buf = bytearray()
+        self.blocks = {}     # num -> (payload, more)
+        self.next_num = 0
+        self.time = time.time()
+
+    def block(self, num):
+        """(payload, more) of block num, None if it left the window."""
+        self.time = time.time()
+        ret = self.blocks.get(num)
+        if ret is not None or num != self.next_num:
+            return ret
+        size = 1 << (self.szx + 4)
+        buf = self.buf
+        while len(buf) <= size and self.chunks is not None:
+            try:
+                chunk = next(self.chunks)
+            except StopIteration:
+                self.chunks = None
+                break
+            buf.extend(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+        ret = (bytes(buf[:size]), len(buf) > size)
+        self.buf = buf[size:]
+        self.blocks[num] = ret
+        self.blocks.pop(num - BLOCK2_WINDOW, None)
+        self.next_num = num + 1
+        return ret
+
+
+def _encode_payload(data, accept=CF_JSON):
+    """
+    (payload bytes, Content-Format): str as UTF-8, bytes-like as is (no format),
+    anything else as CBOR if the client Accepts it, else JSON.
+    """
+    if data is None: return b'', None
+    if isinstance(data, str): return data.encode('utf-8'), None
+    if isinstance(data, (bytes, bytearray, memoryview)): return data, None
+    if accept == CF_CBOR: return cbor.dumps(data), CF_CBOR
+    return ujson.dumps(data).encode('utf-8'), CF_JSON
+
+
+def _etag(tag, cf):
+    """ETag option value: 32 bit version/hash + the Content-Format (one ETag per representation)."""
+    tag &= 0xFFFFFFFF
+    return bytes((tag >> 24, (tag >> 16) & 0xFF, (tag >> 8) & 0xFF, tag & 0xFF, (cf or 0) & 0xFF))
+
+
+class _RouteNode:
+    """Node of the path parameter route tree, one per path segment."""
+    __slots__ = ('children', 'param', 'param_node', 'route')
+
+    def __init__(self):
+        self.children = {}     # literal segment -> _RouteNode
+        self.param = None      # name of the {param} segment at this level
+        self.param_node = None
+        self.route = None      # route_def of a pattern ending here
+
+
+class _ExchangeCache:
+    """
+    Recently received non-idempotent requests (POST, PATCH) keyed by
+    (ip, port, msg_id) with the ACK sent for them, so a retransmitted CON
+    gets the same ACK again instead of running the handler twice, and a
+    duplicated NON is dropped. Idempotent requests are not tracked: running
+    one twice is harmless (RFC 7252 4.5).
+    Everything lives in EXCHANGE_CACHE_BYTES: EXCHANGE_CACHE_MAX slots of
+    arrays (ip as two 16 bit halves, port, msg id, time, ACK position) used as a ring (a
+    new exchange overwrites the oldest one), a bucket index chaining the
+    slots, and the rest as an arena the ACKs are copied into, written as a
+    ring too. No per exchange objects are kept.
+    Bound: a CON is retransmitted at most EXCHANGE_WINDOW_MS after its first
+    transmission, the slots cover that window while all clients together send
+    at most EXCHANGE_CACHE_MAX POSTs in it; exchanges overwritten sooner are
+    counted in 'early'. Older ones stay known until overwritten or
+    EXCHANGE_LIFETIME_MS. An ACK whose arena space was reused is 'lost':
+    duplicates of its request are still never run twice but get no reply.
+    """
+    __slots__ = ('ip_hi', 'ip_lo', 'ports', 'mids', 'stamps', 'ack_off', 'ack_len', 'ack_lap', 'chain',
+                 'heads', 'mask', 'next', 'used', 'arena', 'arena_view', 'arena_pos', 'lap',
+                 'hits', 'replays', 'early', 'lost')
+
+    SLOT_BYTES = 20  # stamps 4, ip_hi, ip_lo, ports, mids, ack_off, ack_len, ack_lap, chain 8 x 2
+
+    def __init__(self, size=EXCHANGE_CACHE_MAX, nbytes=EXCHANGE_CACHE_BYTES):
+        nbuckets = 1
+        while nbuckets < size:
+            nbuckets <<= 1
+        # halves: an IPv4 address as one int would be a heap allocated long on MicroPython
+        self.ip_hi = array.array('H', [0] * size)
+        self.ip_lo = array.array('H', [0] * size)
+        self.ports = array.array('H', [0] * size)
+        self.mids = array.array('H', [0] * size)
+        self.stamps = array.array('i', [0] * size)   # ticks_ms() of the first reception
+        self.ack_off = array.array('H', [0] * size)
+        self.ack_len = array.array('H', [0] * size)  # 0: no ACK stored (yet)
+        self.ack_lap = array.array('H', [0] * size)
+        self.chain = array.array('h', [-1] * size)   # next slot of the same bucket
+        self.heads = array.array('h', [-1] * nbuckets)  # first slot of each bucket
+        self.mask = nbuckets - 1
+        self.next = 0                         # slot of the next new exchange
+        self.used = 0                         # slots holding an exchange
+        self.arena = bytearray(nbytes - size * self.SLOT_BYTES - nbuckets * 2)
+        self.arena_view = memoryview(self.arena)
+        self.arena_pos = 0
+        self.lap = 0                          # arena wrap count
+        self.hits = 0
+        self.replays = 0
+        self.early = 0
+        self.lost = 0
+
+    @staticmethod
+    def tracked(method):
+        return method == METHOD_POST or method == METHOD_PATCH
+
+    @staticmethod
+    def _ip(ip):
+        """IPv4 address as (high, low) 16 bit halves (other address families: of its hash)."""
+        try:
+            a, b, c, d = ip.split('.')
+            return int(a) << 8 | int(b), int(c) << 8 | int(d)
+        except ValueError:
+            h = hash(ip)
+            return (h >> 16) & 0xFFFF, h & 0xFFFF
+
+    def _bucket(self, lo, port, msg_id):
+        return (lo ^ port ^ msg_id ^ (msg_id >> 7)) & self.mask
+
+    def _slot(self, ip, port, msg_id):
+        hi, lo = ip
+        slot = self.heads[self._bucket(lo, port, msg_id)]
+        while slot != -1:
+            if self.mids[slot] == msg_id and self.ports[slot] == port and \
+                    self.ip_lo[slot] == lo and self.ip_hi[slot] == hi:
+                return slot
+            slot = self.chain[slot]
+        return None
+
+    def _unlink(self, slot):
+        b = self._bucket(self.ip_lo[slot], self.ports[slot], self.mids[slot])
+        prev = -1
+        cur = self.heads[b]
+        while cur != -1 and cur != slot:
+            prev = cur
+            cur = self.chain[cur]
+        if cur == -1:
+            return
+        if prev == -1:
+            self.heads[b] = self.chain[slot]
+        else:
+            self.chain[prev] = self.chain[slot]
+
+    def duplicate(self, sock, addr, msg_id):
+        """True for a duplicate (its stored ACK is sent again), else start tracking it."""
+        now = time.ticks_ms()
+        ip = self._ip(addr[0])
+        port = addr[1]
+        slot = self._slot(ip, port, msg_id)
+        if slot is not None and time.ticks_diff(now, self.stamps[slot]) < EXCHANGE_LIFETIME_MS:
+            self.hits += 1
+            n = self.ack_len[slot]
+            if n and self._ack_intact(slot):
+                off = self.ack_off[slot]
+                sock.sendto(self.arena_view[off:off + n], addr)
+                self.replays += 1
+            return True
+        if slot is not None:
+            self._unlink(slot)  # expired: tracked again as a new exchange
+        slot = self.next
+        self.next = (slot + 1) % len(self.mids)
+        if self.used == len(self.mids):
+            self._unlink(slot)
+            if time.ticks_diff(now, self.stamps[slot]) < EXCHANGE_WINDOW_MS:
+                self.early += 1
+        else:
+            self.used += 1
+        self.ip_hi[slot], self.ip_lo[slot] = ip
+        self.ports[slot] = port
+        self.mids[slot] = msg_id
+        self.stamps[slot] = now
+        self.ack_len[slot] = 0
+        b = self._bucket(ip[1], port, msg_id)
+        self.chain[slot] = self.heads[b]
+        self.heads[b] = slot
+        return False
+
+    def _ack_intact(self, slot):
+        """True while the arena bytes of the slot's ACK were not reused."""
+        laps = (self.lap - self.ack_lap[slot]) & 0xFFFF
+        if laps == 0 or (laps == 1 and self.ack_off[slot] >= self.arena_pos):
+            return True
+        self.ack_len[slot] = 0
+        self.lost += 1
+        return False
+
+    def store(self, addr, msg_id, message):
+        """Remember the ACK (piggybacked response or empty ACK) sent for a tracked request."""
+        n = len(message)
+        if not self.used or n > len(self.arena):
+            return
+        slot = self._slot(self._ip(addr[0]), addr[1], msg_id)
+        if slot is None:
+            return
+        pos = self.arena_pos
+        if pos + n > len(self.arena):
+            pos = 0
+            self.lap = (self.lap + 1) & 0xFFFF
+        self.arena[pos:pos + n] = message
+        self.arena_pos = pos + n
+        self.ack_off[slot] = pos
+        self.ack_len[slot] = n
+        self.ack_lap[slot] = self.lap
+
+    def stats(self):
+        return {'exchanges': self.used, 'slots': len(self.mids), 'arena': len(self.arena),
+                'bytes': len(self.mids) * self.SLOT_BYTES + len(self.heads) * 2 + len(self.arena),
+                'hits': self.hits, 'replays': self.replays, 'early': self.early, 'lost': self.lost}
+
+
+class _Client:
+    """Admission state of one client IP: token bucket, running and waiting requests."""
+    __slots__ = ('tokens', 'refill_ms', 'seen_ms', 'active', 'queue', 'limited', 'rejected')
+
+    def __init__(self, now):
+        self.tokens = CLIENT_BURST
+        self.refill_ms = now
+        self.seen_ms = now
+        self.active = 0
+        self.queue = []     # waiting requests, oldest first
+        self.limited = 0    # 4.29 sent
+        self.rejected = 0   # 5.03 sent
+
+    def take(self, now, rate, burst):
+        """Take a token. 0 when granted, else ms until the next token."""
+        period = 1000 // rate
+        add = time.ticks_diff(now, self.refill_ms) // period
+        if add:
+            self.tokens += add
+            if self.tokens >= burst:
+                self.tokens = burst
+                self.refill_ms = now
+            else:
+                self.refill_ms = time.ticks_add(self.refill_ms, add * period)
+        if self.tokens:
+            self.tokens -= 1
+            return 0
+        return period - time.ticks_diff(now, self.refill_ms)
+
+
+class _Exchange:
+    """One outbound request waiting for its ACK and response."""
+    __slots__ = ('addr', 'token', 'msg_id', 'event', 'acked', 'reset', 'code', 'data')
+
+    def __init__(self, addr, token, msg_id):
+        self.addr = addr
+        self.token = token
+        self.msg_id = msg_id
+        self.event = asyncio.Event()
+        self.acked = False   # empty ACK: the response comes separately
+        self.reset = False   # RST from the peer
+        self.code = None     # response code, set with data by the response
+        self.data = None
+
+
+class _Observer:
+    """One Observe registration: destination, rate limit and liveness state."""
+    __slots__ = ('addr', 'token', 'min_interval_ms', 'accept', 'last_ms', 'con_ms', 'pending',
+                 'last_mid', 'con_mid', 'misses', 'sent')
+
+    def __init__(self, addr, token, min_interval_ms, accept=CF_JSON):
+        self.addr = addr
+        self.token = token
+        self.min_interval_ms = min_interval_ms
+        self.accept = accept
+        self.last_ms = self.con_ms = time.ticks_ms()
+        self.pending = None   # newest payload held back by the rate limit
+        self.last_mid = -1    # msg id of the last notification (matched against RST)
+        self.con_mid = -1     # msg id of the outstanding CON notification
+        self.misses = 0
+        self.sent = 0
+
 
 class CoAPRequest:
     """
     Holds request context + reference to the Server instance.
+    Requests are pooled by the server: the datagram is received into the
+    request's own buffer and parsed in place through a memoryview. Only the
+    path and the token are copied; the query, the payload and the other
+    options are decoded when a handler asks for them. A handler must not keep
+    the request after it returned, the server reuses it.
     """
-    def __init__(self, server, addr, packet=None):
+    __slots__ = ('server', 'addr', 'ip', 'buf', 'bufview', 'view', 'method', 'token', 'msg_id', 'type',
+                 'is_observation', 'observe', 'path', 'block1', 'block2', 'valid', 'ack_sent', '_json',
+                 '_payload', '_body', '_payload_idx', '_end', '_query', '_opts', 'queued_ms',
+                 'route', 'params', 'bad_body')
+
+    def __init__(self, server, addr=None, packet=None, bufsize=0):
         self.server = server       # <--- ACCESS TO COAP SERVER
+        self.buf = bytearray(bufsize) if bufsize else None
+        self.bufview = memoryview(self.buf) if bufsize else None
+        self.view = None           # the datagram being parsed
+        self._opts = []            # flat [number, start, end, ...] of the lazily decoded options
+        self.reset(addr)
+        if packet:
+            self.valid = self.parse(packet)
+
+    def reset(self, addr=None):
+        """Clear the parsed fields so the pooled request can take the next datagram."""
         self.addr = addr           # (IP, Port)
-        self.ip = addr[0]
+        self.ip = addr[0] if addr else None
 
         # Default / Parsed fields
         self.method = 0
-        self.payload = b''
-        self.query = {}
         self.token = b''
         self.msg_id = 0
         self.type = 0
         self.is_observation = False
+        self.observe = None        # Observe option value: 0 register, 1 deregister
         self.path = ""
+        self.route = None          # route_def, resolved by the server on admission
+        self.params = None         # {name: segment} of a '/x/{name}' route
         self.block1 = None
+        self.block2 = None
         self.valid = False
         self._json = None
+        self.bad_body = False      # the payload did not decode (set by json)
+        self._payload = None
+        self._body = None
+        self._payload_idx = 0
+        self._end = 0
+        self._query = None
+        self._opts.clear()
         self.ack_sent = False
 
-        if packet:
-            self.valid = self.parse(packet)
-
-    def parse(self, packet):
-        if len(packet) < 4: return False
+    def parse(self, packet, length=None):
+        """Parse packet[:length] (bytes, bytearray or memoryview) without copying it."""
+        if length is None: length = len(packet)
+        if length < 4: return False
+        packet = packet if isinstance(packet, memoryview) else memoryview(packet)
+        self.view = packet
+        self._end = length
 
         idx = self._parse_header(packet)
-        if idx is None: return False
+        if idx is None or idx > length: return False
 
         idx = self._parse_options(packet, idx)
+        if idx is None: return False
         self._parse_payload(packet, idx)
         return True
 
@@ -78,16 +678,19 @@ class CoAPRequest:
         self.type = (h >> 4) & 0x03
         token_len = h & 0x0F
         self.method = packet[1]
-        self.msg_id = struct.unpack('!H', packet[2:4])[0]
-        self.token = bytes(packet[4 : 4+token_len])
+        self.msg_id = (packet[2] << 8) | packet[3]
+        self.token = bytes(packet[4 : 4+token_len])  # small, used as a dict key
         return 4 + token_len
 
     def _parse_options(self, packet, idx):
-        path_segments = []
-        query_segments = []
+        end = self._end
+        opts = self._opts
+        path = None
         opt_num = 0
 
-        while idx < len(packet):
+        bad_path = False
+
+        while idx < end:
             byte = packet[idx]
             if byte == 0xFF:   # option terminator next is data
                 break
@@ -95,44 +698,121 @@ class CoAPRequest:
             idx += 1
             delta = (byte >> 4) & 0x0F
             length = byte & 0x0F
+            if delta == 15 or length == 15: return None  # reserved (message format error)
+            # the extended delta/length bytes must be inside the datagram
+            if idx + (delta > 12) + (delta == 14) + (length > 12) + (length == 14) > end:
+                return None
 
             if delta == 13:    # more than 13 counts
                 delta = packet[idx] + 13
                 idx += 1
             elif delta == 14:  # more than 269 counts
-                delta = struct.unpack('!H', packet[idx:idx+2])[0] + 269
+                delta = ((packet[idx] << 8) | packet[idx+1]) + 269
+                idx += 2
+            if length == 13:
+                length = packet[idx] + 13
+                idx += 1
+            elif length == 14:
+                length = ((packet[idx] << 8) | packet[idx+1]) + 269
                 idx += 2
 
             opt_num += delta
+            if idx + length > end: return None
 
-            opt_val_view = packet[idx : idx+length]
+            if opt_num == OPT_URI_PATH:
+                # the path is needed for routing, everything else is decoded on demand
+                try:
+                    seg = str(packet[idx : idx+length], 'utf-8')
+                    path = "/" + seg if path is None else path + "/" + seg
+                except UnicodeError:
+                    bad_path = True
+            elif opt_num == OPT_OBSERVE:
+                val = 0
+                for i in range(idx, idx + length):
+                    val = (val << 8) | packet[i]
+                self.observe = val
+                self.is_observation = val == 0
+            elif opt_num == OPT_BLOCK1 or opt_num == OPT_BLOCK2:
+                val = 0
+                for i in range(idx, idx + length):
+                    val = (val << 8) | packet[i]
+                if opt_num == OPT_BLOCK1: self.block1 = val
+                else: self.block2 = val
+            else:
+                opts.append(opt_num); opts.append(idx); opts.append(idx + length)
             idx += length
 
-            if opt_num == OPT_URI_PATH: path_segments.append(str(opt_val_view, 'utf-8'))
-            elif opt_num == OPT_URI_QUERY: query_segments.append(str(opt_val_view, 'utf-8'))
-            elif opt_num == OPT_OBSERVE: self.is_observation = True
-            elif opt_num == OPT_BLOCK1:
-                val = 0
-                for b in opt_val_view:
-                    val = (val << 8) | b
-                self.block1 = val
+        # None: a Uri-Path segment is not UTF-8, the server answers 4.00
+        self.path = None if bad_path else path or "/"
+        return idx
+
+    def _parse_payload(self, packet, idx):
+        if idx < self._end and packet[idx] == 0xFF:
+            idx += 1
+        self._payload_idx = idx
+
+    def option(self, number):
+        """Raw value (memoryview) of the first option with this number, None if absent."""
+        opts = self._opts
+        for i in range(0, len(opts), 3):
+            if opts[i] == number:
+                return self.view[opts[i+1] : opts[i+2]]
+        return None
+
+    def option_uint(self, number, default=None):
+        """Value of an unsigned integer option (e.g. OPT_SIZE1), default if absent."""
+        value = self.option(number)
+        if value is None:
+            return default
+        ret = 0
+        for b in value:
+            ret = (ret << 8) | b
+        return ret
+
+    def options(self, number):
+        """Raw values (memoryviews) of every option with this number."""
+        opts = self._opts
+        return [self.view[opts[i+1] : opts[i+2]] for i in range(0, len(opts), 3) if opts[i] == number]
 
-        self.path = "/" + "/".join(path_segments)
+    @property
+    def query(self):
+        """Uri-Query options as a dict, decoded on first access."""
+        if self._query is None:
+            self._query = {}
+            for opt in self.options(OPT_URI_QUERY):
+                q = str(opt, 'utf-8')
+                if '=' in q:
+                    k, v = q.split('=', 1)
+                    self._query[k] = int(v) if v.isdigit() else v
+                else: self._query[q] = True
+        return self._query
 
-        for q in query_segments:
-            if '=' in q:
-                k, v = q.split('=', 1)
-                self.query[k] = int(v) if v.isdigit() else v
-            else: self.query[q] = True
+    @property
+    def payload_view(self):
+        """Payload as a memoryview into the receive buffer (no copy)."""
+        if self._payload is not None:
+            return memoryview(self._payload)
+        if self._body is not None:
+            return self._body
+        return self.view[self._payload_idx : self._end] if self.view is not None else memoryview(b'')
 
-        return idx
+    @property
+    def payload(self):
+        """Payload as bytes, copied out of the receive buffer on first access."""
+        if self._payload is None:
+            self._payload = bytes(self.payload_view)
+        return self._payload
+
+    @payload.setter
+    def payload(self, value):
+        self._payload = value
+        self._json = None
 
-    def _parse_payload(self, packet, idx):
-        if idx < len(packet):
-            if packet[idx] == 0xFF:
-                self.payload = bytes(packet[idx+1:])
-            else:
-                self.payload = bytes(packet[idx:])
+    def set_body(self, view):
+        """Body reassembled from Block1 transfers (a memoryview, not copied)."""
+        self._payload = None
+        self._body = view
+        self._json = None
 
     def send_ack(self):
         """Send an Empty ACK to signal separate response will follow."""
@@ -140,12 +820,27 @@ class CoAPRequest:
             self.server._send_ack(self.addr, self.token, self.msg_id, 0) # 0 = EMPTY
             self.ack_sent = True
 
+    @property
+    def accept(self):
+        """Content-Format the client wants back (Accept option), JSON by default."""
+        return self.option_uint(OPT_ACCEPT, CF_JSON)
+
     @property
     def json(self):
-        """Lazy load JSON payload"""
-        if self._json is None and self.payload:
-            try: self._json = ujson.loads(self.payload)
-            except: self._json = {}
+        """
+        Lazy load the payload: JSON, or CBOR when its Content-Format says so.
+        A payload that does not decode gives {} and sets bad_body.
+        """
+        if self._json is None and len(self.payload_view):
+            try:
+                if self.option_uint(OPT_CONTENT_FORMAT) == CF_CBOR:
+                    self._json = cbor.loads(self.payload_view)  # decoded in place
+                else:
+                    # MicroPython's loads reads any buffer, no copy of the body
+                    self._json = ujson.loads(self.payload_view)
+            except:
+                self._json = {}
+                self.bad_body = True
         return self._json or {}
 
     @property
@@ -164,308 +859,974 @@ class AsyncCoAPServer:
 
         # Route Table: path -> {'methods': [], 'handler': func}
         self.routes = {}
-
-        self.partial_blocks = {}
-        self.pending_requests = {}
-        self.observers = {}
+        # Routes with {param} segments: pattern -> route_def, resolved through a tree
+        self.param_routes = {}
+        self._route_tree = _RouteNode()
+
+        self.partial_blocks = {}    # (addr, path) -> _Block1Transfer
+        self.block1_bytes = 0       # buffers held by partial_blocks (BLOCK1_BUDGET)
+        self.block2_transfers = {}  # (addr, path, query, accept) -> _Block2Transfer
+        self.pending_requests = {}  # msg id -> _Exchange of our outstanding requests
+        self._exchange_tokens = {}  # token -> _Exchange, matches (separate) responses
+        self._outstanding = {}      # peer addr -> requests in flight (NSTART)
+        self._nstart_waiters = {}   # peer addr -> [Event] of requests waiting for a slot
+        self.client_stats = {'requests': 0, 'retransmissions': 0, 'timeouts': 0, 'resets': 0}
+        self.observers = {}   # path -> {addr: _Observer}
         self.obs_seq = 0
-        self.last_cleanup = time.time()
 
         self.max_workers = max_workers
         self.active_workers = 0
+        self.client_rate = CLIENT_RATE
+        self.client_burst = CLIENT_BURST
+        self.clients = {}     # ip -> _Client
+        self._rr = []         # clients with waiting requests, next to serve first
+        self.queued = 0
+        self.queue_timeouts = 0
+        self.urgent_active = 0  # urgent requests running on the reserved workers
+        self.urgent_served = 0
+
+        # one preallocated request per worker, per queue slot and per reserved
+        # urgent worker, plus a spare
+        # one to receive and reject datagrams while all of them are taken.
+        # Each gets its own receive buffer only where the socket can receive
+        # into it: MicroPython sockets have no recvfrom_into, there every
+        # datagram is a recvfrom() bytes object and a buffer would be dead heap
+        self._recv_into = hasattr(self.sock, 'recvfrom_into')
+        bufsize = RX_BUF_SIZE if self._recv_into else 0
+        self._req_pool = [CoAPRequest(self, bufsize=bufsize)
+                          for _ in range(max_workers + QUEUE_MAX + URGENT_MAX)]
+        self._req_spare = CoAPRequest(self, bufsize=bufsize)
+        self._tx = MessageBuilder()
+        self._exchanges = _ExchangeCache()
 
         log.info(f"[CoAP] Server Active on :{port}")
 
-    def route(self, path, methods=['GET']):
-        """Decorator to register a handler."""
+    def route(self, path, methods=['GET'], sink=None, max_concurrency=0, etag=None, max_age=None,
+              urgent=None):
+        """
+        Decorator to register a handler.
+        sink: optional async sink(req, offset, data, more) receiving Block1
+        upload blocks as they arrive (e.g. straight to a file) instead of
+        reassembling the body in RAM; the handler runs after the last block.
+        max_concurrency: handlers of this route running at once (0: no limit),
+        further requests wait in the admission queue.
+        etag: version(req) callable (e.g. a change counter, None: no ETag) or
+        True to hash each response. A GET carrying the current ETag gets a
+        2.03 Valid without a payload; with a callable the handler does not
+        even run. max_age: Max-Age (s) of the GET responses.
+        urgent: optional urgent(req) predicate, e.g. a motor stop. An urgent
+        request skips the rate limit, the queue and max_concurrency and runs
+        at once on one of URGENT_MAX reserved workers, so it is never
+        answered with 4.29/5.03 while the reserve lasts.
+        A path segment '{name}' matches any segment, the handler finds it in
+        req.params['name']. Exact paths win, then literal segments over
+        parameters, level by level (no backtracking).
+        """
         def decorator(handler):
             clean_path = "/" + path.strip("/")
-            self.routes[clean_path] = {
+            route_def = {
                 'methods': methods,
-                'handler': handler
+                'handler': handler,
+                'sink': sink,
+                'max_concurrency': max_concurrency,
+                'active': 0,
+                'etag': etag,
+                'max_age': max_age,
+                'urgent': urgent
             }
+            if '{' not in clean_path:
+                self.routes[clean_path] = route_def
+                return handler
+            node = self._route_tree
+            for seg in clean_path[1:].split('/'):
+                if seg.startswith('{') and seg.endswith('}'):
+                    if node.param_node is None:
+                        node.param_node = _RouteNode()
+                    node.param = seg[1:-1]
+                    node = node.param_node
+                else:
+                    child = node.children.get(seg)
+                    if child is None:
+                        child = node.children[seg] = _RouteNode()
+                    node = child
+            node.route = route_def
+            self.param_routes[clean_path] = route_def
             return handler
         return decorator
 
+    def _match(self, path):
+        """(route_def, params) of a request path, (None, None) when no route matches."""
+        route_def = self.routes.get(path)
+        if route_def is not None or not self.param_routes:
+            return route_def, None
+        node = self._route_tree
+        params = None
+        for seg in path[1:].split('/'):
+            child = node.children.get(seg)
+            if child is None:
+                if node.param_node is None:
+                    return None, None
+                if params is None:
+                    params = {}
+                params[node.param] = seg
+                child = node.param_node
+            node = child
+        if node.route is None:
+            return None, None
+        return node.route, params
+
     async def run(self):
+        """
+        Receive loop. The socket is registered with the uasyncio poller so the
+        task sleeps until a datagram arrives, then drains up to RX_BURST of them.
+        """
+        asyncio.create_task(self.observe_task())
+        asyncio.create_task(self._housekeeping_task())
         while True:
             try:
-                data, addr = self.sock.recvfrom(1500)
-
-                # 1. Parse Synchronously & Free Data
-                req = CoAPRequest(self, addr, packet=data)
-                del data, addr
+                await _readable(self.sock)
+                for _ in range(RX_BURST):
+                    if not self._receive():
+                        break  # EAGAIN: drained
 
-                # 2. Process if valid
-                if req.valid:
-                    if self.active_workers < self.max_workers:
-                        self.active_workers += 1
-                        asyncio.create_task(self._run_worker(req))
-                    else:
-                        log.warning(f"[CoAP] Server Busy: Rejecting {req.addr}")
-                        if req.type == TYPE_CON:
-                            self._send_ack(req.addr, req.token, req.msg_id, RESP_SERVICE_UNAVAILABLE)
-                        elif req.type == TYPE_NON:
-                            self.send_response_raw(req.addr, req.token, RESP_SERVICE_UNAVAILABLE, b'')
-
-                if time.time() - self.last_cleanup > 10:
-                    self._cleanup_partials()
-                gc.collect()
-                mem_info()
-                log.warning(t_logger.mem_info_str())
-                # print(qstr_info(), len(self.pending_requests))
-            except OSError:
-                await asyncio.sleep(0.01)
+                # no gc.collect() here: utils/mem_service.py collects at idle time
             except Exception as e:
                 log.critical(f"[CoAP] Critical: {e}")
                 await asyncio.sleep(0.1)
 
-    async def _run_worker(self, req):
+    def _receive(self):
+        """Receive and dispatch one datagram. False when there is none."""
+        pool = self._req_pool
+        req = pool.pop() if pool else self._req_spare
+        try:
+            if self._recv_into:
+                n, addr = self.sock.recvfrom_into(req.buf)
+                packet = req.bufview
+            else:
+                # MicroPython sockets have no recvfrom_into: parse the
+                # received bytes in place, still without further copies
+                packet, addr = self.sock.recvfrom(RX_BUF_SIZE)
+                n = len(packet)
+        except OSError:
+            self._release(req)
+            return False
+
+        # from here on every path must hand req back to the pool, or to the
+        # admission queue that releases it when its worker is done
+        admitted = False
+        try:
+            # 1. Parse Synchronously
+            req.reset(addr)
+            req.valid = req.parse(packet, n)
+            del packet
+
+            # 2. Process if valid (and not a retransmission of a request already seen)
+            if not req.valid:
+                self._release(req)
+            elif self._exchanges.tracked(req.method) and req.type <= TYPE_NON and \
+                    self._exchanges.duplicate(self.sock, req.addr, req.msg_id):
+                self._release(req)
+            elif req.type > TYPE_NON or not 0 < req.method < 32:
+                self._on_reply(req)  # ACK/RST/response to our own messages, or a ping
+                self._release(req)
+            elif req.path is None:
+                self._reject(req, RESP_BAD_REQ)  # undecodable Uri-Path
+            elif req is self._req_spare:
+                log.warning(f"[CoAP] Server Busy: Rejecting {req.addr}")
+                self._reject(req, RESP_SERVICE_UNAVAILABLE, BUSY_RETRY_S)
+            else:
+                admitted = True
+                self._admit(req)
+        except Exception as e:
+            log.error(f"[CoAP] Datagram from {addr} dropped: {e}")
+            if not admitted:
+                self._release(req)
+        return True
+
+    def _on_reply(self, req):
+        """Match an ACK, RST or response to our requests and notifications."""
+        ex = None
+        if req.type >= TYPE_ACK:
+            ex = self.pending_requests.get(req.msg_id)
+            if ex is not None and ex.addr != req.addr:
+                ex = None
+        elif req.method >= 64:
+            ex = self._exchange_tokens.get(req.token)
+        if ex is None:
+            if req.type >= TYPE_ACK:
+                self._observer_reply(req.addr, req.msg_id, req.type == TYPE_RST)
+            elif req.type == TYPE_CON:
+                # CoAP ping (empty CON) or a response we do not expect
+                self._tx.start(TYPE_RST, 0, req.msg_id).send(self.sock, req.addr)
+            return
+        if req.type == TYPE_RST:
+            ex.reset = True
+        elif req.method == 0:
+            ex.acked = True
+        elif ex.code is None:
+            ex.code = req.method
+            ex.data = self._reply_data(req)
+        if req.type == TYPE_CON:
+            self._tx.start(TYPE_ACK, 0, req.msg_id).send(self.sock, req.addr)
+        ex.event.set()
+
+    def _reply_data(self, req):
+        """Response payload decoded by its Content-Format, else a bytes copy."""
+        view = req.payload_view
+        if not view:
+            return None
+        cf = req.option_uint(OPT_CONTENT_FORMAT)
+        try:
+            if cf == CF_CBOR:
+                return cbor.loads(view)
+            if cf == CF_JSON:
+                return ujson.loads(view)
+        except ValueError:
+            pass
+        return bytes(view)
+
+    def _release(self, req):
+        req.reset()
+        req.view = None  # drop the reference to a received bytes object
+        if req is not self._req_spare:
+            self._req_pool.append(req)
+
+    def _reject(self, req, code, max_age=None):
+        """Answer req with an error (and a Max-Age retry hint), then release it."""
+        try:
+            if req.type == TYPE_CON:
+                tx = self._tx.start(TYPE_ACK, code, req.msg_id, req.token)
+            else:
+                tx = self._tx.start(TYPE_NON, code, self._next_msg_id(), req.token)
+            if max_age is not None:
+                tx.option_uint(OPT_MAX_AGE, max_age)
+            tx.send(self.sock, req.addr)
+            if req.type == TYPE_CON:
+                self._exchanges.store(req.addr, req.msg_id, tx.view[:tx.n])
+        finally:
+            self._release(req)
+
+    # --- Admission control ---
+
+    def _admit(self, req):
+        """Rate limit the client, then queue req and start what the limits allow."""
+        req.route, req.params = self._match(req.path)
+        now = time.ticks_ms()
+        c = self.clients.get(req.ip)
+        if c is None:
+            c = self.clients[req.ip] = _Client(now)
+        c.seen_ms = now
+        if self.urgent_active < URGENT_MAX and self._urgent(req):
+            self.urgent_served += 1
+            self._start(req, c, urgent=True)
+            return
+        # follow-up blocks of a Block1/Block2 transfer already paid on its first block
+        follow_up = (req.block1 is not None and req.block1 >> 4) or \
+            (req.block2 is not None and req.block2 >> 4)
+        wait_ms = 0 if follow_up else c.take(now, self.client_rate, self.client_burst)
+        if wait_ms:
+            c.limited += 1
+            self._reject(req, RESP_TOO_MANY_REQUESTS, (wait_ms + 999) // 1000)
+            return
+        if len(c.queue) >= CLIENT_QUEUE_MAX or self.queued >= QUEUE_MAX:
+            c.rejected += 1
+            log.warning(f"[CoAP] Queue full: Rejecting {req.addr}")
+            self._reject(req, RESP_SERVICE_UNAVAILABLE, BUSY_RETRY_S)
+            return
+        req.queued_ms = now
+        c.queue.append(req)
+        self.queued += 1
+        if len(c.queue) == 1:
+            self._rr.append(c)
+        self._schedule()
+
+    @staticmethod
+    def _urgent(req):
+        route_def = req.route
+        if route_def is None or route_def['urgent'] is None or req.block1 is not None:
+            return False
+        try:
+            return bool(route_def['urgent'](req))
+        except Exception:
+            return False
+
+    def _runnable(self, c):
+        """Oldest waiting request of client c that the client and route limits let start."""
+        if c.active >= CLIENT_MAX_ACTIVE:
+            return None
+        for req in c.queue:
+            route_def = req.route
+            if route_def is None or not route_def['max_concurrency'] or \
+                    route_def['active'] < route_def['max_concurrency']:
+                return req
+        return None
+
+    def _schedule(self):
+        """Start waiting requests while workers are free, one per client in turn."""
+        rr = self._rr
+        skips = 0
+        while rr and skips < len(rr) and self.active_workers < self.max_workers:
+            c = rr.pop(0)
+            req = self._runnable(c)
+            if req is None:
+                rr.append(c)  # all its requests wait for a running one to finish
+                skips += 1
+                continue
+            c.queue.remove(req)
+            self.queued -= 1
+            if c.queue:
+                rr.append(c)
+            skips = 0
+            self._start(req, c)
+
+    def _start(self, req, client, urgent=False):
+        if urgent:
+            self.urgent_active += 1
+        else:
+            self.active_workers += 1
+        route_def = req.route if client else None
+        if client:
+            client.active += 1
+        if route_def:
+            route_def['active'] += 1
+        asyncio.create_task(self._run_worker(req, client, route_def, urgent))
+
+    async def _run_worker(self, req, client=None, route_def=None, urgent=False):
         try:
             await self._process_request(req)
         finally:
-            self.active_workers -= 1
+            if urgent:
+                self.urgent_active -= 1
+            else:
+                self.active_workers -= 1
+            if client:
+                client.active -= 1
+            if route_def:
+                route_def['active'] -= 1
+            self._release(req)
+            if self._rr:
+                self._schedule()
+
+    def _expire_queue(self):
+        """5.03 for requests waiting longer than QUEUE_TIMEOUT_MS, forget idle clients."""
+        now = time.ticks_ms()
+        for ip, c in list(self.clients.items()):
+            while c.queue and time.ticks_diff(now, c.queue[0].queued_ms) > QUEUE_TIMEOUT_MS:
+                req = c.queue.pop(0)
+                self.queued -= 1
+                self.queue_timeouts += 1
+                c.rejected += 1
+                self._reject(req, RESP_SERVICE_UNAVAILABLE, BUSY_RETRY_S)
+            if not c.queue and c in self._rr:
+                self._rr.remove(c)
+            if not c.active and not c.queue and time.ticks_diff(now, c.seen_ms) > CLIENT_IDLE_MS:
+                del self.clients[ip]
+
+    def set_rate_limit(self, rate=None, burst=None):
+        """Per client token bucket: rate requests/s, burst requests."""
+        if rate:
+            self.client_rate = max(1, min(int(rate), 1000))
+        if burst:
+            self.client_burst = max(1, int(burst))
+
+    async def _housekeeping_task(self):
+        # timed, so stale transfers are freed even when no packet arrives
+        while True:
+            await asyncio.sleep_ms(HOUSEKEEPING_MS)
+            self._cleanup_partials()
+            self._expire_queue()
 
     def _cleanup_partials(self):
         now = time.time()
-        keys = [k for k, v in self.partial_blocks.items() if now - v['time'] > 15]
-        for k in keys: del self.partial_blocks[k]
-        self.last_cleanup = now
+        keys = [k for k, v in self.partial_blocks.items() if now - v.time > BLOCK1_TIMEOUT_S]
+        for k in keys: self._drop_block1(k)
+        keys = [k for k, v in self.block2_transfers.items() if now - v.time > BLOCK2_TIMEOUT_S]
+        for k in keys: del self.block2_transfers[k]
 
     async def _process_request(self, req):
+        held = 0
         try:
-            # --- 2. Check ACKs (Client Role) ---
-            if (req.type == TYPE_ACK or req.type == TYPE_RST) and req.msg_id in self.pending_requests:
-                future = self.pending_requests.pop(req.msg_id)
-                if not future.done(): future.set_result(req.method)
-                return
+            # (ACK/RST and responses are matched in _on_reply before dispatch)
 
             # --- 5. Block-Wise Reassembly ---
             if req.block1 is not None:
-                num = req.block1 >> 4
-                more = (req.block1 & 0x08) >> 3
-                block_key = (req.addr, req.token)
-
-                if block_key not in self.partial_blocks:
-                    if num != 0:
-                        self._send_ack(req.addr, req.token, req.msg_id, RESP_ENTITY_INCOMPLETE)
-                        return
-                    self.partial_blocks[block_key] = {'buf': bytearray(), 'time': time.time(), 'next_num': 0}
-
-                state = self.partial_blocks[block_key]
-                if num != state['next_num']:
-                    self._send_ack(req.addr, req.token, req.msg_id, RESP_ENTITY_INCOMPLETE)
-                    return
-
-                state['buf'].extend(req.payload)
-                state['time'] = time.time()
-
-                if more:
-                    state['next_num'] += 1
-                    self._send_block_ack(req.addr, req.token, req.msg_id, RESP_CONTINUE, req.block1)
-                    return
+                body = await self._block1(req)
+                if body is None:
+                    return  # more blocks to come, or rejected
+                held = body
+            await self._dispatch(req)
+        except Exception as e:
+            log.error(f"[CoAP] Parse Error: {e}")
+        finally:
+            # a reassembled body stays in BLOCK1_BUDGET until the handler is done with it
+            self.block1_bytes -= held
+
+    async def _dispatch(self, req):
+        # --- 5b. Block2 follow-up: next block of a streamed response ---
+        if req.block2 is not None and req.block2 >> 4:
+            self._serve_block2(req)
+            return
+
+        # --- 6. Routing & Dispatch ---
+        # A. Auto-Register Observers
+        if req.method == METHOD_GET and req.is_observation:
+            try:
+                rate_ms = int(req.query.get('rate_ms', OBS_MIN_INTERVAL_MS))
+                if rate_ms < 0:
+                    raise ValueError
+            except ValueError:
+                if req.type == TYPE_CON:
+                    self._send_response_packet(req.addr, req.token, req.msg_id, RESP_BAD_REQ,
+                                               {'text': "Bad rate_ms"}, accept=req.accept)
+                return
+            # notifications go out on the OBS_TICK_MS tick, a shorter interval means nothing
+            self._add_observer(req.path, req.addr, req.token, max(rate_ms, OBS_TICK_MS), req.accept)
+            # NOTE: We do NOT return here. We let the handler run
+            # to generate the initial "Current State" response.
+        elif req.method == METHOD_GET and req.observe == 1:
+            self._remove_observer(req.path, req.addr)
+
+        # B. Execute Route
+        route_def = req.route
+        if route_def is not None:
+            if CODE_TO_METHOD.get(req.method) not in route_def['methods']:
+                if req.type == TYPE_CON: self._send_ack(req.addr, req.token, req.msg_id, RESP_METHOD_NOT_ALLOWED)
                 else:
-                    full_payload = self.partial_blocks.pop(block_key)['buf']
-                    req.payload = bytes(full_payload)
-                    req._json = None # Reset cached JSON
-
-            # --- 6. Routing & Dispatch ---
-            # A. Auto-Register Observers
-            if req.method == METHOD_GET and req.is_observation:
-                self._add_observer(req.path, req.addr, req.token)
-                # NOTE: We do NOT return here. We let the handler run
-                # to generate the initial "Current State" response.
-
-            # B. Execute Route
-            if req.path in self.routes:
-                route_def = self.routes[req.path]
-                if CODE_TO_METHOD.get(req.method) not in route_def['methods']:
-                    if req.type == TYPE_CON: self._send_ack(req.addr, req.token, req.msg_id, RESP_METHOD_NOT_ALLOWED)
-                    else:
-                        log.warning(f"[CoAP] Method {CODE_TO_METHOD.get(req.method)} not allowed on {req.path} - Ignoring request")
+                    log.warning(f"[CoAP] Method {CODE_TO_METHOD.get(req.method)} not allowed on {req.path} - Ignoring request")
 
-                    return
+                return
 
-                try:
-                    # Call User Handler
-                    result = await route_def['handler'](req)
+            # Conditional requests (RFC 7252 5.10.6, 5.10.8) against the current version
+            etag = None
+            version = route_def['etag']
+            if version is not None and version is not True:
+                tag = version(req)
+                if tag is not None:
+                    etag = _etag(tag, req.accept)
+                    if req.method == METHOD_GET and not req.is_observation and \
+                            self._etag_valid(req, etag, route_def['max_age']):
+                        return
+                    if req.option(OPT_IF_NONE_MATCH) is not None:
+                        if req.type == TYPE_CON:
+                            self._send_ack(req.addr, req.token, req.msg_id, RESP_PRECONDITION_FAILED)
+                        return
 
-                    # Handle Return Values
-                    if result is not None:
-                        # Determine correct success code
-                        default_code = RESP_CHANGED if req.method == METHOD_POST else RESP_CONTENT
+            try:
+                # Call User Handler
+                result = await route_def['handler'](req)
 
-                        # 1. Tuple: (CODE, DATA)
-                        if isinstance(result, tuple) or isinstance(result, list):
-                            r_code, r_data = result[0], result[1]
+                # Handle Return Values
+                if result is not None:
+                    # Determine correct success code
+                    default_code = RESP_CHANGED if req.method == METHOD_POST else RESP_CONTENT
 
-                        # 2. Int: CODE Only
-                        elif isinstance(result, int):
-                            r_code, r_data = result, None
+                    # 1. Tuple: (CODE, DATA)
+                    if isinstance(result, tuple) or isinstance(result, list):
+                        r_code, r_data = result[0], result[1]
 
-                        # 3. Dict/Str: Content
-                        else:
-                            r_code, r_data = default_code, result
+                    # 2. Int: CODE Only
+                    elif isinstance(result, int):
+                        r_code, r_data = result, None
 
-                        if req.ack_sent:
-                            self._send_separate_response(req.addr, req.token, r_code, r_data)
+                    # 3. Dict/Str: Content
+                    else:
+                        r_code, r_data = default_code, result
+
+                    cf = None
+                    max_age = None
+                    if req.method != METHOD_GET or r_code != RESP_CONTENT:
+                        etag = None
+                    elif r_data is not None:
+                        max_age = route_def['max_age']
+                        if version is True and not _is_stream(r_data) and not req.is_observation:
+                            # hashed ETag: encode once, hash, maybe answer 2.03 instead
+                            r_data, cf = _encode_payload(r_data, req.accept)
+                            etag = _etag(binascii.crc32(r_data), cf)
+                            if self._etag_valid(req, etag, max_age):
+                                return
+
+                    if _is_stream(r_data):
+                        self._start_block2(req, r_code, r_data, etag, max_age)
+                    elif req.ack_sent:
+                        self._send_separate_response(req.addr, req.token, r_code, r_data, cf,
+                                                     req.accept, etag, max_age)
+                    else:
+                        if r_data is None:
+                            self._send_ack(req.addr, req.token, req.msg_id, r_code)
                         else:
-                            if r_data is None:
-                                self._send_ack(req.addr, req.token, req.msg_id, r_code)
-                            else:
-                                self._send_response_packet(req.addr, req.token, req.msg_id, r_code, r_data, req.is_observation)
+                            self._send_response_packet(req.addr, req.token, req.msg_id, r_code, r_data,
+                                                       req.is_observation, cf, req.accept, etag, max_age)
 
-                    # If result is None, we assume handler sent its own reply or will later
+                # If result is None, we assume handler sent its own reply or will later
 
-                except Exception as e:
-                    log.error(f"[CoAP] Handler Err: {e}")
-                    if req.ack_sent:
-                        self._send_separate_response(req.addr, req.token, RESP_INTERNAL_ERR, {'text': str(e)})
-                    elif req.type == TYPE_CON:
-                        self._send_ack(req.addr, req.token, req.msg_id, RESP_INTERNAL_ERR)
-            else:
-                log.info(f"[CoAP] Unhandled: {req.addr} T:{req.type} C:{req.method} P:'{req.path}'")
-
-                if req.type == TYPE_CON: self._send_ack(req.addr, req.token, req.msg_id, RESP_NOT_FOUND)
+            except Exception as e:
+                log.error(f"[CoAP] Handler Err: {e}")
+                if req.ack_sent:
+                    self._send_separate_response(req.addr, req.token, RESP_INTERNAL_ERR, {'text': str(e)})
+                elif req.type == TYPE_CON:
+                    self._send_ack(req.addr, req.token, req.msg_id, RESP_INTERNAL_ERR)
+        else:
+            log.info(f"[CoAP] Unhandled: {req.addr} T:{req.type} C:{req.method} P:'{req.path}'")
+
+            if req.type == TYPE_CON: self._send_ack(req.addr, req.token, req.msg_id, RESP_NOT_FOUND)
+
+    # --- Block1 ---
+
+    def _drop_block1(self, key):
+        t = self.partial_blocks.pop(key, None)
+        if t is not None:
+            self.block1_bytes -= t.capacity
+
+    def _send_too_large(self, req):
+        """4.13 with the largest accepted body in Size1."""
+        tx = self._tx.start(TYPE_ACK, RESP_ENTITY_TOO_LARGE, req.msg_id, req.token) \
+            .option_uint(OPT_SIZE1, BLOCK1_MAX_BODY)
+        tx.send(self.sock, req.addr)
+        self._exchanges.store(req.addr, req.msg_id, tx.view[:tx.n])
+
+    async def _block1(self, req):
+        """
+        Take one Block1 block. When the body is complete and the request
+        should be dispatched (req body set), returns the BLOCK1_BUDGET bytes
+        its buffer still holds, the caller releases them after the handler.
+        None when answered here.
+        """
+        num = req.block1 >> 4
+        more = req.block1 & 0x08
+        key = (req.addr, req.path)
+        route_def = req.route
+        t = self.partial_blocks.get(key)
+
+        if num == 0:
+            self._drop_block1(key)  # a restarted upload
+            t = None
+            size1 = req.option_uint(OPT_SIZE1)
+            sink = route_def.get('sink') if route_def else None
+            if sink is None and size1 is not None and size1 > BLOCK1_MAX_BODY:
+                self._send_too_large(req)
+                return None
+            if not more and sink is None:
+                return 0  # the whole body in one block
+            capacity = 0 if sink else min(size1 or BLOCK1_RESERVE, BLOCK1_MAX_BODY)
+            if len(self.partial_blocks) >= BLOCK1_MAX or self.block1_bytes + capacity > BLOCK1_BUDGET:
+                log.warning(f"[CoAP] Block1 upload from {req.addr} rejected: busy")
+                self._send_ack(req.addr, req.token, req.msg_id, RESP_SERVICE_UNAVAILABLE)
+                return None
+            t = self.partial_blocks[key] = _Block1Transfer(capacity, sink)
+            self.block1_bytes += capacity
+        elif t is None or num != t.next_num:
+            self._send_ack(req.addr, req.token, req.msg_id, RESP_ENTITY_INCOMPLETE)
+            return None
+
+        data = req.payload_view
+        end = t.length + len(data)
+        if t.sink is not None:
+            await t.sink(req, t.length, data, bool(more))
+        else:
+            if end > BLOCK1_MAX_BODY:
+                self._drop_block1(key)
+                self._send_too_large(req)
+                return None
+            if end > t.capacity:
+                # no (or a wrong) Size1: grow within the budget
+                capacity = min(max(end, 2 * t.capacity), BLOCK1_MAX_BODY)
+                if self.block1_bytes - t.capacity + capacity > BLOCK1_BUDGET:
+                    self._drop_block1(key)
+                    self._send_too_large(req)
+                    return None
+                self.block1_bytes += capacity - t.capacity
+                t.grow(capacity)
+            t.view[t.length:end] = data
+        t.length = end
+        t.next_num = num + 1
+        t.time = time.time()
+
+        if more:
+            self._send_block_ack(req.addr, req.token, req.msg_id, RESP_CONTINUE, req.block1)
+            return None
+        # the handler reads the reassembled body in place (a sink already consumed
+        # it), the buffer leaves partial_blocks but not the budget
+        del self.partial_blocks[key]
+        req.set_body(memoryview(b'') if t.sink is not None else t.view[:t.length])
+        return t.capacity
+
+    # --- Block2 ---
+
+    def _etag_valid(self, req, etag, max_age):
+        """Answer 2.03 Valid when the request carries etag (the client has it cached)."""
+        for tag in req.options(OPT_ETAG):
+            if bytes(tag) == etag:
+                break
+        else:
+            return False
+        separate = req.ack_sent or req.type != TYPE_CON
+        msg_id = self._next_msg_id() if separate else req.msg_id
+        tx = self._tx.start(TYPE_NON if separate else TYPE_ACK, RESP_VALID, msg_id, req.token) \
+            .option(OPT_ETAG, etag)
+        if max_age is not None:
+            tx.option_uint(OPT_MAX_AGE, max_age)
+        tx.send(self.sock, req.addr)
+        if not separate:
+            self._exchanges.store(req.addr, msg_id, tx.view[:tx.n])
+        return True
 
-        except Exception as e:
-            log.error(f"[CoAP] Parse Error: {e}")
+    def _start_block2(self, req, code, chunks, etag=None, max_age=None):
+        szx = BLOCK2_SZX
+        if req.block2 is not None:
+            szx = min(req.block2 & 0x07, BLOCK2_SZX)  # client asked for smaller blocks
+        cf = None
+        if isinstance(chunks, JsonChunks):
+            cf = CF_JSON
+            if req.accept == CF_CBOR:
+                # same object, encoded incrementally as the blocks are requested
+                chunks, cf = cbor.iter_encode(chunks.obj), CF_CBOR
+        t = _Block2Transfer(chunks, code, szx, cf, etag, max_age)
+        payload, more = t.block(0)
+        if not more:
+            # fits in one block: plain response
+            if req.ack_sent:
+                self._send_separate_response(req.addr, req.token, code, payload, cf,
+                                             etag=etag, max_age=max_age)
+            else:
+                self._send_response_packet(req.addr, req.token, req.msg_id, code, payload,
+                                           cf=cf, etag=etag, max_age=max_age)
+            return
+        key = self._block2_key(req)
+        if key not in self.block2_transfers and len(self.block2_transfers) >= BLOCK2_MAX:
+            oldest = min(self.block2_transfers.items(), key=lambda kv: kv[1].time)[0]
+            del self.block2_transfers[oldest]
+        self.block2_transfers[key] = t
+        self._send_block2(req, t, 0, payload, more)
+
+    @staticmethod
+    def _block2_key(req):
+        # follow-up blocks repeat the request's options (RFC 7959 2.4): two GETs of
+        # a path with another query or Accept are separate transfers
+        return (req.addr, req.path, b'&'.join(bytes(q) for q in req.options(OPT_URI_QUERY)), req.accept)
+
+    def _serve_block2(self, req):
+        num = req.block2 >> 4
+        key = self._block2_key(req)
+        t = self.block2_transfers.get(key)
+        block = t.block(num) if t is not None else None
+        if block is None:
+            if req.type == TYPE_CON: self._send_ack(req.addr, req.token, req.msg_id, RESP_ENTITY_INCOMPLETE)
+            return
+        self._send_block2(req, t, num, block[0], block[1])
+        if not block[1]:
+            del self.block2_transfers[key]
+
+    def _send_block2(self, req, t, num, payload, more):
+        separate = req.ack_sent or req.type != TYPE_CON
+        msg_id = self._next_msg_id() if separate else req.msg_id
+        tx = self._tx.start(TYPE_NON if separate else TYPE_ACK, t.code, msg_id, req.token)
+        if t.etag is not None:
+            tx.option(OPT_ETAG, t.etag)
+        tx.content_format(t.cf)
+        if t.max_age is not None:
+            tx.option_uint(OPT_MAX_AGE, t.max_age)
+        tx.option_uint(OPT_BLOCK2, (num << 4) | (0x08 if more else 0) | t.szx)
+        tx.payload(payload).send(self.sock, req.addr)
+        if not separate:
+            self._exchanges.store(req.addr, msg_id, tx.view[:tx.n])
 
     # --- Helpers ---
 
-    def _send_response_packet(self, addr, token, msg_id, code, payload_data, is_obs=False):
-        """Sends Response. Adds Observe Option if needed for initial ACK."""
-        if isinstance(payload_data, dict): payload = ujson.dumps(payload_data).encode('utf-8')
-        elif isinstance(payload_data, str): payload = payload_data.encode('utf-8')
-        else: payload = payload_data
-
-        h = (1 << 6) | (TYPE_ACK << 4) | (len(token) & 0x0F)
-        header = struct.pack('!BBH', h, code, msg_id)
+    def _next_msg_id(self):
+        self.msg_id = (self.msg_id + 1) % 65535
+        return self.msg_id
 
-        # If this is an Observe response, we should technically add Option 6
-        # But for initial ACK, many clients accept plain data.
-        # Adding minimal Observe option (seq 0) for correctness:
-        opts = b''
+    def _send_response_packet(self, addr, token, msg_id, code, payload_data, is_obs=False,
+                              cf=None, accept=CF_JSON, etag=None, max_age=None):
+        """Sends Response. Adds Observe Option if needed for initial ACK."""
+        payload, encoded_cf = _encode_payload(payload_data, accept)
+        tx = self._tx.start(TYPE_ACK, code, msg_id, token)
+        if etag is not None:
+            tx.option(OPT_ETAG, etag)
         if is_obs:
-            # Option 6 (Observe), Length 0 (Value 0) -> 0x60
-            opts = b'\x60'
-
-        self.sock.sendto(header + token + opts + b'\xFF' + payload, addr)
+            tx.option(OPT_OBSERVE)  # Observe option with seq 0 in the initial ACK
+        tx.content_format(cf or encoded_cf)
+        if max_age is not None:
+            tx.option_uint(OPT_MAX_AGE, max_age)
+        tx.payload(payload).send(self.sock, addr)
+        self._exchanges.store(addr, msg_id, tx.view[:tx.n])
 
     def _send_ack(self, addr, token, msg_id, code):
-        h = (1 << 6) | (TYPE_ACK << 4) | (len(token) & 0x0F)
-        self.sock.sendto(struct.pack('!BBH', h, code, msg_id) + token, addr)
+        tx = self._tx.start(TYPE_ACK, code, msg_id, token)
+        tx.send(self.sock, addr)
+        self._exchanges.store(addr, msg_id, tx.view[:tx.n])
 
-    def _send_separate_response(self, addr, token, code, payload_data):
+    def _send_separate_response(self, addr, token, code, payload_data, cf=None, accept=CF_JSON,
+                                etag=None, max_age=None):
         """Sends a Separate Response (NON) after an Empty ACK was sent."""
-        if payload_data is None: payload_data = b''
-        if isinstance(payload_data, dict): payload = ujson.dumps(payload_data).encode('utf-8')
-        elif isinstance(payload_data, str): payload = payload_data.encode('utf-8')
-        else: payload = payload_data
-
-        self.send_response_raw(addr, token, code, payload)
-
-    def _add_observer(self, path, addr, token):
+        payload, encoded_cf = _encode_payload(payload_data, accept)
+        tx = self._tx.start(TYPE_NON, code, self._next_msg_id(), token)
+        if etag is not None:
+            tx.option(OPT_ETAG, etag)
+        tx.content_format(cf or encoded_cf)
+        if max_age is not None:
+            tx.option_uint(OPT_MAX_AGE, max_age)
+        tx.payload(payload).send(self.sock, addr)
+
+    # --- Observe ---
+
+    def _add_observer(self, path, addr, token, min_interval_ms=OBS_MIN_INTERVAL_MS, accept=CF_JSON):
         if path not in self.observers: self.observers[path] = {}
-        self.observers[path][addr] = token
+        self.observers[path][addr] = _Observer(addr, token, int(min_interval_ms), accept)
+        log.info(f"[CoAP] Observe {path} by {addr}")
+
+    def _remove_observer(self, path, addr):
+        obs = self.observers.get(path)
+        if obs and obs.pop(addr, None):
+            log.info(f"[CoAP] Observe {path} removed {addr}")
+            if not obs: del self.observers[path]
+
+    def _observer_reply(self, addr, msg_id, rst):
+        """ACK of a CON notification clears the liveness check, RST cancels."""
+        for path, obs in list(self.observers.items()):
+            o = obs.get(addr)
+            if o is None:
+                continue
+            if rst and (msg_id == o.last_mid or msg_id == o.con_mid):
+                self._remove_observer(path, addr)
+            elif msg_id == o.con_mid:
+                o.con_mid = -1
+                o.misses = 0
+
+    def has_observers(self, path):
+        return bool(self.observers.get(path))
 
     def notify_observers(self, path, payload_dict):
-        if path not in self.observers or not self.observers[path]: return
+        """
+        Send the new state to the observers of path. An observer notified less
+        than its min interval ago gets the newest state later (observe_task).
+        """
+        obs = self.observers.get(path)
+        if not obs: return
+        payloads = {}  # Content-Format -> payload, encoded once per format
+        self.obs_seq = (self.obs_seq + 1) % 0xFFFFFF  # 24 bit Observe sequence
+        now = time.ticks_ms()
+        for o in obs.values():
+            payload = payloads.get(o.accept)
+            if payload is None:
+                try:
+                    payload = payloads[o.accept] = _encode_payload(payload_dict, o.accept)[0]
+                except Exception as e:
+                    log.error(f"[CoAP] Notify {path}: {e}")
+                    return
+            if time.ticks_diff(now, o.last_ms) >= o.min_interval_ms:
+                self._notify(o, payload, now)
+            else:
+                o.pending = payload
+
+    def _notify(self, o, payload, now):
+        # a CON every OBS_CON_INTERVAL_MS, unless one is still waiting for its ACK
+        con = o.con_mid < 0 and time.ticks_diff(now, o.con_ms) >= OBS_CON_INTERVAL_MS
+        mid = self._next_msg_id()
+        if con:
+            o.con_mid = mid
+            o.con_ms = now
+        o.last_mid = mid
+        o.last_ms = now
+        o.pending = None
+        o.sent += 1
+        self._send_notification(o.addr, o.token, payload, self.obs_seq, mid, con,
+                                CF_CBOR if o.accept == CF_CBOR else CF_JSON)
+
+    def _send_notification(self, addr, token, payload, obs_seq, msg_id=None, con=False, cf=CF_JSON):
+        # Opt 6 (Observe) & Opt 12 (Content-Format)
         try:
-            payload = ujson.dumps(payload_dict).encode('utf-8')
-            self.obs_seq = (self.obs_seq + 1) % 0xFFFFFF
-            obs_val = struct.pack('!H', self.obs_seq & 0xFFFF)
-            for addr, token in self.observers[path].items():
-                self._send_notification(addr, token, payload, obs_val)
-        except: pass
-
-    def _send_notification(self, addr, token, payload, obs_val):
-        h = (1 << 6) | (TYPE_NON << 4) | (len(token) & 0x0F)
-        self.msg_id = (self.msg_id + 1) % 65535
-        # Opt 6 (Observe) & Opt 12 (JSON)
-        pkt = struct.pack('!BBH', h, RESP_CONTENT, self.msg_id) + token + \
-              struct.pack('B', (6<<4)|len(obs_val)) + obs_val + \
-              struct.pack('B', (6<<4)|1) + b'\x32' + \
-              b'\xFF' + payload
-        self.sock.sendto(pkt, addr)
+            self._tx.start(TYPE_CON if con else TYPE_NON, RESP_CONTENT,
+                           self._next_msg_id() if msg_id is None else msg_id, token) \
+                .option_uint(OPT_OBSERVE, obs_seq) \
+                .content_format(cf) \
+                .payload(payload).send(self.sock, addr)
+        except OSError as e:
+            log.warning(f"[CoAP] Notification to {addr}: {e}")
+
+    def _observe_tick(self):
+        """Flush rate limited notifications and drop observers that stopped ACKing."""
+        now = time.ticks_ms()
+        for path, obs in list(self.observers.items()):
+            for addr, o in list(obs.items()):
+                if o.con_mid >= 0 and time.ticks_diff(now, o.con_ms) >= OBS_ACK_TIMEOUT_MS:
+                    o.con_mid = -1
+                    o.misses += 1
+                    if o.misses >= OBS_MAX_MISSES:
+                        log.warning(f"[CoAP] Observer {addr} of {path} timed out")
+                        self._remove_observer(path, addr)
+                        continue
+                if o.pending is not None and time.ticks_diff(now, o.last_ms) >= o.min_interval_ms:
+                    self._notify(o, o.pending, now)
+
+    async def observe_task(self):
+        while True:
+            await asyncio.sleep_ms(OBS_TICK_MS)
+            if self.observers:
+                self._observe_tick()
 
     def send_response(self, data, context):
         try:
             payload = ujson.dumps(data).encode('utf-8')
-            self.msg_id = (self.msg_id + 1) % 65535
             self.send_response_raw(context['addr'], context['token'], RESP_CONTENT, payload)
         except: pass
 
     def send_response_raw(self, addr, token, code, payload):
-        self.msg_id = (self.msg_id + 1) % 65535
-        h = (1 << 6) | (TYPE_NON << 4) | (len(token) & 0x0F)
-        header = struct.pack('!BBH', h, code, self.msg_id)
-        if payload:
-            self.sock.sendto(header + token + b'\xFF' + payload, addr)
-        else:
-            self.sock.sendto(header + token, addr)
+        self._tx.start(TYPE_NON, code, self._next_msg_id(), token).payload(payload).send(self.sock, addr)
 
     def broadcast_presence(self):
         self.transmit('255.255.255.255', 'announce', {"id": "esp32_robot"}, confirmable=False)
 
+    def _build_request(self, mtype, method, msg_id, token, path, payload, accept=None):
+        """Request message in the builder: path/query options, Content-Format, Accept, payload."""
+        if payload is None:
+            payload, cf = b'', None
+        else:
+            payload, cf = _encode_payload(payload)
+        tx = self._tx.start(mtype, method, msg_id, token)
+
+        # Split path and query
+        path_parts = path.split('?', 1)
+        path_root = path_parts[0]
+        query_str = path_parts[1] if len(path_parts) > 1 else ""
+
+        for seg in path_root.strip('/').split('/'):
+            if seg: tx.option(OPT_URI_PATH, seg.encode('utf-8'))
+        if payload:
+            tx.option_uint(OPT_CONTENT_FORMAT, cf)
+        if query_str:
+            for q in query_str.split('&'):
+                tx.option(OPT_URI_QUERY, q.encode('utf-8'))
+        if accept is not None:
+            tx.option_uint(OPT_ACCEPT, accept)
+        return tx.payload(payload)
+
     def transmit(self, ip, path, payload, method=METHOD_POST, confirmable=False, port=COAP_PORT):
+        """Fire-and-forget send, request() waits for the ACK and the response."""
         try:
             log.info(f"[CoAP] TX {CODE_TO_METHOD.get(method, method)} {ip}:{port}/{path}")
-            if isinstance(payload, dict): payload = ujson.dumps(payload).encode('utf-8')
-            elif isinstance(payload, str): payload = payload.encode('utf-8')
             t_type = TYPE_CON if confirmable else TYPE_NON
-            self.msg_id = (self.msg_id + 1) % 65535
-            h = (1 << 6) | (t_type << 4) | 0
-            header = struct.pack('!BBH', h, method, self.msg_id)
-            options = bytearray()
-
-            # Split path and query
-            path_parts = path.split('?', 1)
-            path_root = path_parts[0]
-            query_str = path_parts[1] if len(path_parts) > 1 else ""
-
-            segments = [s for s in path_root.strip('/').split('/') if s]
-            last_opt = 0
-            for seg in segments:
-                delta = 11 - last_opt; last_opt = 11
-                sb = seg.encode('utf-8')
-                options.extend(self._encode_opt_head(delta, len(sb)))
-                options.extend(sb)
-
-            if query_str:
-                queries = query_str.split('&')
-                for q in queries:
-                    delta = 15 - last_opt; last_opt = 15
-                    sb = q.encode('utf-8')
-                    options.extend(self._encode_opt_head(delta, len(sb)))
-                    options.extend(sb)
-
-            if payload:
-                self.sock.sendto(header + options + b'\xFF' + payload, (ip, port))
-            else:
-                self.sock.sendto(header + options, (ip, port))
+            self._build_request(t_type, method, self._next_msg_id(), b'', path, payload) \
+                .send(self.sock, (ip, port))
         except Exception as e:
             log.error(f"[CoAP] Transmit Error: {e}")
 
-    def _encode_opt_head(self, delta, length):
-        b = bytearray()
-        d = 13 if delta >= 13 else delta
-        l = 13 if length >= 13 else length
-        b.append((d << 4) | l)
-        if delta >= 269: b.extend(struct.pack('!H', delta-269))
-        elif delta >= 13: b.append(delta-13)
-        if length >= 269: b.extend(struct.pack('!H', length-269))
-        elif length >= 13: b.append(length-13)
-        return b
+    # --- Client role ---
 
+    def _next_token(self):
+        while True:
+            token = random.getrandbits(32).to_bytes(4, 'big')
+            if token not in self._exchange_tokens:
+                return token
+
+    async def _nstart_acquire(self, addr, deadline):
+        """Take an in-flight slot of addr, asyncio.TimeoutError at deadline (ticks_ms)."""
+        while self._outstanding.get(addr, 0) >= NSTART:
+            remaining = time.ticks_diff(deadline, time.ticks_ms())
+            if remaining <= 0:
+                raise asyncio.TimeoutError
+            event = asyncio.Event()
+            self._nstart_waiters.setdefault(addr, []).append(event)
+            await asyncio.wait_for_ms(event.wait(), remaining)
+        self._outstanding[addr] = self._outstanding.get(addr, 0) + 1
+
+    def _nstart_release(self, addr):
+        n = self._outstanding.get(addr, 1) - 1
+        if n > 0:
+            self._outstanding[addr] = n
+        else:
+            self._outstanding.pop(addr, None)
+        # wake every waiter, one takes the slot and the others wait again
+        # (a cancelled waiter must not swallow the wakeup)
+        for event in self._nstart_waiters.pop(addr, ()):
+            event.set()
+
+    async def _wait_exchange(self, ex, timeout_ms):
+        """True when the exchange was signalled (ACK, RST or response) within timeout_ms."""
+        try:
+            await asyncio.wait_for_ms(ex.event.wait(), timeout_ms)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def request(self, ip, path, payload=None, method=METHOD_POST, confirmable=True,
+                      port=COAP_PORT, timeout=RESPONSE_TIMEOUT_S, accept=None):
+        """
+        Send a request on the server socket and await the response.
+        A CON is retransmitted with exponential backoff until ACKed (RFC 7252
+        4.2); at most NSTART requests are in flight per peer, more wait here.
+        timeout (s) bounds the whole call: the wait for a slot, the
+        retransmissions and the response.
+        Returns (code, data), data decoded by its Content-Format (JSON/CBOR)
+        else bytes, None when empty. Raises asyncio.TimeoutError without ACK
+        or response in time, OSError when the peer resets the exchange.
+        """
+        addr = (ip, port)
+        deadline = time.ticks_add(time.ticks_ms(), int(timeout * 1000))
+        try:
+            await self._nstart_acquire(addr, deadline)
+        except asyncio.TimeoutError:
+            self.client_stats['timeouts'] += 1
+            raise
+        ex = _Exchange(addr, self._next_token(), self._next_msg_id())
+        self.pending_requests[ex.msg_id] = ex
+        self._exchange_tokens[ex.token] = ex
+        self.client_stats['requests'] += 1
+        try:
+            tx = self._build_request(TYPE_CON if confirmable else TYPE_NON, method,
+                                     ex.msg_id, ex.token, path, payload, accept)
+            packet = bytes(tx.view[:tx.n])  # the builder is shared, keep it for retransmissions
+            self.sock.sendto(packet, addr)
+
+            if confirmable:
+                wait_ms = random.randint(ACK_TIMEOUT_MS, int(ACK_TIMEOUT_MS * ACK_RANDOM_FACTOR))
+                retransmits = 0
+                while True:
+                    # every wait is clamped to the deadline
+                    remaining = time.ticks_diff(deadline, time.ticks_ms())
+                    if remaining > 0 and await self._wait_exchange(ex, min(wait_ms, remaining)):
+                        break
+                    if retransmits == MAX_RETRANSMIT or remaining <= wait_ms:
+                        self.client_stats['timeouts'] += 1
+                        raise asyncio.TimeoutError
+                    retransmits += 1
+                    wait_ms *= 2
+                    self.client_stats['retransmissions'] += 1
+                    self.sock.sendto(packet, addr)
+
+            # NON request, or CON with an empty ACK: the response comes separately
+            while ex.code is None and not ex.reset:
+                ex.event.clear()
+                remaining = time.ticks_diff(deadline, time.ticks_ms())
+                if remaining <= 0 or not await self._wait_exchange(ex, remaining):
+                    self.client_stats['timeouts'] += 1
+                    raise asyncio.TimeoutError
+            if ex.reset:
+                self.client_stats['resets'] += 1
+                raise OSError(f"CoAP request {path} reset by {ip}")
+            return ex.code, ex.data
+        finally:
+            self.pending_requests.pop(ex.msg_id, None)
+            self._exchange_tokens.pop(ex.token, None)
+            self._nstart_release(addr)
 
     def _send_block_ack(self, addr, token, msg_id, code, block_val):
-        h = (1 << 6) | (TYPE_ACK << 4) | (len(token) & 0x0F)
-        b_bytes = bytearray()
-        val = block_val
-        while val > 0: b_bytes.insert(0, val & 0xFF); val >>= 8
-        if not b_bytes: b_bytes = b'\x00'
-        opt_head = (13 << 4) | len(b_bytes)
-        packet = struct.pack('!BBH', h, code, msg_id) + token + \
-                 struct.pack('B', opt_head) + b'\x0E' + b_bytes
-        self.sock.sendto(packet, addr)
\ No newline at end of file
+        tx = self._tx.start(TYPE_ACK, code, msg_id, token).option_uint(OPT_BLOCK1, block_val)
+        tx.send(self.sock, addr)
+        self._exchanges.store(addr, msg_id, tx.view[:tx.n])
+
+    def stats(self):
+        """Server counters for /app/coap/stats."""
+        return {'workers': self.active_workers, 'max_workers': self.max_workers,
+                'queued': self.queued, 'queue_timeouts': self.queue_timeouts,
+                'urgent': self.urgent_active, 'urgent_served': self.urgent_served,
+                'rate': self.client_rate, 'burst': self.client_burst,
+                'clients': {ip: {'active': c.active, 'queued': len(c.queue), 'tokens': c.tokens,
+                                 'limited': c.limited, 'rejected': c.rejected}
+                            for ip, c in self.clients.items()},
+                'routes': {path: r['active'] for routes in (self.routes, self.param_routes)
+                           for path, r in routes.items() if r['max_concurrency']},
+                'observers': {path: len(obs) for path, obs in self.observers.items()},
+                'partial_blocks': len(self.partial_blocks),
+                'dedup': self._exchanges.stats(),
+                'client': dict(self.client_stats, outstanding=len(self.pending_requests))}
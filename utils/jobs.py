@@ -0,0 +1,218 @@
+# Asynchronous jobs: long robot operations (us_scan, calibrations) as CoAP
+# resources, so no worker slot is held while they run.
+#
+#   POST /app/jobs {'topic': 'us_scan', 'payload': {...}, 'reply_topic': 'us_scan_report',
+#                   'reply_timeout': 120, 'priority': 0}
+#       -> 2.01 {'id': 3, 'state': 'running', ...} at once
+#   GET /app/jobs             all jobs (Observe: 0 pushes every change)
+#   GET /app/jobs?id=3        one job with its partial results and result
+#   DELETE /app/jobs?id=3     cancel
+#
+# A job is a MessageBus request (utils/messagebus.py) run in its own asyncio
+# task. The request carries JOB_ID; the task doing the work reports progress
+# with report_progress() and stops early when is_cancelled() says so. Tasks
+# that do neither still run as jobs, they only report start and end.
+import uasyncio as asyncio
+import time
+import utils.t_logger as t_logger
+from utils.messagebus import Publisher, Subscriber, check_priority, check_timeout, PRIORITY_NORMAL
+from utils.coap_server import (
+    METHOD_GET, METHOD_DELETE,
+    RESP_CONTENT, RESP_CREATED, RESP_DELETED, RESP_BAD_REQ, RESP_NOT_FOUND,
+    RESP_SERVICE_UNAVAILABLE,
+)
+
+log = t_logger.get_logger()
+
+JOBS_PATH = '/app/jobs'
+JOB_PROGRESS = 'job_progress'  # bus topic of the progress reports
+JOB_ID = 'job_id'              # key added to the request message of a job
+MAX_RUNNING = 4
+MAX_KEPT = 8                   # finished jobs kept for polling, oldest dropped first
+MAX_PARTIAL = 64               # partial results kept per job
+DEFAULT_TIMEOUT_S = 120
+
+RUNNING = 'running'; DONE = 'done'; FAILED = 'failed'; CANCELLED = 'cancelled'
+
+_cancelled = set()  # ids of cancelled jobs still known to the manager
+
+
+def report_progress(publisher, request, progress, partial=None):
+    """
+    Progress of the job that sent request (a bus message), no-op when the
+    request is not a job. progress: 0..1, partial: optional partial result.
+    """
+    if isinstance(request, dict) and JOB_ID in request:
+        publisher.publish(JOB_PROGRESS, {JOB_ID: request[JOB_ID], 'progress': progress,
+                                         'partial': partial})
+
+
+def is_cancelled(request):
+    """True when the job that sent request was cancelled, the task should stop."""
+    return isinstance(request, dict) and request.get(JOB_ID) in _cancelled
+
+
+class Job:
+    __slots__ = ('id', 'topic', 'state', 'progress', 'partial', 'result', 'error',
+                 'created_ms', 'ended_ms', 'task')
+
+    def __init__(self, job_id, topic):
+        self.id = job_id
+        self.topic = topic
+        self.state = RUNNING
+        self.progress = 0
+        self.partial = []
+        self.result = None
+        self.error = None
+        self.created_ms = time.ticks_ms()
+        self.ended_ms = None
+        self.task = None
+
+    def summary(self):
+        end = self.ended_ms if self.ended_ms is not None else time.ticks_ms()
+        return {'id': self.id, 'topic': self.topic, 'state': self.state,
+                'progress': self.progress, 'partial': len(self.partial),
+                'elapsed_ms': time.ticks_diff(end, self.created_ms), 'error': self.error}
+
+    def details(self):
+        ret = self.summary()
+        ret['partial'] = self.partial
+        ret['result'] = self.result
+        return ret
+
+
+class Jobs:
+    """Job manager serving JOBS_PATH on server."""
+
+    def __init__(self, server):
+        self.server = server
+        self.jobs = {}  # id -> Job, in creation order
+        self._next_id = 0
+        self.publisher = Publisher('jobs')
+        self.sub = Subscriber('jobs', topics=JOB_PROGRESS)
+        server.route(JOBS_PATH, ('GET', 'POST', 'DELETE'))(self._handler)
+
+    def running(self):
+        return sum(1 for job in self.jobs.values() if job.state == RUNNING)
+
+    def start(self, topic, payload=None, reply_topic=None, timeout=DEFAULT_TIMEOUT_S,
+              priority=PRIORITY_NORMAL):
+        """
+        Start a job, None when MAX_RUNNING jobs are running already.
+        Raises ValueError when payload is not a dict.
+        """
+        if payload and not isinstance(payload, dict):
+            raise ValueError('Job payload must be an object')
+        if self.running() >= MAX_RUNNING:
+            return None
+        self._next_id += 1
+        job = Job(self._next_id, topic)
+        self.jobs[job.id] = job
+        self._evict()
+        message = dict(payload) if payload else {}
+        message[JOB_ID] = job.id
+        job.task = asyncio.create_task(self._run(job, message, reply_topic, timeout, priority))
+        log.info(f'[Jobs] {job.id} started: {topic}')
+        self._changed()
+        return job
+
+    def cancel(self, job):
+        """Cancel a running job: its task sees is_cancelled(), the wait ends now."""
+        if job.state != RUNNING:
+            return False
+        _cancelled.add(job.id)
+        job.task.cancel()
+        job.state = CANCELLED  # _run() ends with the same state
+        return True
+
+    async def _run(self, job, message, reply_topic, timeout, priority):
+        try:
+            _, _, reply = await self.publisher.request(job.topic, message, timeout=timeout,
+                                                       reply_topic=reply_topic, priority=priority)
+            job.result = reply
+            job.progress = 1
+            job.state = DONE
+        except asyncio.CancelledError:
+            job.state = CANCELLED
+        except asyncio.TimeoutError:
+            job.state = FAILED
+            job.error = 'timeout'
+        except Exception as e:
+            job.state = FAILED
+            job.error = str(e)
+        job.ended_ms = time.ticks_ms()
+        job.task = None
+        log.info(f'[Jobs] {job.id} {job.state}')
+        self._changed()
+
+    def _evict(self):
+        """Drop the oldest finished jobs beyond MAX_KEPT."""
+        for job_id in list(self.jobs):
+            if len(self.jobs) <= MAX_KEPT:
+                break
+            if self.jobs[job_id].state != RUNNING:
+                del self.jobs[job_id]
+                _cancelled.discard(job_id)
+
+    def _list(self):
+        return [job.summary() for job in self.jobs.values()]
+
+    def _changed(self):
+        # observers get the whole (small) list: a conflated notification loses nothing
+        if self.server.has_observers(JOBS_PATH):
+            self.server.notify_observers(JOBS_PATH, self._list())
+
+    def _job(self, req):
+        job_id = req.query.get('id')
+        return self.jobs.get(job_id) if isinstance(job_id, int) else None
+
+    async def _handler(self, req):
+        if req.method == METHOD_GET:
+            if 'id' not in req.query:
+                return RESP_CONTENT, self._list()
+            job = self._job(req)
+            if job is None:
+                return RESP_NOT_FOUND, {'text': "No such job"}
+            return RESP_CONTENT, job.details()
+
+        if req.method == METHOD_DELETE:
+            job = self._job(req)
+            if job is None:
+                return RESP_NOT_FOUND, {'text': "No such job"}
+            self.cancel(job)
+            return RESP_DELETED, job.summary()
+
+        data = req.json
+        if not data or 'topic' not in data:
+            return RESP_BAD_REQ, {'text': "Missing topic"}
+        try:
+            job = self.start(data['topic'], data.get('payload'), data.get('reply_topic'),
+                             check_timeout(data.get('reply_timeout', DEFAULT_TIMEOUT_S)),
+                             check_priority(data.get('priority', PRIORITY_NORMAL)))
+        except ValueError as e:
+            return RESP_BAD_REQ, {'text': str(e)}
+        if job is None:
+            return RESP_SERVICE_UNAVAILABLE, {'text': f"{MAX_RUNNING} jobs running"}
+        return RESP_CREATED, job.summary()
+
+    async def run(self):
+        """Collect the progress reports of the running jobs."""
+        while True:
+            changed = False
+            for _, _, message in await self.sub.get_many():
+                job = self.jobs.get(message.get(JOB_ID))
+                if job is None or job.state != RUNNING:
+                    continue
+                job.progress = message.get('progress', job.progress)
+                partial = message.get('partial')
+                if partial is not None:
+                    if len(job.partial) >= MAX_PARTIAL:
+                        job.partial.pop(0)
+                    job.partial.append(partial)
+                changed = True
+            if changed:
+                self._changed()
+
+
+async def jobs_task(server):
+    await Jobs(server).run()
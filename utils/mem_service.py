@@ -0,0 +1,181 @@
+# Memory service: adaptive GC and heap telemetry.
+#
+# - gc.threshold() makes the allocator collect by itself after a budget of
+#   allocations, instead of only when the heap is exhausted (long pauses).
+# - An idle task collects early while the event loop has nothing to do
+#   (measured by its own wakeup lag), so collections seldom hit a request.
+# - Samples of the MicroPython GC heap (gc.mem_free) and of the ESP-IDF heap
+#   (free, largest free block and fragmentation from esp32.idf_heap_info) are
+#   kept in a small ring for trends, with alert thresholds. The two heaps are
+#   separate pools and are never added up.
+# Served on /app/mem (app/__init__.py).
+import gc
+import time
+import esp32
+import uasyncio as asyncio
+import utils.t_logger as t_logger
+
+log = t_logger.get_logger()
+
+IDLE_PERIOD_MS = 100       # idle task wakeup period
+IDLE_LAG_MS = 5            # wakeup later than this -> the loop is busy, do not collect
+COLLECT_BYTES = 16 * 1024  # collect at idle once this much was allocated since the last collect
+COLLECT_MAX_MS = 5_000     # ... or at least this often while idle
+SAMPLE_MS = 10_000         # trend sample period
+N_SAMPLES = 30             # 5 minutes of trend
+
+# Alert thresholds, changed at runtime via MemService.set_alerts()
+# free_min: GC heap free, idf_free_min / largest_min / frag_max: ESP-IDF heap
+DEFAULT_ALERTS = {'free_min': 16 * 1024, 'idf_free_min': 16 * 1024, 'largest_min': 8 * 1024,
+                  'frag_max': 0.6}
+
+
+def _idf_heap():
+    """(free, largest free block) over the ESP-IDF data heaps."""
+    try:
+        heaps = esp32.idf_heap_info(esp32.HEAP_DATA)
+    except Exception:
+        return 0, 0
+    free = 0
+    largest = 0
+    for heap in heaps:
+        free += heap[1]
+        if heap[2] > largest:
+            largest = heap[2]
+    return free, largest
+
+
+class MemService:
+    _instance = None
+
+    @classmethod
+    def instance(cls):
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def __init__(self):
+        self.alerts = dict(DEFAULT_ALERTS)
+        self.threshold = -1
+        self.collections = 0
+        self.collect_us_total = 0
+        self.collect_us_max = 0
+        self.busy_skips = 0
+        self.samples = []  # ring of (ticks_ms, gc free, idf free, idf largest, idf frag)
+        self._sample_i = 0
+        self.active_alerts = []
+        self._alloc_after_collect = gc.mem_alloc()
+        self._last_collect_ms = time.ticks_ms()
+
+    def set_threshold(self, nbytes=None):
+        """
+        gc.threshold() in bytes. None: a quarter of the free GC heap, the
+        usual MicroPython recommendation. -1 disables it.
+        """
+        if nbytes is None:
+            nbytes = gc.mem_free() // 4
+        gc.threshold(nbytes)
+        self.threshold = nbytes
+        log.info(f'[Mem] gc.threshold {nbytes}')
+
+    def set_alerts(self, **kwargs):
+        for key, value in kwargs.items():
+            if key in self.alerts and value is not None:
+                self.alerts[key] = value
+
+    def collect(self):
+        t0 = time.ticks_us()
+        gc.collect()
+        dt = time.ticks_diff(time.ticks_us(), t0)
+        self.collections += 1
+        self.collect_us_total += dt
+        if dt > self.collect_us_max:
+            self.collect_us_max = dt
+        self._alloc_after_collect = gc.mem_alloc()
+        self._last_collect_ms = time.ticks_ms()
+
+    def _measure(self):
+        """
+        (ticks_ms, gc free, idf free, idf largest, idf frag) now,
+        idf frag = 1 - largest block / IDF free.
+        """
+        idf_free, largest = _idf_heap()
+        frag = 1 - largest / idf_free if idf_free else 0
+        return time.ticks_ms(), gc.mem_free(), idf_free, largest, round(frag, 3)
+
+    def sample(self):
+        """Take a heap sample, update the trend ring and the alerts."""
+        entry = self._measure()
+        _, free, idf_free, largest, frag = entry
+        if len(self.samples) < N_SAMPLES:
+            self.samples.append(entry)
+        else:
+            self.samples[self._sample_i] = entry
+        self._sample_i = (self._sample_i + 1) % N_SAMPLES
+
+        alerts = []
+        if free < self.alerts['free_min']:
+            alerts.append('free_min')
+        if idf_free and idf_free < self.alerts['idf_free_min']:
+            alerts.append('idf_free_min')
+        if largest and largest < self.alerts['largest_min']:
+            alerts.append('largest_min')
+        if frag > self.alerts['frag_max']:
+            alerts.append('frag_max')
+        for name in alerts:
+            if name not in self.active_alerts:
+                log.warning(f'[Mem] Alert {name}: gc free {free}, idf free {idf_free}, '
+                            f'largest {largest}, frag {frag:.2f}')
+        self.active_alerts = alerts
+        return entry
+
+    def _ordered_samples(self):
+        if len(self.samples) < N_SAMPLES:
+            return self.samples
+        return self.samples[self._sample_i:] + self.samples[:self._sample_i]
+
+    def stats(self):
+        """Current heap state, GC counters, trend and alerts (for /app/mem)."""
+        now = self._measure()
+        samples = self._ordered_samples() or [now]
+        first = samples[0]
+        return {'gc': {'free': now[1], 'alloc': gc.mem_alloc()},
+                'idf': {'free': now[2], 'largest': now[3], 'frag': now[4]},
+                'threshold': self.threshold,
+                'collections': self.collections, 'busy_skips': self.busy_skips,
+                'collect_us_max': self.collect_us_max,
+                'collect_us_avg': self.collect_us_total // max(self.collections, 1),
+                # change over the sampled window, negative = leaking / fragmenting
+                'trend': {'window_ms': time.ticks_diff(now[0], first[0]),
+                          'gc_free': now[1] - first[1], 'idf_free': now[2] - first[2],
+                          'idf_largest': now[3] - first[3],
+                          'min_gc_free': min(s[1] for s in samples),
+                          'min_idf_free': min(s[2] for s in samples),
+                          'min_idf_largest': min(s[3] for s in samples)},
+                'alerts': self.active_alerts, 'thresholds': self.alerts}
+
+    async def run(self):
+        """Idle time collector and periodic sampler."""
+        self.sample()
+        last_sample = time.ticks_ms()
+        while True:
+            t0 = time.ticks_ms()
+            await asyncio.sleep_ms(IDLE_PERIOD_MS)
+            now = time.ticks_ms()
+            lag = time.ticks_diff(now, t0) - IDLE_PERIOD_MS
+            allocated = gc.mem_alloc() - self._alloc_after_collect
+            if allocated > COLLECT_BYTES or (
+                    allocated > 0 and time.ticks_diff(now, self._last_collect_ms) > COLLECT_MAX_MS):
+                if lag <= IDLE_LAG_MS:
+                    self.collect()
+                else:
+                    self.busy_skips += 1  # gc.threshold still bounds the heap growth
+            if time.ticks_diff(now, last_sample) >= SAMPLE_MS:
+                last_sample = now
+                self.sample()
+
+
+async def mem_task(threshold=None):
+    service = MemService.instance()
+    service.set_threshold(threshold)
+    await service.run()
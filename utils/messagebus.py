@@ -1,4 +1,12 @@
 # messagebus.py
+#
+# Topics are hierarchical, levels are separated by '/' (e.g. 'report/ahrs').
+# Subscriptions may use MQTT style wildcards:
+#   '+' matches exactly one level   'report/+'  -> 'report/ahrs', 'report/us'
+#   '#' matches any remaining levels (last level only)  'report/#', '#'
+# Plain names such as 'ahrs_report' are single level topics.
+import gc
+import time
 import uasyncio as asyncio
 import utils.t_logger as t_logger
 log = t_logger.get_logger()
@@ -15,75 +23,320 @@ class QueueFull(Exception):
     pass
 
 
+# Overflow policies (what put_nowait does when the queue is full)
+OVERFLOW_BLOCK = 0        # raise QueueFull, put() waits for a free slot
+OVERFLOW_DROP_OLDEST = 1  # overwrite the oldest queued item
+OVERFLOW_DROP_NEWEST = 2  # discard the incoming item
+OVERFLOW_GROW = 3         # double the full lane up to MAX_QUEUE_SIZE, then drop the newest
+
+DEFAULT_QUEUE_SIZE = 16
+MAX_QUEUE_SIZE = 128      # hard cap of a growing lane: a stalled consumer can not take the heap
+
+# Message priorities, each maps to its own queue lane (see Queue lanes)
+PRIORITY_NORMAL = 0
+PRIORITY_HIGH = 1
+PRIORITY_URGENT = 2  # stop / emergency commands
+
+MAX_REQUEST_TIMEOUT_S = 300  # longest reply wait a remote caller may ask for
+
+
+def check_priority(priority):
+    """priority (e.g. from a request) as an int PRIORITY_NORMAL..PRIORITY_URGENT, else ValueError."""
+    try:
+        ret = int(priority)
+    except (TypeError, ValueError):
+        ret = -1
+    if not PRIORITY_NORMAL <= ret <= PRIORITY_URGENT:
+        raise ValueError('Bad priority %r' % (priority,))
+    return ret
+
+
+def check_timeout(timeout, max_s=MAX_REQUEST_TIMEOUT_S):
+    """Request timeout (s) as a float, 0 < timeout <= max_s, else ValueError."""
+    try:
+        ret = float(timeout)
+    except (TypeError, ValueError):
+        ret = 0
+    if not 0 < ret <= max_s:
+        raise ValueError('Bad timeout %r' % (timeout,))
+    return ret
+
+
+# Upper bounds [us] of the publish -> get latency histogram bins,
+# the last bin counts everything above the last bound
+LATENCY_BOUNDS_US = (100, 1_000, 10_000, 100_000, 1_000_000)
+
+
+class _Lane:
+    """One priority lane of a Queue, a preallocated ring buffer."""
+    __slots__ = ('items', 'stamps', 'head', 'count')
+
+    def __init__(self, size):
+        self.items = [None] * size
+        self.stamps = [0] * size
+        self.head = 0
+        self.count = 0
+
+
 class Queue:
-    def __init__(self, maxsize=0):
-        self.maxsize = maxsize
-        self._items = []
-        self._get_waiters = []
-        self._put_waiters = []
+    """
+    Fixed capacity circular buffer queue.
+    The slots are preallocated at creation so put/get never allocate, and
+    the get/put waiters share one reusable Event each instead of a new
+    Event per wait.
+    maxsize <= 0 falls back to DEFAULT_QUEUE_SIZE. With OVERFLOW_GROW a full
+    lane doubles (allocating only then) up to MAX_QUEUE_SIZE slots, past that
+    the newest item is dropped and counted like with OVERFLOW_DROP_NEWEST.
+    lanes > 1 gives every priority (PRIORITY_xxx) its own ring of maxsize
+    slots, get() always serves the highest non empty lane first so urgent
+    items never wait behind a backlog. Priorities above the last lane use
+    the last lane.
+    Every item is stamped with ticks_us() on put, get() adds its queueing
+    latency to latency_hist (bins per LATENCY_BOUNDS_US).
+    """
+    __slots__ = ('maxsize', 'overflow', 'dropped', 'high_water', 'latency_hist',
+                 'latency_max', '_lanes', '_count', '_get_event', '_put_event')
 
-    def full(self):
-        return self.maxsize > 0 and len(self._items) >= self.maxsize
+    def __init__(self, maxsize=DEFAULT_QUEUE_SIZE, overflow=OVERFLOW_BLOCK, lanes=1):
+        if maxsize <= 0:
+            maxsize = DEFAULT_QUEUE_SIZE
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self._init_stats()
+        self._lanes = [_Lane(maxsize) for _ in range(max(lanes, 1))]
+        self._count = 0
+        self._get_event = asyncio.Event()
+        self._put_event = asyncio.Event()
+
+    def _init_stats(self):
+        self.dropped = 0
+        self.high_water = 0
+        self.latency_hist = [0] * (len(LATENCY_BOUNDS_US) + 1)
+        self.latency_max = 0
+
+    def _record_latency(self, stamp):
+        latency = time.ticks_diff(time.ticks_us(), stamp)
+        if latency > self.latency_max:
+            self.latency_max = latency
+        i = 0
+        for bound in LATENCY_BOUNDS_US:
+            if latency < bound:
+                break
+            i += 1
+        self.latency_hist[i] += 1
+
+    def _lane(self, priority):
+        lanes = self._lanes
+        if priority <= 0:
+            return lanes[0]
+        return lanes[priority] if priority < len(lanes) else lanes[-1]
+
+    def full(self, priority=PRIORITY_NORMAL):
+        lane = self._lane(priority)
+        return lane.count >= len(lane.items)
 
     def empty(self):
-        return len(self._items) == 0
+        return self._count == 0
 
-    async def put(self, item):
-        while self.full():
-            event = asyncio.Event()
-            self._put_waiters.append(event)
-            await event.wait()
+    def qsize(self):
+        return self._count
 
-        self._items.append(item)
-
-        # notify get waiters
-        self._notify_get_waiters()
+    async def put(self, item, priority=PRIORITY_NORMAL):
+        if self.overflow == OVERFLOW_BLOCK:
+            while self.full(priority):
+                self._put_event.clear()
+                await self._put_event.wait()
+        self.put_nowait(item, priority)
 
     async def get(self, timeout=None):
-        if timeout is not None and timeout != 0:
+        if timeout is None:
+            await self._wait_for_item()
+        elif timeout != 0 and self._count == 0:
             try:
                 await asyncio.wait_for(self._wait_for_item(), timeout)
             except asyncio.TimeoutError:
                 raise QueueEmpty("Queue get timed out")
-        elif timeout is None:
-            await self._wait_for_item()
-        try:
-            item = self._items.pop(0)
-            # Notify put waiters if an item was successfully retrieved
-            # This was moved from the previous diff, ensuring it's called after item retrieval.
-            self._notify_put_waiters()
-        except IndexError:
-            raise QueueEmpty
-        return item
+        return self.get_nowait()
+
+    async def get_many(self, max_n=DEFAULT_QUEUE_SIZE, timeout=None):
+        """
+        Wait like get() for at least one item, then return a list of up to
+        max_n queued items so a burst costs a single wakeup.
+        """
+        items = [await self.get(timeout)]
+        while len(items) < max_n and self._count:
+            items.append(self.get_nowait())
+        return items
 
     def get_nowait(self):
-        """Return next item if available, else raise exception."""
-        if self.empty():
-            raise asyncio.QueueEmpty  # compatible with CPython asyncio
-        return self._items.pop(0)
+        """Return next item (highest priority first) if available, else raise QueueEmpty."""
+        if self._count == 0:
+            raise QueueEmpty
+        lanes = self._lanes
+        i = len(lanes) - 1
+        while lanes[i].count == 0:
+            i -= 1
+        lane = lanes[i]
+        head = lane.head
+        item = lane.items[head]
+        lane.items[head] = None  # release the reference for the GC
+        self._record_latency(lane.stamps[head])
+        lane.head = (head + 1) % len(lane.items)
+        lane.count -= 1
+        self._count -= 1
+        # wake a blocked put()
+        self._put_event.set()
+        return item
 
-    def put_nowait(self, item):
-        if self.full():
-            raise QueueFull
-        self._items.append(item)
-        self._notify_get_waiters()
+    def put_nowait(self, item, priority=PRIORITY_NORMAL):
+        """
+        Queue an item according to the overflow policy.
+        Returns False if the item was dropped (OVERFLOW_DROP_NEWEST, a grown lane at its cap).
+        """
+        queued = self._put(item, priority)
+        # wake the get() waiters
+        self._get_event.set()
+        return queued
+
+    def put_many_nowait(self, items, priority=PRIORITY_NORMAL):
+        """
+        Queue a batch of items with a single wakeup of the get() waiters.
+        Returns the number of items queued (dropped ones excluded).
+        Raises QueueFull (OVERFLOW_BLOCK) after queueing what fitted.
+        """
+        queued = 0
+        try:
+            for item in items:
+                if self._put(item, priority):
+                    queued += 1
+        finally:
+            if queued:
+                self._get_event.set()
+        return queued
+
+    def _put(self, item, priority=PRIORITY_NORMAL):
+        """Store one item in its priority lane without waking the waiters."""
+        lane = self._lane(priority)
+        size = len(lane.items)
+        if lane.count >= size:
+            if self.overflow == OVERFLOW_GROW and size < MAX_QUEUE_SIZE:
+                self._grow(lane)
+                size = len(lane.items)
+            elif self.overflow == OVERFLOW_BLOCK:
+                raise QueueFull
+            else:
+                self.dropped += 1
+                if self.overflow != OVERFLOW_DROP_OLDEST:
+                    return False  # OVERFLOW_DROP_NEWEST, or a grown lane at its cap
+                # OVERFLOW_DROP_OLDEST: free the lane head slot
+                lane.items[lane.head] = None
+                lane.head = (lane.head + 1) % size
+                lane.count -= 1
+                self._count -= 1
+        tail = (lane.head + lane.count) % size
+        lane.items[tail] = item
+        lane.stamps[tail] = time.ticks_us()
+        lane.count += 1
+        self._count += 1
+        if self._count > self.high_water:
+            self.high_water = self._count
+        return True
+
+    @staticmethod
+    def _grow(lane):
+        """Double a full lane, the queued items move to the front in order."""
+        size = len(lane.items)
+        order = [(lane.head + i) % size for i in range(lane.count)]
+        lane.items = [lane.items[i] for i in order] + [None] * size
+        lane.stamps = [lane.stamps[i] for i in order] + [0] * size
+        lane.head = 0
 
     async def _wait_for_item(self):
         """Internal helper to wait for an item to be available."""
-        while self.empty():
-            event = asyncio.Event()
-            self._get_waiters.append(event)
-            await event.wait()
-
-    def _notify_get_waiters(self):
-        """Internal helper to notify waiting getters."""
-        if self._get_waiters:
-            self._get_waiters.pop(0).set()
-
-    def _notify_put_waiters(self):
-        """Internal helper to notify waiting putters."""
-        if self._put_waiters:
-            self._put_waiters.pop(0).set()
+        while self._count == 0:
+            self._get_event.clear()
+            await self._get_event.wait()
+
+
+class ConflatingQueue(Queue):
+    """
+    Latest value only queue, one slot per topic.
+    A message published while an older one of the same topic is still queued
+    overwrites it in place (counted in dropped), so a slow consumer always
+    gets the freshest sample and the memory is bounded by the topic count.
+    Items are (topic, sender_id, message) tuples as pushed by Subscriber.
+    Only plain messages are conflated: requests (REPLY_ID, they wait for a
+    reply) and messages above PRIORITY_NORMAL are queued in full, the
+    prioritised ones are served first, highest priority first.
+    """
+    __slots__ = ('_slots', '_stamps', '_order', '_priority')
+
+    def __init__(self):
+        self.maxsize = 0
+        self.overflow = OVERFLOW_DROP_OLDEST
+        self._init_stats()
+        self._slots = {}     # topic -> pending item or None
+        self._stamps = {}    # topic -> ticks_us() of the pending item
+        self._order = []     # topics holding a pending item or kept requests, oldest first
+        self._priority = []  # kept (priority, stamp, item) above PRIORITY_NORMAL, highest first
+        self._count = 0
+        self._get_event = asyncio.Event()
+        self._put_event = asyncio.Event()
+
+    def full(self, priority=PRIORITY_NORMAL):
+        return False
+
+    def get_nowait(self):
+        """Return the oldest pending topic's latest item, else raise QueueEmpty."""
+        if self._count == 0:
+            raise QueueEmpty
+        self._count -= 1
+        entry = self._priority.pop(0) if self._priority else self._order.pop(0)
+        if isinstance(entry, tuple):
+            # kept request or prioritised message
+            self._record_latency(entry[1])
+            return entry[2]
+        item = self._slots[entry]
+        self._slots[entry] = None  # keep the slot, drop the reference
+        self._record_latency(self._stamps[entry])
+        return item
+
+    def _put(self, item, priority=PRIORITY_NORMAL):
+        message = item[2]
+        if priority > PRIORITY_NORMAL or (isinstance(message, dict) and REPLY_ID in message):
+            self._keep(item, priority)
+            return True
+        topic = item[0]
+        self._stamps[topic] = time.ticks_us()
+        if self._slots.get(topic) is not None:
+            # overwrite the stale sample in place
+            self._slots[topic] = item
+            self.dropped += 1
+            return True
+        self._slots[topic] = item
+        self._order.append(topic)
+        self._count_one()
+        return True
+
+    def _keep(self, item, priority):
+        """Queue an item that must not be overwritten."""
+        entry = (priority, time.ticks_us(), item)
+        if priority <= PRIORITY_NORMAL:
+            self._order.append(entry)
+        else:
+            kept = self._priority
+            i = 0
+            while i < len(kept) and kept[i][0] >= priority:
+                i += 1
+            kept.insert(i, entry)
+        self._count_one()
+
+    def _count_one(self):
+        self._count += 1
+        if self._count > self.high_water:
+            self.high_water = self._count
+
+
 # -------------------------------
 # Subscriber
 # -------------------------------
@@ -91,34 +344,102 @@ class Subscriber:
     """
     Each subscriber has ONE queue and can subscribe to multiple topics.
     Messages arrive as: (topic: str, sender_id: str, message: any)
+    The queue is preallocated for maxsize messages and by default grows past
+    it up to MAX_QUEUE_SIZE (OVERFLOW_GROW), so a burst of commands is not
+    lost while a stalled consumer still can not take the whole heap; past the
+    cap new messages are dropped and counted in dropped. Streams that may lose
+    messages opt in with another overflow policy (OVERFLOW_xxx) or with
+    conflate=True, which keeps only the latest message of each topic (see
+    ConflatingQueue), for telemetry where only the newest value matters.
+    lanes > 1 serves higher priority messages first (see Queue).
+    The message tuple may be shared with the other subscribers of the topic.
+    The bus keeps a reference to every subscribed Subscriber, so __del__ does
+    not run while subscribed: call close() or use it as a context manager
+        with Subscriber('scan', topics='us_report') as sub:
+            ...
     """
-    def __init__(self, subscriber_id=None, topics=None, queue=None):
+    __slots__ = ('id', 'queue', 'bus', 'topics', 'created_ms', 'last_get_ms')
+
+    def __init__(self, subscriber_id=None, topics=None, queue=None,
+                 maxsize=DEFAULT_QUEUE_SIZE, overflow=OVERFLOW_GROW, conflate=False,
+                 lanes=1):
         self.id = f'' if subscriber_id is None else subscriber_id
 #         self.queue = asyncio.Queue() if queue is None else queue
-        self.queue = Queue() if queue is None else queue
+        if queue is None:
+            queue = ConflatingQueue() if conflate else Queue(maxsize, overflow, lanes)
+        self.queue = queue
         self.bus = MessageBus.instance()
+        self.topics = []  # own subscriptions (reverse index of the bus)
+        self.created_ms = self.last_get_ms = time.ticks_ms()
         if topics and isinstance(topics, str):
             topics = [topics]
         if topics:
             for t in topics:
                 self.bus.subscribe(self, t)
 
-    def _push(self, topic, sender_id, message):
-        """Internal: message injection."""
-        self.queue.put_nowait((topic, sender_id, message))
+    def _push(self, envelope, priority=PRIORITY_NORMAL):
+        """Internal: message injection, envelope is (topic, sender_id, message)."""
+        try:
+            self.queue.put_nowait(envelope, priority)
+        except QueueFull:
+            # the bus publish is synchronous, a blocking queue can not wait here
+            self.queue.dropped += 1
+            log.warning('Subscriber %s queue full, dropped %s' % (self.id, envelope[0]))
+
+    def _push_many(self, envelopes, priority=PRIORITY_NORMAL):
+        """Internal: batch injection with a single wakeup."""
+        queue = self.queue
+        depth = queue.qsize()
+        try:
+            queue.put_many_nowait(envelopes, priority)
+        except QueueFull:
+            # everything after the first rejected message is lost
+            lost = len(envelopes) - (queue.qsize() - depth)
+            queue.dropped += lost
+            log.warning('Subscriber %s queue full, dropped %d %s' % (self.id, lost, envelopes[0][0]))
 
     async def get(self, timeout=None):
         """Wait for next message from ANY subscribed topic."""
         ret = await self.queue.get(timeout=timeout)
-        log.debug('Subscribe %s get: %s' % (self.id ,ret))
+        self.last_get_ms = time.ticks_ms()
+        if log.is_enabled(t_logger.DEBUG):
+            log.debug('Subscribe %s get: %s' % (self.id ,ret))
+        return ret
+
+    async def get_many(self, max_n=DEFAULT_QUEUE_SIZE, timeout=None):
+        """
+        Wait for at least one message, then return a list with everything
+        queued (up to max_n) so a task can coalesce the work of a burst.
+        Raises QueueEmpty on timeout like get().
+        """
+        ret = await self.queue.get_many(max_n, timeout=timeout)
+        self.last_get_ms = time.ticks_ms()
+        if log.is_enabled(t_logger.DEBUG):
+            log.debug('Subscribe %s get_many: %s' % (self.id, ret))
         return ret
 
     def get_nowait(self):
         """Get message if available, else return None."""
+        self.last_get_ms = time.ticks_ms()
         if not self.queue.empty():
             return self.queue.get_nowait()
         return None
 
+    @property
+    def dropped(self):
+        """Number of messages dropped or overwritten before they were read."""
+        return self.queue.dropped
+
+    def stats(self):
+        """Queue telemetry: current and high-water depth, drops and latency."""
+        q = self.queue
+        return {'id': self.id,
+                'depth': q.qsize(),
+                'high_water': q.high_water,
+                'dropped': q.dropped,
+                'latency_hist': q.latency_hist,
+                'latency_max_us': q.latency_max}
+
     def subscribe(self, topic: str):
         """Subscribe this subscriber to a topic."""
         self.bus.subscribe(self, topic)
@@ -132,13 +453,19 @@ class Subscriber:
         self.bus.unsubscribe_all(self)
 
     def close(self):
-        self.unsubscribe_all()
-        del self.queue
+        if self.bus is not None:
+            self.unsubscribe_all()
         self.queue = None
+        self.bus = None
 
-    def __del__(self):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
         self.close()
 
+    def __del__(self):
+        self.close()
 
 
 # -------------------------------
@@ -146,11 +473,22 @@ class Subscriber:
 # -------------------------------
 class Topic:
     """
-    Represents one named topic. Keeps a list of subscribers.
+    Represents one concrete topic name. Keeps the list of exact subscribers
+    and the cached fan-out (exact + matching wildcard subscribers) that the
+    bus resolves on first publish and drops on any subscription change.
     """
+    __slots__ = ('name', 'subscribers', 'fanout', 'published', '_envelope',
+                 '_rate_ms', '_rate_count')
+
     def __init__(self, name):
         self.name = name
         self.subscribers = []
+        self.fanout = None  # tuple of subscribers, None = not resolved
+        self.published = 0
+        self._envelope = None
+        # publish rate window, restarted by every MessageBus.stats()
+        self._rate_ms = time.ticks_ms()
+        self._rate_count = 0
 
     def add_subscriber(self, sub: Subscriber):
         if sub not in self.subscribers:
@@ -163,10 +501,71 @@ class Topic:
         except ValueError:
             pass
 
-    def publish(self, sender_id, message):
-        """Send a message to all subscribers."""
-        for sub in self.subscribers:
-            sub._push(self.name, sender_id, message)
+    def publish(self, sender_id, message, priority=PRIORITY_NORMAL):
+        """Send a message to all subscribers (exact and wildcard)."""
+        self.published += 1
+        if not self.fanout:
+            return
+        # one immutable envelope shared by all subscribers, reused as long as
+        # the same sender publishes the same object (events, constant messages)
+        envelope = self._envelope
+        if envelope is None or envelope[1] is not sender_id or envelope[2] is not message:
+            envelope = self._envelope = (self.name, sender_id, message)
+        for sub in self.fanout:
+            sub._push(envelope, priority)
+
+    def publish_many(self, sender_id, messages, priority=PRIORITY_NORMAL):
+        """Send a batch of messages, each subscriber is woken up once."""
+        self.published += len(messages)
+        if not self.fanout or not messages:
+            return
+        envelopes = [(self.name, sender_id, message) for message in messages]
+        for sub in self.fanout:
+            sub._push_many(envelopes, priority)
+
+
+class _TrieNode:
+    """One topic level of the wildcard subscription trie."""
+    __slots__ = ('children', 'subscribers')
+
+    def __init__(self):
+        self.children = {}     # level -> _TrieNode, '+' and '#' included
+        self.subscribers = []  # subscribers of the pattern ending here
+
+
+def _is_pattern(topic):
+    return '+' in topic or '#' in topic
+
+
+def topic_matches(pattern, topic):
+    """True if a concrete topic name matches a name or +/# pattern."""
+    if not _is_pattern(pattern):
+        return pattern == topic
+    p = pattern.split('/')
+    t = topic.split('/')
+    for i, level in enumerate(p):
+        if level == '#':
+            return True
+        if i == len(t) or (level != '+' and level != t[i]):
+            return False
+    return len(p) == len(t)
+
+
+# -------------------------------
+# Request / Reply
+# -------------------------------
+# Correlation id key added to a request message and echoed in the reply
+REPLY_ID = 'reply_id'
+
+
+class _PendingReply:
+    """Reusable wait slot of one in-flight MessageBus.request (pooled)."""
+    __slots__ = ('event', 'reply_topic', 'reply')
+
+    def __init__(self):
+        self.event = asyncio.Event()
+        self.reply_topic = None
+        self.reply = None
 
 
 # -------------------------------
@@ -174,9 +573,19 @@ class Topic:
 # -------------------------------
 class MessageBus:
     _instance = None
+    __slots__ = ('topics', '_wildcards', '_subscribers', '_pending', '_reply_pool', '_next_id',
+                 'instrumented', 'alloc_stats')
 
     def __init__(self):
-        self.topics = {}
+        self.topics = {}             # concrete name -> Topic
+        self._wildcards = _TrieNode()
+        self._subscribers = set()    # every Subscriber with a subscription
+        self._pending = {}      # correlation id -> _PendingReply
+        self._reply_pool = []   # free _PendingReply slots
+        self._next_id = 0
+        # allocation instrumentation, see instrument()
+        self.instrumented = False
+        self.alloc_stats = None
 
     @classmethod
     def instance(cls):
@@ -186,25 +595,245 @@ class MessageBus:
 
     def get_topic(self, name):
         """Return existing topic or create a new one."""
-        return self.topics.setdefault(name, Topic(name))
+        t = self.topics.get(name)
+        if t is None:
+            t = self.topics[name] = Topic(name)
+        return t
 
     def subscribe(self, subscriber: Subscriber, topic: str):
-        self.get_topic(topic).add_subscriber(subscriber)
+        """Subscribe to a topic name or a wildcard pattern."""
+        if topic in subscriber.topics:
+            return
+        if _is_pattern(topic):
+            node = self._wildcards
+            for level in topic.split('/'):
+                child = node.children.get(level)
+                if child is None:
+                    child = node.children[level] = _TrieNode()
+                node = child
+            node.subscribers.append(subscriber)
+        else:
+            self.get_topic(topic).add_subscriber(subscriber)
+        subscriber.topics.append(topic)
+        self._subscribers.add(subscriber)
+        self._invalidate()
 
     def unsubscribe(self, subscriber: Subscriber, topic: str):
-        """Remove subscriber from a topic."""
-        if topic in self.topics:
-            self.topics[topic].remove_subscriber(subscriber)
+        """Remove subscriber from a topic or a wildcard pattern."""
+        if topic not in subscriber.topics:
+            return
+        self._remove(subscriber, topic)
+        subscriber.topics.remove(topic)
+        if not subscriber.topics:
+            self._subscribers.discard(subscriber)
+        self._invalidate()
 
     def unsubscribe_all(self, subscriber: Subscriber):
+        """Remove subscriber from all its topics, O(own topics)."""
+        if not subscriber.topics:
+            return
+        for topic in subscriber.topics:
+            self._remove(subscriber, topic)
+        subscriber.topics = []
+        self._subscribers.discard(subscriber)
+        self._invalidate()
+
+    def _remove(self, subscriber, topic):
+        """Drop one subscription, pruning wildcard trie nodes left empty."""
+        if not _is_pattern(topic):
+            t = self.topics.get(topic)
+            if t is not None:
+                t.remove_subscriber(subscriber)
+            return
+        path = [self._wildcards]
+        levels = topic.split('/')
+        for level in levels:
+            node = path[-1].children.get(level)
+            if node is None:
+                return
+            path.append(node)
+        node = path[-1]
+        if subscriber in node.subscribers:
+            node.subscribers.remove(subscriber)
+        for i in range(len(levels) - 1, -1, -1):
+            node = path[i + 1]
+            if node.subscribers or node.children:
+                break
+            del path[i].children[levels[i]]
+
+    def _invalidate(self):
+        """Drop the cached fan-out sets, called on every subscription change."""
         for t in self.topics.values():
-            t.remove_subscriber(subscriber)
-
-    def publish(self, topic: str, sender_id=None, message=None):
+            t.fanout = None
+
+    def _resolve(self, t: Topic):
+        """Build the fan-out tuple of a concrete topic (exact + wildcard matches)."""
+        subs = list(t.subscribers)
+        levels = t.name.split('/')
+        stack = [(self._wildcards, 0)]
+        while stack:
+            node, i = stack.pop()
+            multi = node.children.get('#')
+            if multi is not None:
+                subs.extend(multi.subscribers)
+            if i == len(levels):
+                subs.extend(node.subscribers)
+                continue
+            child = node.children.get(levels[i])
+            if child is not None:
+                stack.append((child, i + 1))
+            child = node.children.get('+')
+            if child is not None:
+                stack.append((child, i + 1))
+        # a subscriber matched by several patterns gets the message once
+        fanout = []
+        for sub in subs:
+            if sub not in fanout:
+                fanout.append(sub)
+        return tuple(fanout)
+
+    def instrument(self, enable=True):
+        """
+        Measure the heap allocated by every publish (gc.mem_alloc() delta).
+        The counters restart on every enable, read them from alloc_stats:
+        {'publishes': <int>, 'bytes': <int>, 'max': <int>, 'skipped': <int>}
+        'skipped' counts publishes where a GC cycle ran and the delta was lost.
+        """
+        self.instrumented = enable
+        if enable:
+            self.alloc_stats = {'publishes': 0, 'bytes': 0, 'max': 0, 'skipped': 0}
+
+    def publish(self, topic: str, sender_id=None, message=None, priority=PRIORITY_NORMAL):
         """Low-level publish (used by Publisher)."""
-
-        t = self.get_topic(topic)
-        t.publish(sender_id, message)
+        if self.instrumented:
+            mem0 = gc.mem_alloc()
+            self._publish(topic, sender_id, message, priority)
+            delta = gc.mem_alloc() - mem0
+            stats = self.alloc_stats
+            if delta < 0:
+                stats['skipped'] += 1
+                return
+            stats['publishes'] += 1
+            stats['bytes'] += delta
+            if delta > stats['max']:
+                stats['max'] = delta
+        else:
+            self._publish(topic, sender_id, message, priority)
+
+    def _publish(self, topic, sender_id, message, priority=PRIORITY_NORMAL):
+        t = self.topics.get(topic)
+        if t is None:
+            t = self.get_topic(topic)
+        if t.fanout is None:
+            t.fanout = self._resolve(t)
+        t.publish(sender_id, message, priority)
+
+    def publish_many(self, topic: str, sender_id=None, messages=(), priority=PRIORITY_NORMAL):
+        """Publish a batch of messages on one topic with a single notification."""
+        t = self.topics.get(topic)
+        if t is None:
+            t = self.get_topic(topic)
+        if t.fanout is None:
+            t.fanout = self._resolve(t)
+        t.publish_many(sender_id, messages, priority)
+
+    def subscribers(self):
+        """All subscribers with at least one subscription (exact or wildcard)."""
+        return list(self._subscribers)
+
+    def find_orphans(self, idle_ms=60_000):
+        """
+        Leak detector: subscribers that still receive messages (non empty
+        queue) but were not read for idle_ms, typically a task that died or a
+        short lived Subscriber that was never closed.
+        Returns [{'id', 'topics', 'depth', 'dropped', 'idle_ms'}, ...]
+        """
+        now = time.ticks_ms()
+        orphans = []
+        for sub in self._subscribers:
+            idle = time.ticks_diff(now, sub.last_get_ms)
+            if idle >= idle_ms and not sub.queue.empty():
+                orphans.append({'id': sub.id, 'topics': sub.topics, 'depth': sub.queue.qsize(),
+                                'dropped': sub.queue.dropped, 'idle_ms': idle})
+        return orphans
+
+    def stats(self):
+        """
+        Bus telemetry snapshot (JSON friendly):
+        {'topics': {<name>: {'published': <int>, 'rate': <msg/s>, 'subscribers': <int>}},
+         'subscribers': [Subscriber.stats(), ...],
+         'orphans': find_orphans(),
+         'latency_bounds_us': LATENCY_BOUNDS_US}
+        'rate' is measured since the previous stats() call.
+        """
+        now = time.ticks_ms()
+        topics = {}
+        for name, t in self.topics.items():
+            dt = time.ticks_diff(now, t._rate_ms)
+            rate = (t.published - t._rate_count) * 1000 / dt if dt > 0 else 0
+            t._rate_ms = now
+            t._rate_count = t.published
+            topics[name] = {'published': t.published,
+                            'rate': round(rate, 2),
+                            'subscribers': len(t.fanout if t.fanout is not None else t.subscribers)}
+        return {'topics': topics,
+                'subscribers': [sub.stats() for sub in self._subscribers],
+                'orphans': self.find_orphans(),
+                'latency_bounds_us': LATENCY_BOUNDS_US}
+
+    def reply(self, topic: str, sender_id, message, cid, priority=PRIORITY_NORMAL):
+        """
+        Publish message on topic as the reply to the request with correlation
+        id cid and hand it to that request if it is still waiting.
+        The id is bus internal and never added to the reply, so a late reply
+        (the request timed out) reaches the subscribers as a plain message.
+        """
+        self.publish(topic, sender_id, message, priority)
+        pending = self._pending.get(cid)
+        if pending is None or pending.reply is not None:
+            return
+        if pending.reply_topic is not None and pending.reply_topic != topic:
+            return
+        pending.reply = (topic, sender_id, message)
+        pending.event.set()
+
+    async def request(self, topic: str, payload=None, timeout=2, reply_topic=None, sender_id=None,
+                      priority=PRIORITY_NORMAL):
+        """
+        Publish payload on topic and wait for the reply to it.
+        The message is tagged with a correlation id (REPLY_ID) that the
+        replying task echoes with Publisher.reply(), so concurrent requests
+        only ever receive their own reply. If reply_topic is given the reply
+        must also arrive on that topic.
+        payload must be a dict (or empty), the request is a copy of it.
+        Returns (topic, sender_id, message).
+        Raises ValueError for any other payload, asyncio.TimeoutError if no
+        reply arrived within timeout seconds.
+        """
+        if payload and not isinstance(payload, dict):
+            raise ValueError('Request payload must be an object')
+        self._next_id = (self._next_id + 1) & 0x3FFFFFFF  # keep it a small int
+        cid = self._next_id
+        message = dict(payload) if payload else {}
+        message[REPLY_ID] = cid
+        pending = self._reply_pool.pop() if self._reply_pool else _PendingReply()
+        pending.reply_topic = reply_topic
+        # register after publishing, the request itself carries the same id
+        self.publish(topic, sender_id, message, priority)
+        self._pending[cid] = pending
+        try:
+            if timeout is None:
+                await pending.event.wait()
+            else:
+                await asyncio.wait_for(pending.event.wait(), timeout)
+            reply = pending.reply
+        finally:
+            del self._pending[cid]
+            pending.reply = None
+            pending.reply_topic = None
+            pending.event.clear()
+            self._reply_pool.append(pending)
+        return reply
 
 
 # -------------------------------
@@ -215,18 +844,46 @@ class Publisher:
     A publisher has a fixed sender_id string.
     Publishes messages or events to topics.
     """
+    __slots__ = ('id', 'bus')
+
     def __init__(self, publisher_id: str):
         self.id = publisher_id
         self.bus = MessageBus.instance()
 
-    def publish(self, topic: str, message=None):
-        log.debug('Publish topic:%s sender_id:%s message:%s' % (topic, self.id, message))
-        self.bus.publish(topic, sender_id=self.id, message=message)
+    def publish(self, topic: str, message=None, priority=PRIORITY_NORMAL):
+        # do not build the debug string unless it is going to be logged
+        if log.is_enabled(t_logger.DEBUG):
+            log.debug('Publish topic:%s sender_id:%s message:%s' % (topic, self.id, message))
+        self.bus.publish(topic, self.id, message, priority)
+
+    def publish_many(self, topic: str, messages, priority=PRIORITY_NORMAL):
+        """Publish a list of messages, each subscriber is notified once."""
+        if log.is_enabled(t_logger.DEBUG):
+            log.debug('Publish many topic:%s sender_id:%s count:%d' % (topic, self.id, len(messages)))
+        self.bus.publish_many(topic, self.id, messages, priority)
 
     def event(self, topic: str):
         """Publish an event (message=None)."""
         self.publish(topic, None)
 
+    def reply(self, request, topic: str, message):
+        """
+        Publish message on topic as the reply to request (a message received
+        from the bus), routed by its correlation id to MessageBus.request().
+        """
+        if not (isinstance(request, dict) and REPLY_ID in request):
+            self.publish(topic, message)
+            return
+        if log.is_enabled(t_logger.DEBUG):
+            log.debug('Reply topic:%s sender_id:%s message:%s' % (topic, self.id, message))
+        self.bus.reply(topic, self.id, message, request[REPLY_ID])
+
+    async def request(self, topic: str, message=None, timeout=2, reply_topic=None,
+                      priority=PRIORITY_NORMAL):
+        """Send a request and wait for its reply, see MessageBus.request()."""
+        return await self.bus.request(topic, message, timeout=timeout, reply_topic=reply_topic,
+                                      sender_id=self.id, priority=priority)
+
     def close(self):
         self.bus = None
 
@@ -2,6 +2,7 @@ import time
 import esp32
 import gc
 import usocket as socket
+import uasyncio as asyncio
 
 # Log Levels
 DEBUG    = 10
@@ -18,6 +19,13 @@ LEVEL_NAMES = {
     50: "CRIT"
 }
 
+# Buffered output: log() only stores the record in a preallocated ring, the
+# flush_task() prints it and packs the network lines ('\n' separated) into
+# few multicast datagrams. Until the task runs, records are written at once.
+RING_SIZE = 64          # records buffered, the oldest is dropped (and counted) on overflow
+BATCH_BYTES = 1024      # payload of one log datagram
+FLUSH_DELAY_MS = 20     # gather records this long after the first one
+
 _logger_instance = None
 
 class Logger:
@@ -28,6 +36,15 @@ class Logger:
         self.multicast_ip = '224.0.1.187'
         self.multicast_port = 5683
         self.topic = "log"
+        self._ring = [[0, 0, None] for _ in range(RING_SIZE)]  # [ticks_ms, level, msg] slots
+        self._head = 0
+        self._count = 0
+        self._event = asyncio.Event()
+        self._buffered = False  # flush_task() is running
+        self.dropped = 0
+        self._dropped_reported = 0
+        self.datagrams = 0
+        self.lines = 0
 
     def set_level(self, console=None, network=None):
         """Change log levels at runtime."""
@@ -44,6 +61,11 @@ class Logger:
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         print(f"[Logger] UDP logging enabled to {ip}:{port}")
 
+    def is_enabled(self, level):
+        """True if a message of this level is logged (console or network).
+        Use it to skip building expensive messages in hot paths."""
+        return level >= self.level_console or level >= self.level_network
+
     def log(self, level, msg, *args, **kwargs):
         if level < self.level_console and level < self.level_network:
             return
@@ -54,21 +76,86 @@ class Logger:
             except:
                 pass
 
-        # Console Logging
-        if level >= self.level_console:
-            t = time.localtime()
-            ts = "{:02d}:{:02d}:{:02d}".format(t[3], t[4], t[5])
+        if self._count == RING_SIZE:
+            # full: overwrite the oldest record
+            self.dropped += 1
+            self._head = (self._head + 1) % RING_SIZE
+            self._count -= 1
+        slot = self._ring[(self._head + self._count) % RING_SIZE]
+        slot[0] = time.ticks_ms()
+        slot[1] = level
+        slot[2] = msg
+        self._count += 1
+        if self._buffered:
+            self._event.set()
+        else:
+            self.flush()
+
+    def flush(self):
+        """Write out the buffered records: console lines, network lines in batches."""
+        now_ms = time.ticks_ms()
+        now_s = time.time()
+        batch = []
+        size = 0
+        if self.dropped != self._dropped_reported:
+            line = f"[Logger] {self.dropped - self._dropped_reported} records dropped"
+            self._dropped_reported = self.dropped
+            if WARNING >= self.level_console:
+                print(line)
+            if self.sock and WARNING >= self.level_network:
+                batch.append(f"[WARN] {line}".encode('utf-8'))
+                size = len(batch[0])
+        while self._count:
+            slot = self._ring[self._head]
+            level = slot[1]
+            msg = slot[2]
+            slot[2] = None
+            self._head = (self._head + 1) % RING_SIZE
+            self._count -= 1
             lname = LEVEL_NAMES.get(level, "LOG")
-            print(f"[{ts}] [{lname}] {msg}")
 
-        # Network Logging (CoAP Multicast)
-        if level >= self.level_network and self.sock:
-            try:
-                lname = LEVEL_NAMES.get(level, "LOG")
-                payload = f"[{lname}] {msg}"
-                self.sock.sendto(payload.encode('utf-8'), (self.multicast_ip, self.multicast_port))
-            except Exception as e:
-                print(f"[Logger] Network Error: {e}")
+            # Console Logging (wall clock of the record, not of the flush)
+            if level >= self.level_console:
+                t = time.localtime(now_s - time.ticks_diff(now_ms, slot[0]) // 1000)
+                ts = "{:02d}:{:02d}:{:02d}".format(t[3], t[4], t[5])
+                print(f"[{ts}] [{lname}] {msg}")
+
+            # Network Logging (CoAP Multicast)
+            if level >= self.level_network and self.sock:
+                line = f"[{lname}] {msg}".encode('utf-8')
+                if batch and size + 1 + len(line) > BATCH_BYTES:
+                    self._send(batch)
+                    batch = []
+                    size = 0
+                size += len(line) + (1 if batch else 0)
+                batch.append(line)
+        if batch:
+            self._send(batch)
+
+    def _send(self, lines):
+        try:
+            self.sock.sendto(b'\n'.join(lines), (self.multicast_ip, self.multicast_port))
+            self.datagrams += 1
+            self.lines += len(lines)
+        except Exception as e:
+            print(f"[Logger] Network Error: {e}")
+
+    async def flush_task(self):
+        """Buffer the records from now on and write them out from this task."""
+        self._buffered = True
+        try:
+            while True:
+                await self._event.wait()
+                self._event.clear()
+                await asyncio.sleep_ms(FLUSH_DELAY_MS)
+                self.flush()
+        finally:
+            self._buffered = False
+            self.flush()
+
+    def stats(self):
+        return {'buffered': self._count, 'dropped': self.dropped, 'datagrams': self.datagrams,
+                'lines': self.lines, 'ring': RING_SIZE}
 
     def debug(self, msg, *args, **kwargs):
         self.log(DEBUG, msg, *args, **kwargs)
@@ -0,0 +1,78 @@
+# Direct task resources: /task/<name> bound onto MessageBus topics.
+#
+#   POST /task/motors {'motor0_power': 50, 'motor1_power': 50}
+# publishes the body as is on the bound topic, without the
+#   {'topic', 'reply_topic', 'payload', ...}
+# wrapper of /app/messagebus, and answers with the task's reply message when
+# the binding has a reply topic. Query options:
+#   ?timeout=<s> reply timeout (up to 300), ?priority=<0..2>,
+#   ?noreply publish only; other values are answered with 4.00
+#   GET /task lists the bindings.
+# One '/task/{name}' route serves every binding (path parameter route, see
+# AsyncCoAPServer.route()), the name is looked up in a dict.
+import uasyncio as asyncio
+import utils.t_logger as t_logger
+from utils.messagebus import Publisher, check_priority, check_timeout, PRIORITY_NORMAL, PRIORITY_URGENT
+from utils.coap_server import (
+    iter_json, RESP_CONTENT, RESP_CHANGED, RESP_BAD_REQ, RESP_NOT_FOUND, RESP_INTERNAL_ERR,
+)
+
+log = t_logger.get_logger()
+
+# name -> (bus topic, reply topic or None, default reply timeout s)
+TASK_BINDINGS = {
+    'motors': ('motors_task', 'motors_report', 2),
+    'servo': ('servo_task', 'servo_report', 3),
+    'leds': ('led_task', 'leds_report', 2),
+    'us': ('us_task', 'us_report', 3),
+    'ahrs': ('ahrs_task', 'ahrs_report', 30),  # 'calibrate' takes 20 s
+    'display': ('display_task', 'display_report', 2),
+    'us_scan': ('us_scan', 'us_scan_report', 120),
+}
+
+
+class TaskResources:
+    def __init__(self, server, bindings=TASK_BINDINGS):
+        self.bindings = bindings
+        self.publisher = Publisher('coap_task')
+        server.route('/task', ('GET',))(self._list_handler)
+        # long reply waits (us_scan, calibration) leave workers for the other routes,
+        # ?priority=2 (a stop) is admitted past every limit
+        server.route('/task/{name}', ('POST', 'PUT'), max_concurrency=6,
+                     urgent=lambda req: req.query.get('priority') == PRIORITY_URGENT)(self._handler)
+
+    async def _list_handler(self, req):
+        return RESP_CONTENT, {name: {'topic': b[0], 'reply_topic': b[1], 'timeout': b[2]}
+                              for name, b in self.bindings.items()}
+
+    async def _handler(self, req):
+        name = req.params['name']
+        binding = self.bindings.get(name)
+        if binding is None:
+            return RESP_NOT_FOUND, {'text': f"No task '{name}'"}
+        topic, reply_topic, timeout = binding
+        query = req.query
+        payload = req.json
+        if req.bad_body:
+            return RESP_BAD_REQ, {'text': "Malformed body"}
+        try:
+            priority = check_priority(query.get('priority', PRIORITY_NORMAL))
+            timeout = check_timeout(query.get('timeout', timeout))
+        except ValueError as e:
+            return RESP_BAD_REQ, {'text': str(e)}
+
+        if reply_topic is None or 'noreply' in query:
+            self.publisher.publish(topic, payload, priority)
+            return RESP_CHANGED
+
+        req.send_ack()
+        try:
+            _, _, message = await self.publisher.request(
+                topic, payload, timeout=timeout,
+                reply_topic=reply_topic, priority=priority)
+        except ValueError as e:
+            return RESP_BAD_REQ, {'text': str(e)}
+        except asyncio.TimeoutError:
+            return RESP_INTERNAL_ERR, {'text': "Timeout waiting for reply"}
+        # streamed: large replies (e.g. us_scan_report) go out as Block2
+        return RESP_CONTENT, iter_json(message)
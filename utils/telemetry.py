@@ -0,0 +1,47 @@
+# Observe telemetry: CoAP resources fed by MessageBus report topics.
+#
+#   GET /telemetry/ahrs (Observe: 0) [?rate_ms=100]
+# returns the latest report, then the server pushes every new report of the
+# topic to the observer (rate limited per observer, see coap_server.py).
+# A conflating subscriber keeps only the newest report per topic, so a burst
+# of reports costs one JSON encoding per resource.
+import uasyncio as asyncio
+import utils.t_logger as t_logger
+from utils.messagebus import Subscriber
+from utils.coap_server import RESP_CONTENT
+
+log = t_logger.get_logger()
+
+# resource path -> bus topic
+TELEMETRY_TOPICS = {
+    '/telemetry/ahrs': 'ahrs_report',
+    '/telemetry/us': 'us_report',
+    '/telemetry/motors': 'motors_report',
+}
+
+
+class Telemetry:
+    def __init__(self, server, resources=TELEMETRY_TOPICS):
+        self.server = server
+        self.paths = {topic: path for path, topic in resources.items()}
+        self.latest = {path: {} for path in resources}
+        self.sub = Subscriber('telemetry', topics=list(self.paths), conflate=True)
+        for path in resources:
+            server.route(path, ('GET',))(self._handler)
+
+    async def _handler(self, req):
+        # initial "current state" response of an observation (or a plain GET)
+        return RESP_CONTENT, self.latest[req.path]
+
+    async def run(self):
+        while True:
+            for topic, sender_id, message in await self.sub.get_many(len(self.paths)):
+                path = self.paths.get(topic)
+                if path is None:
+                    continue
+                self.latest[path] = message
+                self.server.notify_observers(path, message)
+
+
+async def telemetry_task(server, resources=TELEMETRY_TOPICS):
+    await Telemetry(server, resources).run()